@@ -0,0 +1,90 @@
+"""In-memory caches shared by the request handlers of a worker process."""
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import metrics
+
+
+class TTLCache:
+    """Thread safe LRU cache bounded by the total size of its entries.
+
+    Entries expire after ttl seconds (never when ttl is None), entries larger
+    than max_entry_bytes are not stored at all and the least recently used
+    entries are evicted once the cache grows over max_bytes. Hits and misses
+    are published as metrics labelled with the cache name.
+    """
+
+    def __init__(self, name, ttl=None, max_bytes=64 * 1024 * 1024, max_entry_bytes=None):
+        """Initialize empty cache."""
+        self.name = name
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes or max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key, default=None):
+        """Get the value stored under the key, default if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        self._record(hit=entry is not None)
+        return entry[0] if entry is not None else default
+
+    def age(self, key):
+        """Get the number of seconds since the value under the key was stored."""
+        with self._lock:
+            entry = self._entries.get(key)
+        return time.time() - entry[2] if entry is not None else None
+
+    def set(self, key, value, size):
+        """Store the value of the given size in bytes, return False if it is too large."""
+        if size > self.max_entry_bytes:
+            metrics.increment('cache.{}.oversized'.format(self.name))
+            return False
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.time())
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                metrics.increment('cache.{}.evictions'.format(self.name))
+        return True
+
+    def delete(self, key):
+        """Drop the value stored under the key."""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        """Drop all entries."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self):
+        """Get number of entries, including the expired ones not evicted yet."""
+        return len(self._entries)
+
+    def _expired(self, entry):
+        return self.ttl is not None and time.time() - entry[2] >= self.ttl
+
+    def _remove(self, key):
+        _value, size, _stored_at = self._entries.pop(key)
+        self._size -= size
+
+    def _record(self, hit):
+        metrics.increment('cache.{}.{}'.format(self.name, 'hits' if hit else 'misses'))
+        hits = metrics.get('cache.{}.hits'.format(self.name))
+        misses = metrics.get('cache.{}.misses'.format(self.name))
+        metrics.set_gauge('cache.{}.hit_ratio'.format(self.name),
+                          float(hits) / (hits + misses))
@@ -0,0 +1,146 @@
+"""Compression of the responses negotiated by the Accept-Encoding request header."""
+import os
+import zlib
+
+from metrics import metrics
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# Responses smaller than COMPRESS_MIN_SIZE bytes are sent as they are, 0 disables compression
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", "6"))
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/plain', 'text/html')
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Stream Gremlin and S3 JSON bytes to clients as they come instead of re-encoding them.
+# Streamed graph queries are served from and stored in the GREMLIN_CACHE_TTL cache as
+# raw bytes, but concurrent identical queries are not coalesced into one upstream call.
+STREAM_UPSTREAM_RESPONSES = os.environ.get("STREAM_UPSTREAM_RESPONSES", "false").lower() \
+    in ("1", "true")
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def is_gzip(content):
+    """Check whether the bytes start a gzip stream."""
+    return content[:2] == GZIP_MAGIC
+
+
+def gunzip_chunks(chunks):
+    """Decompress the chunks if they form a gzip stream, pass them through otherwise."""
+    chunks = iter(chunks)
+    first = next(chunks, b'')
+    if not is_gzip(first):
+        yield first
+        yield from chunks
+        return
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    yield decompressor.decompress(first)
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+def gunzip(content):
+    """Decompress the bytes if they are gzip compressed."""
+    if not is_gzip(content):
+        return content
+    return zlib.decompress(content, 16 + zlib.MAX_WBITS)
+
+
+def choose_encoding(accept_encodings):
+    """Choose the content encoding preferred by the client, None for identity.
+
+    :param accept_encodings: werkzeug Accept of the Accept-Encoding request header
+    """
+    if brotli is not None and accept_encodings['br'] > 0 and \
+            accept_encodings['br'] >= accept_encodings['gzip']:
+        return 'br'
+    if accept_encodings['gzip'] > 0:
+        return 'gzip'
+    return None
+
+
+class _Compressor:
+    """Incremental compressor of the given encoding."""
+
+    def __init__(self, encoding):
+        """Initialize the compressor."""
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=min(COMPRESS_LEVEL, 11))
+            self._compress = self._compressor.process
+        else:
+            self._compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED,
+                                                16 + zlib.MAX_WBITS)
+            self._compress = self._compressor.compress
+
+    def compress(self, data):
+        """Compress next part of the data."""
+        return self._compress(data)
+
+    def finish(self):
+        """Get the end of the compressed stream."""
+        if brotli is not None and isinstance(self._compressor, brotli.Compressor):
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compress(data, encoding):
+    """Compress the data with the given encoding."""
+    compressor = _Compressor(encoding)
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_chunks(chunks, encoding):
+    """Compress the chunks of a streamed response with the given encoding."""
+    compressor = _Compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response, accept_encodings):
+    """Compress the response body if the client accepts it and it is worth it.
+
+    Streamed responses are compressed on the fly whatever their size. Responses
+    that already have a Content-Encoding are left intact, as well as responses
+    to clients that do not send Accept-Encoding.
+    """
+    if COMPRESS_MIN_SIZE <= 0 or response.mimetype not in COMPRESSIBLE_MIMETYPES or \
+            response.status_code < 200 or response.status_code in (204, 206, 304) or \
+            'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+        response.direct_passthrough = False
+        metrics.increment('compression.{}.streamed'.format(encoding))
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        compressed = compress(data, encoding)
+        response.set_data(compressed)
+        metrics.increment('compression.{}.responses'.format(encoding))
+        metrics.increment('compression.{}.saved_bytes'.format(encoding),
+                          len(data) - len(compressed))
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,343 @@
+"""Postgres sessions, replicas of the database and the worker results stored there."""
+import datetime
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+from flask import current_app
+from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker, scoped_session
+from f8a_worker.models import WorkerResult
+
+from graph import sanitize_text_for_query
+from lazy import Lazy
+
+logger = logging.getLogger(__name__)
+
+# Reject pass-through SQL queries whose EXPLAIN estimate is over the budget
+PGSQL_EXPLAIN_GUARD = os.environ.get("PGSQL_EXPLAIN_GUARD", "false").lower() in ("1", "true")
+PGSQL_MAX_QUERY_COST = float(os.environ.get("PGSQL_MAX_QUERY_COST", "100000"))
+PGSQL_MAX_QUERY_ROWS = float(os.environ.get("PGSQL_MAX_QUERY_ROWS", "100000"))
+PGSQL_STATEMENT_TIMEOUT_MS = int(os.environ.get("PGSQL_STATEMENT_TIMEOUT_MS", "30000"))
+
+
+class PostgresPassThrough:
+    """Postgres connection pass through session and cursor handler."""
+
+    def __init__(self):
+        """Initialize the connection to Postgres database using psycopg2 as a pass through."""
+        self.conn_string = self.get_conn_string(
+            os.getenv('PGBOUNCER_SERVICE_HOST', 'bayesian-pgbouncer'))
+
+    @staticmethod
+    def get_conn_string(host, port=None):
+        """Get psycopg2 connection string for the given database host."""
+        conn_string = "host='{host}' dbname='{dbname}' user='{user}' password='{password}'".\
+            format(host=host,
+                   dbname=os.getenv('POSTGRESQL_DATABASE', 'coreapi'),
+                   user=os.getenv('POSTGRESQL_USER', 'coreapi'),
+                   password=os.getenv('POSTGRESQL_PASSWORD', 'coreapi'))
+        if port:
+            conn_string += " port='{port}'".format(port=port)
+        return conn_string
+
+    def connect(self):
+        """Connect to a replica if there is a healthy one, to the primary otherwise."""
+        replica = _replicas.pick()
+        if replica is not None:
+            try:
+                return psycopg2.connect(self.get_conn_string(*replica))
+            except psycopg2.Error as e:
+                logger.error("Cannot connect to replica %s, using primary: %s", replica[0], e)
+                _replicas.mark_unhealthy(replica)
+        return psycopg2.connect(self.conn_string)
+
+    def fetch_records(self, data, client_validated):
+        """Fetch records from RDS database."""
+        if data and data.get('query'):
+            conn = cursor = None
+            try:
+                conn = self.connect()
+                cursor = conn.cursor()
+                # sanitize the query to drop CRUD operations
+                query = sanitize_text_for_query(data['query'])
+                if query:
+                    # applies to the current transaction only
+                    cursor.execute("SET LOCAL statement_timeout = %s",
+                                   (PGSQL_STATEMENT_TIMEOUT_MS,))
+                    if PGSQL_EXPLAIN_GUARD:
+                        rejection = self.check_query_cost(cursor, query)
+                        if rejection:
+                            return rejection
+                    cursor.execute(query)
+
+                    if client_validated:
+                        return {'data': cursor.fetchall()}
+                    return {'data': cursor.fetchmany(10)}
+            except (ValueError, Exception) as e:
+                return {'error': str(e)}
+            finally:
+                if conn is not None:
+                    conn.commit()
+                    cursor.close()
+                    conn.close()
+        else:
+            return {'warning': 'Invalid payload. Check your payload once again'}
+
+    @staticmethod
+    def check_query_cost(cursor, query):
+        """Estimate the query with EXPLAIN and reject it if it is over the budget.
+
+        :return: None if the query can run, dict describing the rejection otherwise
+        """
+        query = query.rstrip(';').strip()
+        if ';' in query:
+            return {'error': 'Only a single select query is supported'}
+
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + query)
+        plan = cursor.fetchone()[0][0]['Plan']
+        estimate = {'cost': plan.get('Total Cost'), 'rows': plan.get('Plan Rows')}
+        if estimate['cost'] > PGSQL_MAX_QUERY_COST or estimate['rows'] > PGSQL_MAX_QUERY_ROWS:
+            logger.info("Rejecting pass through query with estimate %r", estimate)
+            return {
+                'error': 'Query is too expensive to run, please narrow it down '
+                         '(e.g. by filtering on an indexed column or adding a limit)',
+                'estimate': estimate,
+                'budget': {'cost': PGSQL_MAX_QUERY_COST, 'rows': PGSQL_MAX_QUERY_ROWS}
+            }
+        return None
+
+
+class Postgres:
+    """Postgres utility class to create postgres connection session."""
+
+    def __init__(self, host=None, port=None):
+        """Postgres utility class constructor."""
+        con_string = 'postgresql://{user}' + ':{passwd}@{pg_host}:' \
+                     + '{pg_port}/{db}?sslmode=disable'
+
+        self.connection = con_string.format(
+            user=os.getenv('POSTGRESQL_USER'),
+            passwd=os.getenv('POSTGRESQL_PASSWORD'),
+            pg_host=host or os.getenv(
+                'PGBOUNCER_SERVICE_HOST',
+                'bayesian-pgbouncer'),
+            pg_port=port or os.getenv(
+                'PGBOUNCER_SERVICE_PORT',
+                '5432'),
+            db=os.getenv('POSTGRESQL_DATABASE'))
+        engine = create_engine(self.connection)
+
+        self.Session = sessionmaker(bind=engine)
+        # sessions are not thread-safe, every thread (request handlers, report watcher,
+        # outbox drainers) gets its own one through the scoped session, see remove_sessions
+        self.session = scoped_session(self.Session)
+
+    def session(self):
+        """Postgres utility session getter."""
+        return self.session
+
+
+_rdb = Lazy('postgres', Postgres)
+
+
+class ReplicaRouter:
+    """Routes read-only work to Postgres replicas that do not lag behind the primary.
+
+    Replicas are given as comma separated host[:port] list, each of them is
+    checked for replication lag at most once per check interval. Callers get
+    None when no replica is healthy and are expected to use the primary.
+    """
+
+    LAG_QUERY = "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() " \
+                "THEN 0 ELSE COALESCE(EXTRACT(EPOCH FROM now() - " \
+                "pg_last_xact_replay_timestamp()), 0) END"
+
+    def __init__(self, hosts, max_lag_seconds=10, check_interval=30):
+        """Initialize the router with the replicas found in the hosts string."""
+        self.replicas = []
+        for host in (hosts or '').split(','):
+            host, _, port = host.strip().partition(':')
+            if host:
+                self.replicas.append((host, port or os.getenv('PGBOUNCER_SERVICE_PORT', '5432')))
+        self.max_lag_seconds = max_lag_seconds
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._next = 0
+        self._health = {}
+        self._databases = {}
+
+    def pick(self):
+        """Pick next healthy replica in round robin fashion, None if there is none."""
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = self.replicas[self._next % len(self.replicas)]
+                self._next += 1
+            if self.is_healthy(replica):
+                return replica
+        return None
+
+    def is_healthy(self, replica):
+        """Check whether the replica is reachable and its lag is within the limit."""
+        now = time.time()
+        with self._lock:
+            checked_at, healthy = self._health.get(replica, (None, False))
+        if checked_at is not None and now - checked_at < self.check_interval:
+            return healthy
+
+        healthy = self.check_lag(replica)
+        with self._lock:
+            self._health[replica] = (now, healthy)
+        return healthy
+
+    def check_lag(self, replica):
+        """Query the replication lag of the replica."""
+        conn = None
+        try:
+            conn = psycopg2.connect(PostgresPassThrough.get_conn_string(*replica),
+                                    connect_timeout=2)
+            cursor = conn.cursor()
+            cursor.execute(self.LAG_QUERY)
+            lag = float(cursor.fetchone()[0])
+        except (psycopg2.Error, TypeError, ValueError) as e:
+            logger.error("Replication lag check of %s failed: %s", replica[0], e)
+            return False
+        finally:
+            if conn is not None:
+                conn.close()
+
+        if lag > self.max_lag_seconds:
+            logger.warning("Replica %s lags %.1f seconds behind, using primary", replica[0], lag)
+            return False
+        return True
+
+    def mark_unhealthy(self, replica):
+        """Stop using the replica until its next check."""
+        with self._lock:
+            self._health[replica] = (time.time(), False)
+
+    def get_session(self):
+        """Get session of a healthy replica, None if there is none."""
+        replica = self.pick()
+        if replica is None:
+            return None
+        with self._lock:
+            database = self._databases.get(replica)
+            if database is None:
+                database = self._databases[replica] = Postgres(*replica)
+        return database.session
+
+    def remove_sessions(self):
+        """End the replica sessions of the current thread."""
+        with self._lock:
+            databases = list(self._databases.values())
+        for database in databases:
+            database.session.remove()
+
+
+_replicas = ReplicaRouter(os.getenv('PGBOUNCER_REPLICA_HOSTS'),
+                          max_lag_seconds=float(os.getenv('REPLICA_MAX_LAG_SECONDS', '10')),
+                          check_interval=float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', '30')))
+
+
+def get_session(read_only=False):
+    """Retrieve the database connection session.
+
+    :param read_only: use session of a healthy replica when there is one
+    :return: database session
+    """
+    try:
+        session = _replicas.get_session() if read_only else None
+        if session is None:
+            session = _rdb.session
+    except Exception as e:
+        raise Exception("session could not be loaded due to {}".format(e))
+    return session
+
+
+def remove_sessions():
+    """End the database sessions of the current thread and return their connections to the pool.
+
+    Every thread gets its own session, so it has to be ended once the request or
+    the unit of background work is over, otherwise its connection stays checked
+    out, idle in transaction.
+    """
+    if _rdb.created:
+        _rdb.session.remove()
+    _replicas.remove_sessions()
+
+
+def query_worker_result(session, external_request_id, worker):  # pragma: no cover
+    """Query worker_result table."""
+    return session.query(WorkerResult) \
+        .filter(WorkerResult.external_request_id == external_request_id,
+                WorkerResult.worker == worker) \
+        .order_by(WorkerResult.ended_at.desc())
+
+
+def query_worker_results(session, external_request_ids, worker):  # pragma: no cover
+    """Query worker_result table for many external request ids at once."""
+    return session.query(WorkerResult) \
+        .filter(WorkerResult.external_request_id.in_(external_request_ids),
+                WorkerResult.worker == worker) \
+        .order_by(WorkerResult.ended_at.desc())
+
+
+def get_first_query_result(query):  # pragma: no cover
+    """Return first result of query."""
+    return query.first()
+
+
+def retrieve_worker_result(external_request_id, worker):
+    """Retrieve results for selected worker from RDB."""
+    start = datetime.datetime.now()
+    session = get_session(read_only=True)
+    try:
+        query = query_worker_result(session, external_request_id, worker)
+        result = get_first_query_result(query)
+    except SQLAlchemyError:
+        session.rollback()
+        raise
+
+    if result:
+        result_dict = result.to_dict()
+        elapsed_seconds = (datetime.datetime.now() - start).total_seconds()
+        msg = "It took {t} seconds to retrieve {w} " \
+            "worker results for {r}.".format(t=elapsed_seconds, w=worker, r=external_request_id)
+        current_app.logger.debug(msg)
+
+        return result_dict
+
+    return None
+
+
+def retrieve_worker_results(external_request_ids, worker):
+    """Retrieve latest results for selected worker and many requests from RDB.
+
+    :param external_request_ids: iterable of external request ids
+    :param worker: name of the worker
+    :return: dict mapping external request id to its latest result
+    """
+    results = {}
+    external_request_ids = list(set(external_request_ids))
+    if not external_request_ids:
+        return results
+
+    start = datetime.datetime.now()
+    session = get_session(read_only=True)
+    try:
+        # ordered by ended_at, the first row seen for every id is its latest result
+        for result in query_worker_results(session, external_request_ids, worker):
+            if result.external_request_id not in results:
+                results[result.external_request_id] = result.to_dict()
+    except SQLAlchemyError:
+        session.rollback()
+        raise
+
+    elapsed_seconds = (datetime.datetime.now() - start).total_seconds()
+    logger.debug("It took {t} seconds to retrieve {w} worker results for {n} requests."
+                 .format(t=elapsed_seconds, w=worker, n=len(external_request_ids)))
+    return results
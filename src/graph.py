@@ -0,0 +1,236 @@
+"""Pass-through of the queries to the graph database."""
+import base64
+import json
+import logging
+import os
+import re
+
+import requests
+
+from cache import TTLCache
+from compression import STREAM_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+GREMLIN_SERVER_URL_REST = "http://{host}:{port}".format(
+    host=os.environ.get("BAYESIAN_GREMLIN_HTTP_SERVICE_HOST", "localhost"),
+    port=os.environ.get("BAYESIAN_GREMLIN_HTTP_SERVICE_PORT", "8182"))
+
+# Results of graph pass-through queries are cached for GREMLIN_CACHE_TTL seconds, 0 disables
+GREMLIN_CACHE_TTL = int(os.environ.get("GREMLIN_CACHE_TTL", "30"))
+GREMLIN_CACHE_MAX_BYTES = int(os.environ.get("GREMLIN_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+GREMLIN_CACHE_MAX_ENTRY_BYTES = int(os.environ.get("GREMLIN_CACHE_MAX_ENTRY_BYTES",
+                                                   str(4 * 1024 * 1024)))
+# Unbounded graph pass-through traversals return at most this many elements,
+# it is also the largest page size of the paginated traversals
+GREMLIN_MAX_RESULTS = int(os.environ.get("GREMLIN_MAX_RESULTS", "10000"))
+# Seconds to wait for the graph database to respond, and between the streamed chunks
+GREMLIN_TIMEOUT = float(os.environ.get("GREMLIN_TIMEOUT", "60"))
+
+# Steps that already bound the traversal or end it, such traversals are left intact
+_BOUNDING_STEPS = re.compile(r'\.(limit|range|tail|count|sample|next|tryNext|hasNext|'
+                             r'toList|toSet|iterate|explain|drop)\(')
+
+
+def sanitize_text_for_query(text):
+    """
+    Sanitize text so it can used in queries.
+
+    :param text: string, text to sanitize
+    :return: sanitized text
+    """
+    if text is None:
+        return ''
+
+    if not isinstance(text, str):
+        raise ValueError(
+            'Invalid query text: expected string, got {t}'.format(t=type(text))
+        )
+
+    strict_check_words = ['drop', 'delete', 'update', 'remove', 'insert']
+    if re.compile('|'.join(strict_check_words), re.IGNORECASE).search(text):
+        raise ValueError('Only select queries are supported')
+
+    # remove newlines, quotes and backslash character
+    text = " ".join([line.strip() for line in text.split("\n")])
+    return text.strip()
+
+
+def is_plain_traversal(query):
+    """Check whether the query is a single traversal whose results can be bounded."""
+    return query.startswith('g.') and ';' not in query and \
+        not _BOUNDING_STEPS.search(query)
+
+
+def encode_cursor(offset):
+    """Encode offset of the next page into an opaque cursor."""
+    return base64.urlsafe_b64encode(json.dumps({'offset': offset}).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode offset of the next page from the cursor."""
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())['offset']
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError('Invalid cursor')
+    return offset
+
+
+class GraphPassThrough:
+    """Graph database pass through handler."""
+
+    def __init__(self):
+        """Initialize the cache of query results."""
+        self.cache = TTLCache('gremlin', ttl=GREMLIN_CACHE_TTL,
+                              max_bytes=GREMLIN_CACHE_MAX_BYTES,
+                              max_entry_bytes=GREMLIN_CACHE_MAX_ENTRY_BYTES)
+
+    def fetch_nodes(self, data, use_cache=True):
+        """Fetch node from graph database.
+
+        Results of traversals that are not bounded are limited to GREMLIN_MAX_RESULTS
+        elements, see fetch_limited. When page_size (and cursor of the next page) is
+        given, a page of the results is returned together with the cursor of the
+        following page.
+
+        :param data: dict, holding the query and optionally page_size and cursor
+        :param use_cache: serve the result from cache when the same query was run recently
+        """
+        if data and data.get('query'):
+            try:
+                if data.get('page_size') or data.get('cursor'):
+                    return self.fetch_page(self.sanitize(data['query']), data.get('page_size'),
+                                           data.get('cursor'), use_cache)
+                query = self.sanitize(data['query'])
+                if is_plain_traversal(query):
+                    return self.fetch_limited(query, use_cache)
+                if query:
+                    return {'data': self.run_query(query, use_cache)}
+            except (ValueError, requests.exceptions.Timeout, Exception) as e:
+                return {'error': str(e)}
+        else:
+            return {'warning': 'Invalid payload. Check your payload once again'}
+
+    def stream_nodes(self, data, use_cache=True):
+        """Stream the raw query result from graph database, wrapped in the data key.
+
+        The response of the graph database is passed through without being
+        decoded and encoded again. Its bytes are cached like the results of
+        fetch_nodes, unless they exceed the entry size limit of the cache.
+
+        :param data: dict, holding the query
+        :param use_cache: serve the result from cache when the same query was run recently
+        :return: generator of the response bytes
+        :raises requests.exceptions.HTTPError: when the graph database responds with an error
+        """
+        query = self.prepare_query(data['query'])
+        if not query:
+            raise ValueError('Invalid payload. Check your payload once again')
+
+        key = ('raw', query)
+        if use_cache and GREMLIN_CACHE_TTL > 0:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return iter([b'{"data": ', cached, b'}'])
+
+        resp = requests.post(url=GREMLIN_SERVER_URL_REST, json={'gremlin': query}, stream=True,
+                             timeout=GREMLIN_TIMEOUT)
+        if resp.status_code != 200:
+            resp.close()
+            raise requests.exceptions.HTTPError(
+                'Graph database responded with status {}'.format(resp.status_code),
+                response=resp)
+
+        def generate():
+            parts = [] if GREMLIN_CACHE_TTL > 0 else None
+            size = 0
+            try:
+                yield b'{"data": '
+                for chunk in resp.iter_content(STREAM_CHUNK_SIZE):
+                    if parts is not None:
+                        size += len(chunk)
+                        if size > GREMLIN_CACHE_MAX_ENTRY_BYTES:
+                            parts = None
+                        else:
+                            parts.append(chunk)
+                    yield chunk
+                yield b'}'
+                if parts is not None:
+                    # cache is refreshed even when it was bypassed
+                    self.cache.set(key, b''.join(parts), size)
+            finally:
+                resp.close()
+        return generate()
+
+    @staticmethod
+    def sanitize(query):
+        """Sanitize the query and drop its trailing semicolon."""
+        # sanitize the query to drop CRUD operations
+        return sanitize_text_for_query(query).rstrip(';').strip()
+
+    def limits_results(self, query):
+        """Check whether results of the query get limited to GREMLIN_MAX_RESULTS elements."""
+        try:
+            return is_plain_traversal(self.sanitize(query))
+        except ValueError:
+            return False
+
+    def prepare_query(self, query):
+        """Sanitize the query and limit results of the unbounded traversals."""
+        query = self.sanitize(query)
+        if is_plain_traversal(query):
+            query = '{query}.limit({limit})'.format(query=query, limit=GREMLIN_MAX_RESULTS)
+        return query
+
+    def fetch_limited(self, query, use_cache=True):
+        """Fetch at most GREMLIN_MAX_RESULTS results of the traversal.
+
+        The response tells whether the limit was reached, the results beyond it
+        can be paged through from the returned cursor on.
+        """
+        result = self.run_query('{query}.limit({limit})'.format(
+            query=query, limit=GREMLIN_MAX_RESULTS), use_cache)
+        elements = (result.get('result') or {}).get('data') or []
+        truncated = len(elements) >= GREMLIN_MAX_RESULTS
+        return {
+            'data': result,
+            'truncated': truncated,
+            'next_cursor': encode_cursor(GREMLIN_MAX_RESULTS) if truncated else None
+        }
+
+    def fetch_page(self, query, page_size, cursor, use_cache=True):
+        """Fetch one page of the traversal results."""
+        if not is_plain_traversal(query):
+            raise ValueError('Only single traversals without limiting or terminal steps '
+                             'can be paginated')
+        page_size = min(int(page_size or GREMLIN_MAX_RESULTS), GREMLIN_MAX_RESULTS)
+        if page_size <= 0:
+            raise ValueError('page_size must be a positive number')
+        offset = decode_cursor(cursor) if cursor else 0
+
+        end = offset + page_size
+        result = self.run_query('{query}.range({start}, {end})'.format(
+            query=query, start=offset, end=end), use_cache)
+        elements = (result.get('result') or {}).get('data') or []
+        return {
+            'data': result,
+            'next_cursor': encode_cursor(end) if len(elements) >= page_size else None
+        }
+
+    def run_query(self, query, use_cache=True):
+        """Run the query on the graph database, or get its result from cache."""
+        use_cache = use_cache and GREMLIN_CACHE_TTL > 0
+        if use_cache:
+            cached = self.cache.get(query)
+            if cached is not None:
+                return cached
+
+        payload = {'gremlin': query}
+        resp = requests.post(url=GREMLIN_SERVER_URL_REST, json=payload, timeout=GREMLIN_TIMEOUT)
+        result = resp.json()
+        if GREMLIN_CACHE_TTL > 0 and resp.status_code == 200:
+            # cache is refreshed even when it was bypassed
+            self.cache.set(query, result, len(resp.content))
+        return result
@@ -0,0 +1,78 @@
+"""Backend clients created on first use, or warmed up in the background."""
+import logging
+import threading
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_NOT_CREATED = object()
+
+
+class Lazy:
+    """Proxy of a backend client that is created by the factory on first use.
+
+    Attribute access is forwarded to the client, so the proxy can stand in for
+    it, apart from the instance and created attributes of the proxy itself. The
+    factory runs once per process, a failed attempt is not remembered and the
+    next use tries again.
+    """
+
+    def __init__(self, name, factory, *args, **kwargs):
+        """Initialize the proxy, the factory is called with the given arguments."""
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_args', args)
+        object.__setattr__(self, '_kwargs', kwargs)
+        object.__setattr__(self, '_lock', threading.Lock())
+        object.__setattr__(self, '_value', _NOT_CREATED)
+
+    @property
+    def created(self):
+        """Check whether the client has been created already."""
+        return self._value is not _NOT_CREATED
+
+    def instance(self):
+        """Get the client, create it if it does not exist yet."""
+        value = self._value
+        if value is not _NOT_CREATED:
+            return value
+
+        with self._lock:
+            if self._value is _NOT_CREATED:
+                start = time.time()
+                value = self._factory(*self._args, **self._kwargs)
+                metrics.set_gauge('startup.{}.init_seconds'.format(self._name),
+                                  time.time() - start)
+                object.__setattr__(self, '_value', value)
+            return self._value
+
+    def __getattr__(self, name):
+        """Get attribute of the client."""
+        return getattr(self.instance(), name)
+
+    def __setattr__(self, name, value):
+        """Set attribute of the client."""
+        setattr(self.instance(), name, value)
+
+    def __delattr__(self, name):
+        """Delete attribute of the client."""
+        delattr(self.instance(), name)
+
+
+def warm_up(*clients):
+    """Create the clients in a background thread so the first requests do not wait."""
+    def run():
+        start = time.time()
+        for client in clients:
+            try:
+                client.instance()
+            except Exception as e:
+                logger.error('Warm-up of %s failed, it is retried on first use: %r',
+                             client._name, e)
+        metrics.set_gauge('startup.warm_up_seconds', time.time() - start)
+
+    thread = threading.Thread(target=run, name='warm-up', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,52 @@
+"""In-process counters and gauges exposed by the /api/v1/metrics endpoint."""
+import os
+import threading
+
+
+class Metrics:
+    """Thread safe registry of named counters and gauges.
+
+    Every gunicorn worker process keeps its own registry, the snapshot
+    therefore carries the process id so the values can be told apart.
+    """
+
+    def __init__(self):
+        """Initialize empty registry."""
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+
+    def increment(self, name, value=1):
+        """Increment the counter by the given value."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        """Set the gauge to the given value."""
+        with self._lock:
+            self._gauges[name] = value
+
+    def get(self, name, default=0):
+        """Get current value of the counter or the gauge."""
+        with self._lock:
+            if name in self._counters:
+                return self._counters[name]
+            return self._gauges.get(name, default)
+
+    def snapshot(self):
+        """Return a copy of all counters and gauges."""
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'counters': dict(self._counters),
+                'gauges': dict(self._gauges)
+            }
+
+    def reset(self):
+        """Drop all counters and gauges."""
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+
+
+metrics = Metrics()
@@ -1,33 +1,214 @@
 """Sends notification to users."""
 
+import math
 import os
+import threading
+from collections import OrderedDict
+from itertools import chain
 from time import strftime, gmtime
 from uuid import uuid4
 
 import requests
 import logging
 
+from metrics import metrics
+from outbox import Drainer
+from payload_logging import log_payload
+
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Notifications are posted by NOTIFICATION_WORKERS threads, each post waits at most
+# NOTIFICATION_TIMEOUT seconds and at most NOTIFICATION_MAX_PENDING of them are queued
+NOTIFICATION_WORKERS = int(os.environ.get("NOTIFICATION_WORKERS", "3"))
+NOTIFICATION_TIMEOUT = float(os.environ.get("NOTIFICATION_TIMEOUT", "10"))
+NOTIFICATION_MAX_PENDING = int(os.environ.get("NOTIFICATION_MAX_PENDING", "100"))
+
+# Stored notifications are delivered in batches of NOTIFICATION_BATCH_SIZE every
+# NOTIFICATION_INTERVAL seconds, or right after they are stored
+NOTIFICATION_INTERVAL = float(os.environ.get("NOTIFICATION_INTERVAL", "30"))
+NOTIFICATION_BATCH_SIZE = int(os.environ.get("NOTIFICATION_BATCH_SIZE", "20"))
+
+# Notifications of a repository generated within NOTIFICATION_DIGEST_WINDOW seconds of the
+# first one are merged into a single digest, 0 (the default) sends every notification on
+# its own right away
+NOTIFICATION_DIGEST_WINDOW = float(os.environ.get("NOTIFICATION_DIGEST_WINDOW", "0"))
+
+
+def _notify_endpoint():
+    """Get URL of the notification service endpoint."""
+    url = os.getenv('NOTIFICATION_SERVICE_HOST', '').strip()
+    return '{url}/api/notify'.format(url=url)
+
+
+def _auth_headers(token):
+    """Get headers authenticating the request to the notification service."""
+    return {'Authorization': 'Bearer {token}'.format(token=token)}
+
+
+class NotificationSender:
+    """Delivers the notifications in the background.
+
+    The posts go through a FuturesSession, i.e. a pooled session used by a
+    fixed number of threads. The number of queued notifications is bounded,
+    notifications over the bound are rejected right away.
+    """
+
+    def __init__(self, session, max_pending=NOTIFICATION_MAX_PENDING,
+                 timeout=NOTIFICATION_TIMEOUT):
+        """Initialize the sender.
+
+        :param session: FuturesSession the notifications are posted with
+        """
+        self.session = session
+        self.timeout = timeout
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, notification, token):
+        """Queue the notification for the delivery.
+
+        :return: future of the response, None if the queue is full
+        """
+        if not self._pending.acquire(blocking=False):
+            metrics.increment('notifications.rejected')
+            logger.error('Notification %s rejected, too many notifications are pending',
+                         notification.get('data', {}).get('id'))
+            return None
+        try:
+            future = self.session.post(_notify_endpoint(), json=notification,
+                                       headers=_auth_headers(token), timeout=self.timeout)
+        except Exception:
+            self._pending.release()
+            raise
+        metrics.increment('notifications.enqueued')
+        future.add_done_callback(self._delivered)
+        return future
+
+    def _delivered(self, future):
+        """Record the outcome of the delivery."""
+        self._pending.release()
+        try:
+            future.result().raise_for_status()
+        except requests.exceptions.RequestException as e:
+            metrics.increment('notifications.failed')
+            logger.error('Notification cannot be delivered: %r', e)
+        else:
+            metrics.increment('notifications.delivered')
+
+
+def notification_lease(batch_size=NOTIFICATION_BATCH_SIZE, workers=NOTIFICATION_WORKERS,
+                       timeout=NOTIFICATION_TIMEOUT):
+    """Get seconds a batch of notifications may take to deliver, with a margin."""
+    return 2 * timeout * math.ceil(batch_size / workers)
+
+
+class NotificationQueue:
+    """Notifications stored in the outbox and delivered from it in the background.
+
+    Stored notifications survive restarts and outages of the notification
+    service, the outbox retries them with backoff and dead-letters the ones
+    failing repeatedly.
+    """
+
+    def __init__(self, outbox, sender, get_token, interval=NOTIFICATION_INTERVAL,
+                 batch_size=NOTIFICATION_BATCH_SIZE, digest_window=NOTIFICATION_DIGEST_WINDOW):
+        """Initialize the queue, notifications are delivered once it is started.
+
+        :param sender: NotificationSender posting the notifications
+        :param get_token: function getting the token of the notification service
+        :param digest_window: seconds the notifications of a repository are merged for
+        """
+        self.outbox = outbox
+        self.sender = sender
+        self.get_token = get_token
+        self.interval = interval
+        self.digest_window = digest_window
+        self.drainer = Drainer(outbox, self.deliver, interval=interval, batch_size=batch_size)
+
+    def start(self):
+        """Start delivering the notifications in the background."""
+        self.drainer.start()
+        return self
+
+    def put(self, notification):
+        """Store the notification and get it delivered.
+
+        Within the digest window, the notification is merged into the one of
+        the same repository that is waiting already.
+        """
+        repo_url = notification['data']['attributes']['id']
+        if self.digest_window <= 0:
+            self.outbox.put(repo_url, notification)
+            self.drainer.wake()
+            return
+        self.outbox.put(repo_url, notification, delay=self.digest_window,
+                        merge=UserNotification.merge_notifications)
+
+    def deliver(self, messages):
+        """Post the notifications concurrently and record the outcomes in the outbox."""
+        token = self.get_token()
+        futures = [(message, self.sender.submit(message.payload, token))
+                   for message in messages]
+        delivered = []
+        deferred = []
+        for message, future in futures:
+            if future is None:
+                deferred.append(message.id)
+                continue
+            try:
+                future.result().raise_for_status()
+            except requests.exceptions.RequestException as e:
+                self.outbox.failed([message.id], e)
+            else:
+                delivered.append(message.id)
+        self.outbox.delivered(delivered)
+        self.outbox.defer(deferred, self.interval)
+
 
 class UserNotification:
     """Generates report containing descriptive data for dependencies."""
 
     @staticmethod
-    def send_notification(notification, token):
+    def send_notification(notification, token, timeout=NOTIFICATION_TIMEOUT):
         """Send notification to the OSIO notification service."""
-        url = os.getenv('NOTIFICATION_SERVICE_HOST', '').strip()
-
-        endpoint = '{url}/api/notify'.format(url=url)
-        auth = 'Bearer {token}'.format(token=token)
-        resp = requests.post(endpoint, json=notification, headers={'Authorization': auth})
+        resp = requests.post(_notify_endpoint(), json=notification,
+                             headers=_auth_headers(token), timeout=timeout)
         if resp.status_code == 202:
             return {'status': 'success'}
         else:
             resp.raise_for_status()
 
+    @staticmethod
+    def merge_notifications(digest, notification):
+        """Merge the notification into the digest of the same repository.
+
+        Vulnerable dependencies are deduplicated, the later notification wins,
+        and the counts are computed again from the merged dependencies.
+        """
+        custom = digest["data"]["attributes"]["custom"]
+        new_custom = notification["data"]["attributes"]["custom"]
+        vulnerable_deps = OrderedDict()
+        for deps in chain(custom.get("direct_updates", []), custom.get("transitive_updates", []),
+                          new_custom.get("direct_updates", []),
+                          new_custom.get("transitive_updates", [])):
+            vulnerable_deps[(deps.get("ecosystem"), deps.get("name"), deps.get("version"))] = deps
+
+        merged = dict(custom, **new_custom)
+        merged["direct_updates"] = [deps for deps in vulnerable_deps.values()
+                                    if not deps.get("is_transitive", None)]
+        merged["transitive_updates"] = [deps for deps in vulnerable_deps.values()
+                                        if deps.get("is_transitive", None)]
+        merged["total_dependencies"] = len(vulnerable_deps)
+        merged["cve_count"] = sum(int(deps["cve_count"]) for deps in vulnerable_deps.values())
+        merged["merged_notifications"] = custom.get("merged_notifications", 1) + 1
+        metrics.increment('notifications.merged')
+
+        result = dict(notification)
+        result["data"] = dict(notification["data"])
+        result["data"]["attributes"] = dict(notification["data"]["attributes"], custom=merged)
+        return result
+
     @staticmethod
     def generate_notification(report):
         """Generate notification structure from the cve report."""
@@ -65,5 +246,5 @@ class UserNotification:
         result["data"]["attributes"]["custom"]["cve_count"] = total_cve_count
         result["data"]["attributes"]["custom"]["transitive_updates"] = transitive_updates
         result["data"]["attributes"]["custom"]["direct_updates"] = direct_updates
-        logger.error("Notification Payload %s", result)
+        log_payload(logger, logging.DEBUG, "Notification Payload %s", result)
         return result
@@ -0,0 +1,297 @@
+"""Durable outbox of messages delivered in the background with retries."""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from sqlalchemy import Column, Float, Index, Integer, MetaData, String, Table, Text, \
+    create_engine, func, or_, select, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# The outboxes are kept in the Postgres database shared by the replicas when
+# OUTBOX_BACKEND is 'postgres', otherwise in the SQLite database at OUTBOX_PATH
+# local to the pod, that is not shared by the replicas. The default path is in the
+# temporary directory, which is writable by the non-root user of the image.
+OUTBOX_BACKEND = os.environ.get("OUTBOX_BACKEND", "sqlite")
+OUTBOX_PATH = os.environ.get("OUTBOX_PATH",
+                             os.path.join(tempfile.gettempdir(), "gemini-outbox.sqlite"))
+
+Message = namedtuple('Message', ['id', 'destination', 'payload', 'attempts', 'created_at'])
+
+outbox_messages = Table(
+    'gemini_outbox', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('topic', String(64), nullable=False),
+    Column('destination', Text, nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('state', String(16), nullable=False, server_default='pending'),
+    Column('attempts', Integer, nullable=False, server_default='0'),
+    Column('created_at', Float, nullable=False),
+    Column('next_attempt_at', Float, nullable=False),
+    Column('claimed_until', Float),
+    Column('claim_token', String(32)),
+    Column('last_error', Text),
+    Index('gemini_outbox_due', 'topic', 'state', 'next_attempt_at'),
+    sqlite_autoincrement=True)
+
+
+class Outbox:
+    """Messages of one topic kept in a database until they are delivered.
+
+    Messages are claimed in batches for a lease period, so that several
+    processes sharing the database do not deliver the same message twice.
+    A failed delivery is retried with exponential backoff, messages failing
+    max_attempts times are dead-lettered and kept for inspection.
+    """
+
+    def __init__(self, database, topic, max_attempts=8, base_delay=5.0, max_delay=3600.0,
+                 lease=60.0, keep_delivered=24 * 3600.0):
+        """Initialize the outbox and create its table if it does not exist.
+
+        :param database: path of the SQLite database or SQLAlchemy engine of the database
+        """
+        if isinstance(database, str):
+            database = create_engine('sqlite:///' + database, connect_args={'timeout': 30})
+        self.engine = database
+        self.topic = topic
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.keep_delivered = keep_delivered
+        outbox_messages.create(bind=self.engine, checkfirst=True)
+
+    def put(self, destination, payload, delay=0, merge=None):
+        """Store the message, it is due after delay seconds.
+
+        :param destination: where the message is delivered to, e.g. URL
+        :param payload: JSON serializable content of the message
+        :param merge: function merging the payload into the payload of a message for the
+                      same destination that still waits for its first attempt; the payload
+                      is stored as a new message when there is no such message
+        :return: id of the message
+        """
+        now = time.time()
+        with self.engine.begin() as conn:
+            if merge is not None:
+                self._lock(conn, destination)
+                row = conn.execute(
+                    select([outbox_messages.c.id, outbox_messages.c.payload])
+                    .where(outbox_messages.c.topic == self.topic)
+                    .where(outbox_messages.c.destination == destination)
+                    .where(outbox_messages.c.state == 'pending')
+                    .where(outbox_messages.c.attempts == 0)
+                    .where(self._unclaimed(now))
+                    .order_by(outbox_messages.c.id).limit(1)).first()
+                if row is not None:
+                    conn.execute(outbox_messages.update()
+                                 .where(outbox_messages.c.id == row.id)
+                                 .values(payload=json.dumps(merge(json.loads(row.payload),
+                                                                  payload))))
+                    metrics.increment('outbox.{}.merged'.format(self.topic))
+                    return row.id
+            result = conn.execute(outbox_messages.insert().values(
+                topic=self.topic, destination=destination, payload=json.dumps(payload),
+                created_at=now, next_attempt_at=now + delay))
+        metrics.increment('outbox.{}.stored'.format(self.topic))
+        return result.inserted_primary_key[0]
+
+    def claim(self, limit, due=None):
+        """Claim at most limit messages that are due, oldest first.
+
+        :param due: claim messages due at this time, now by default
+        """
+        now = time.time()
+        token = uuid.uuid4().hex
+        # messages locked by other claimers are skipped instead of being claimed twice
+        due_ids = select([outbox_messages.c.id]) \
+            .where(outbox_messages.c.topic == self.topic) \
+            .where(outbox_messages.c.state == 'pending') \
+            .where(outbox_messages.c.next_attempt_at <= (now if due is None else due)) \
+            .where(self._unclaimed(now)) \
+            .order_by(outbox_messages.c.next_attempt_at).limit(limit) \
+            .with_for_update(skip_locked=True)
+        with self.engine.begin() as conn:
+            conn.execute(outbox_messages.update().where(outbox_messages.c.id.in_(due_ids))
+                         .values(claimed_until=now + self.lease, claim_token=token))
+            rows = conn.execute(
+                select([outbox_messages.c.id, outbox_messages.c.destination,
+                        outbox_messages.c.payload, outbox_messages.c.attempts,
+                        outbox_messages.c.created_at])
+                .where(outbox_messages.c.claim_token == token)
+                .order_by(outbox_messages.c.id)).fetchall()
+        return [Message(row[0], row[1], json.loads(row[2]), row[3], row[4]) for row in rows]
+
+    def delivered(self, ids):
+        """Mark the messages as delivered."""
+        self._update(ids, state='delivered', claimed_until=None)
+        metrics.increment('outbox.{}.delivered'.format(self.topic), len(ids))
+
+    def defer(self, ids, delay):
+        """Release the messages to be claimed again after delay seconds, not as an attempt."""
+        self._update(ids, claimed_until=None, next_attempt_at=time.time() + delay)
+
+    def failed(self, ids, error):
+        """Schedule next attempt of the messages with backoff, dead-letter them after the last."""
+        now = time.time()
+        with self.engine.begin() as conn:
+            for message_id in ids:
+                row = conn.execute(select([outbox_messages.c.attempts])
+                                   .where(outbox_messages.c.id == message_id)).first()
+                if row is None:
+                    continue
+                attempts = row[0] + 1
+                update = outbox_messages.update().where(outbox_messages.c.id == message_id)
+                if attempts >= self.max_attempts:
+                    conn.execute(update.values(state='dead', attempts=attempts,
+                                               claimed_until=None, last_error=str(error)))
+                    metrics.increment('outbox.{}.dead_lettered'.format(self.topic))
+                    logger.error('Message %d of %s dead-lettered after %d attempts: %s',
+                                 message_id, self.topic, attempts, error)
+                    continue
+                delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+                conn.execute(update.values(attempts=attempts, next_attempt_at=now + delay,
+                                           claimed_until=None, last_error=str(error)))
+        metrics.increment('outbox.{}.failed_attempts'.format(self.topic), len(ids))
+
+    def dead_letter(self, ids, error):
+        """Give up the delivery of the messages."""
+        self._update(ids, state='dead', claimed_until=None, last_error=str(error))
+        metrics.increment('outbox.{}.dead_lettered'.format(self.topic), len(ids))
+
+    def dead_letters(self, limit=100):
+        """Get the dead-lettered messages together with their last errors."""
+        with self.engine.connect() as conn:
+            rows = conn.execute(
+                select([outbox_messages.c.id, outbox_messages.c.destination,
+                        outbox_messages.c.payload, outbox_messages.c.attempts,
+                        outbox_messages.c.created_at, outbox_messages.c.last_error])
+                .where(outbox_messages.c.topic == self.topic)
+                .where(outbox_messages.c.state == 'dead')
+                .order_by(outbox_messages.c.id).limit(limit)).fetchall()
+        return [(Message(row[0], row[1], json.loads(row[2]), row[3], row[4]), row[5])
+                for row in rows]
+
+    def counts(self):
+        """Get number of the messages in each state."""
+        with self.engine.connect() as conn:
+            return dict(conn.execute(
+                select([outbox_messages.c.state, func.count()])
+                .where(outbox_messages.c.topic == self.topic)
+                .group_by(outbox_messages.c.state)).fetchall())
+
+    def purge(self):
+        """Delete the delivered messages older than keep_delivered seconds."""
+        with self.engine.begin() as conn:
+            conn.execute(outbox_messages.delete()
+                         .where(outbox_messages.c.topic == self.topic)
+                         .where(outbox_messages.c.state == 'delivered')
+                         .where(outbox_messages.c.created_at < time.time() - self.keep_delivered))
+
+    def _update(self, ids, **values):
+        if not ids:
+            return
+        with self.engine.begin() as conn:
+            conn.execute(outbox_messages.update().where(outbox_messages.c.id.in_(ids))
+                         .values(**values))
+
+    def _lock(self, conn, destination):
+        """Lock the messages of the destination until the end of the transaction."""
+        if conn.dialect.name == 'sqlite':
+            # the whole database is locked, the driver has not begun the transaction yet
+            conn.execute(text("BEGIN IMMEDIATE"))
+        else:  # pragma: no cover
+            conn.execute(select([func.pg_advisory_xact_lock(
+                func.hashtext('{} {}'.format(self.topic, destination)))]))
+
+    @staticmethod
+    def _unclaimed(now):
+        return or_(outbox_messages.c.claimed_until.is_(None),
+                   outbox_messages.c.claimed_until < now)
+
+
+class Drainer:
+    """Background thread handing the due messages of the outbox over in batches.
+
+    The handler gets the list of claimed messages and is expected to report
+    their outcome to the outbox; when it raises, all of them count as failed.
+    """
+
+    def __init__(self, outbox, handler, interval=5.0, batch_size=50):
+        """Initialize the drainer, it does not run until started."""
+        self.outbox = outbox
+        self.handler = handler
+        self.interval = interval
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start the drainer thread unless it is running already."""
+        with self._lock:
+            if self._thread is None:
+                self._stopped.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name='outbox-{}'.format(self.outbox.topic), daemon=True)
+                self._thread.start()
+        return self
+
+    def wake(self):
+        """Drain the outbox right away instead of after the interval."""
+        self._wake.set()
+
+    def stop(self):
+        """Stop the drainer thread."""
+        self._stopped.set()
+        self._wake.set()
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def drain(self):
+        """Hand all the due messages over to the handler, return their number.
+
+        Messages deferred or failed during the pass wait for the next one.
+        """
+        handled = 0
+        started = time.time()
+        while not self._stopped.is_set():
+            try:
+                messages = self.outbox.claim(self.batch_size, due=started)
+            except SQLAlchemyError as e:
+                logger.error('Outbox %s cannot be read: %r', self.outbox.topic, e)
+                break
+            if not messages:
+                break
+            try:
+                self.handler(messages)
+            except Exception as e:
+                logger.error('Delivery of %d messages of %s failed: %r',
+                             len(messages), self.outbox.topic, e)
+                self.outbox.failed([message.id for message in messages], e)
+            handled += len(messages)
+        return handled
+
+    def _run(self):
+        purged_at = 0
+        while not self._stopped.is_set():
+            self.drain()
+            if time.time() - purged_at > 3600:
+                try:
+                    self.outbox.purge()
+                except SQLAlchemyError as e:
+                    logger.error('Outbox %s cannot be purged: %r', self.outbox.topic, e)
+                purged_at = time.time()
+            self._wake.wait(self.interval)
+            self._wake.clear()
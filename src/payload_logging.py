@@ -0,0 +1,78 @@
+"""Sampled and size capped logging of large payloads, e.g. reports and notifications."""
+import json
+import os
+import random
+
+# Payloads are logged with probability PAYLOAD_LOG_SAMPLE_RATE and cut after
+# PAYLOAD_LOG_MAX_SIZE characters. PAYLOAD_LOG_MODULES overrides both per logger as
+# comma separated name=rate:size items, e.g. "utils=0.1:1024,notification=0:0"; the
+# item of the longest matching logger name prefix applies.
+PAYLOAD_LOG_SAMPLE_RATE = float(os.environ.get("PAYLOAD_LOG_SAMPLE_RATE", "0.01"))
+PAYLOAD_LOG_MAX_SIZE = int(os.environ.get("PAYLOAD_LOG_MAX_SIZE", "2048"))
+
+
+def parse_module_config(config):
+    """Parse the per logger settings, {logger name: (sample rate, max size)}."""
+    modules = {}
+    for item in config.split(','):
+        if not item.strip():
+            continue
+        name, _, settings = item.partition('=')
+        rate, _, size = settings.partition(':')
+        modules[name.strip()] = (float(rate) if rate.strip() else PAYLOAD_LOG_SAMPLE_RATE,
+                                 int(size) if size.strip() else PAYLOAD_LOG_MAX_SIZE)
+    return modules
+
+
+PAYLOAD_LOG_MODULES = parse_module_config(os.environ.get("PAYLOAD_LOG_MODULES", ""))
+
+
+def payload_settings(logger_name):
+    """Get sample rate and max size of the payloads logged by the logger."""
+    match = None
+    for name in PAYLOAD_LOG_MODULES:
+        if (logger_name == name or logger_name.startswith(name + '.')) and \
+                (match is None or len(name) > len(match)):
+            match = name
+    if match is None:
+        return PAYLOAD_LOG_SAMPLE_RATE, PAYLOAD_LOG_MAX_SIZE
+    return PAYLOAD_LOG_MODULES[match]
+
+
+class CappedPayload:
+    """Payload serialized only when the log record is formatted, at most max_size characters.
+
+    The serialization stops as soon as the size is reached, so huge payloads
+    cost no more than the part that is logged.
+    """
+
+    def __init__(self, payload, max_size):
+        """Initialize the wrapper."""
+        self.payload = payload
+        self.max_size = max_size
+
+    def __str__(self):
+        """Serialize the payload as JSON, cut after max_size characters."""
+        parts = []
+        size = 0
+        encoder = json.JSONEncoder(default=repr)
+        for chunk in encoder.iterencode(self.payload):
+            parts.append(chunk)
+            size += len(chunk)
+            if size > self.max_size:
+                return '{}... ({} characters shown)'.format(
+                    ''.join(parts)[:self.max_size], self.max_size)
+        return ''.join(parts)
+
+
+def log_payload(logger, level, msg, payload):
+    """Log the message with the payload, sampled and size capped as configured for the logger.
+
+    :param msg: message with a single %s placeholder for the payload
+    """
+    if not logger.isEnabledFor(level):
+        return
+    rate, max_size = payload_settings(logger.name)
+    if rate <= 0 or max_size <= 0 or (rate < 1 and random.random() >= rate):
+        return
+    logger.log(level, msg, CappedPayload(payload, max_size))
@@ -2,7 +2,8 @@
 
 import requests
 
-from utils import GREMLIN_SERVER_URL_REST, fix_gremlin_output
+from graph import GREMLIN_SERVER_URL_REST
+from utils import fix_gremlin_output
 
 
 class RepoDependencyCreator:
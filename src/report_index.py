@@ -0,0 +1,148 @@
+"""Compact time series index of the daily stacks report summaries."""
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+logger = logging.getLogger(__name__)
+
+
+class StacksSummaryIndex:
+    """Time series of selected stacks_summary fields of the daily stacks reports.
+
+    Comparisons and trends read this single small object instead of downloading
+    the whole daily reports. The index is filled in incrementally: dates that are
+    requested but not indexed yet are read from their daily reports once and the
+    index is written back, either to S3 next to the reports or to a local file.
+    """
+
+    # reports of the most recent days may still be generated, their absence is
+    # not recorded in the index
+    SETTLE_DAYS = 2
+
+    def __init__(self, s3_helper, fetch_reports, deployment_prefix, fields, ttl=300,
+                 path=None):
+        """Initialize the index.
+
+        :param s3_helper: S3Helper used to read and write the index object
+        :param fetch_reports: function yielding (report name, report) of the given names,
+                              report is None only if it does not exist and reports that
+                              cannot be fetched are left out to be fetched again later
+        :param deployment_prefix: prefix of the daily reports
+        :param fields: names of the stacks_summary fields kept in the index
+        :param ttl: seconds after which the index is read again from its storage
+        :param path: local file keeping the index instead of S3
+        """
+        self.s3_helper = s3_helper
+        self.fetch_reports = fetch_reports
+        self.deployment_prefix = deployment_prefix
+        self.fields = list(fields)
+        self.ttl = ttl
+        self.path = path
+        self.object_name = '{dp}/index/stacks-summary.json'.format(dp=deployment_prefix)
+        self._lock = threading.Lock()
+        self._dates = None
+        self._loaded_at = None
+
+    def report_name(self, date):
+        """Get name of the daily report of the date."""
+        return '{dp}/daily/{date}.json'.format(dp=self.deployment_prefix, date=date)
+
+    def get_range(self, dates, fields=None):
+        """Get the summary fields of the daily reports.
+
+        :param dates: list of dates (YYYY-MM-DD)
+        :param fields: names of the fields, all indexed fields by default
+        :return: dict mapping the date to its fields, None if there is no report
+        """
+        fields = fields or self.fields
+        not_indexed = [field for field in fields if field not in self.fields]
+        if not_indexed:
+            raise ValueError('Fields {} are not indexed'.format(', '.join(not_indexed)))
+
+        indexed = self._load()
+        missing = [date for date in dates if date not in indexed]
+        if missing:
+            indexed = self._update(missing)
+
+        result = {}
+        for date in dates:
+            values = indexed.get(date)
+            result[date] = {field: values.get(field) for field in fields} \
+                if values is not None else None
+        return result
+
+    def clear(self):
+        """Forget the index loaded in memory."""
+        with self._lock:
+            self._dates = None
+            self._loaded_at = None
+
+    def _load(self):
+        """Get the index, read it again from its storage once it is older than ttl."""
+        with self._lock:
+            if self._dates is not None and time.time() - self._loaded_at < self.ttl:
+                return dict(self._dates)
+
+        stored = self._read()
+        with self._lock:
+            self._dates = dict(stored, **(self._dates or {}))
+            self._loaded_at = time.time()
+            return dict(self._dates)
+
+    def _update(self, dates):
+        """Index the summaries of the daily reports of the dates."""
+        names = {self.report_name(date): date for date in dates}
+        settled = (datetime.date.today() - datetime.timedelta(days=self.SETTLE_DAYS)) \
+            .strftime('%Y-%m-%d')
+        new = {}
+        for name, report in self.fetch_reports(names):
+            date = names[name]
+            if report is not None:
+                summary = report.get('stacks_summary', {})
+                new[date] = {field: summary.get(field) for field in self.fields}
+            elif date <= settled:
+                new[date] = None
+
+        with self._lock:
+            self._dates = dict(self._dates or {}, **new)
+            dates = dict(self._dates)
+        if new:
+            self._write(dates)
+        return dates
+
+    def _read(self):
+        """Read the index from its storage, empty index if there is none yet."""
+        try:
+            if self.path:
+                with open(self.path) as f:
+                    document = json.load(f)
+            else:
+                document = self.s3_helper.get_object_content(self.object_name, use_cache=False)
+        except (IOError, ValueError, ClientError, BotoCoreError) as e:
+            logger.info('Stacks summary index cannot be read, starting a new one: %r', e)
+            return {}
+
+        if not isinstance(document, dict) or document.get('fields') != self.fields or \
+                not isinstance(document.get('dates'), dict):
+            # index of other fields gets rebuilt
+            return {}
+        return document['dates']
+
+    def _write(self, dates):
+        """Write the index to its storage."""
+        document = {'fields': self.fields, 'dates': dates}
+        try:
+            if self.path:
+                tmp_path = '{path}.{pid}.tmp'.format(path=self.path, pid=os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(document, f)
+                os.rename(tmp_path, self.path)
+            else:
+                self.s3_helper.put_object_content(self.object_name, document)
+        except (IOError, OSError, ClientError, BotoCoreError) as e:
+            logger.error('Stacks summary index cannot be stored: %r', e)
@@ -0,0 +1,131 @@
+"""Watcher of the scan reports that clients are waiting for."""
+import itertools
+import logging
+import threading
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ReportWatcher:
+    """Notify the subscribers once the worker result of their commit appears.
+
+    A single background thread checks the results of all commits that are
+    waited for with one query per interval, no matter how many clients wait.
+    The thread runs only as long as there are subscribers. The result of a
+    new subscriber is checked right away, so existing results are not
+    delayed by the interval.
+    """
+
+    def __init__(self, fetch_results, worker, interval=2.0, release=None):
+        """Initialize the watcher.
+
+        :param fetch_results: function getting dict of the latest results of the given
+                              external request ids (commit hashes) and worker
+        :param worker: name of the worker whose results are watched
+        :param interval: seconds between the checks
+        :param release: function called after every check, e.g. ending the database session
+        """
+        self.fetch_results = fetch_results
+        self.release = release
+        self.worker = worker
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._tokens = itertools.count()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def subscribe(self, sha, callback):
+        """Call the callback with the result of the commit once it appears.
+
+        The callback is called from the watcher thread, or right away from the
+        calling one when the result exists already, and must not block.
+
+        :return: token to unsubscribe with
+        """
+        token = next(self._tokens)
+        with self._lock:
+            self._subscribers.setdefault(sha, {})[token] = callback
+            metrics.set_gauge('report_watcher.waiting', len(self._subscribers))
+        self._check([sha])
+        with self._lock:
+            if self._thread is None and self._subscribers:
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, name='report-watcher',
+                                                daemon=True)
+                self._thread.start()
+        return token
+
+    def waiting(self):
+        """Get number of the subscribers waiting for results."""
+        with self._lock:
+            return sum(len(callbacks) for callbacks in self._subscribers.values())
+
+    def unsubscribe(self, sha, token):
+        """Stop waiting for the result of the commit."""
+        with self._lock:
+            callbacks = self._subscribers.get(sha, {})
+            callbacks.pop(token, None)
+            if not callbacks:
+                self._subscribers.pop(sha, None)
+            metrics.set_gauge('report_watcher.waiting', len(self._subscribers))
+
+    def wait(self, sha, timeout):
+        """Wait for the result of the commit.
+
+        :return: the result, None if it has not appeared within timeout seconds
+        """
+        done = threading.Event()
+        found = []
+
+        def notify(result):
+            found.append(result)
+            done.set()
+
+        token = self.subscribe(sha, notify)
+        try:
+            done.wait(timeout)
+        finally:
+            self.unsubscribe(sha, token)
+        return found[0] if found else None
+
+    def stop(self):
+        """Stop the watcher thread, e.g. in tests."""
+        self._stopped.set()
+
+    def _run(self):
+        """Check the results until there is nobody waiting for them."""
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                shas = list(self._subscribers)
+                if not shas:
+                    self._thread = None
+                    return
+            self._check(shas)
+        with self._lock:
+            self._thread = None
+
+    def _check(self, shas):
+        """Check the results of the commits and notify their subscribers."""
+        metrics.increment('report_watcher.queries')
+        try:
+            results = self.fetch_results(shas, self.worker)
+        except Exception as e:
+            logger.error('Results of %d waited for commits cannot be checked: %r', len(shas), e)
+            return
+        finally:
+            if self.release is not None:
+                self.release()
+
+        for sha, result in results.items():
+            with self._lock:
+                callbacks = list(self._subscribers.pop(sha, {}).values())
+            for callback in callbacks:
+                try:
+                    callback(result)
+                except Exception as e:
+                    logger.error('Subscriber of %s failed: %r', sha, e)
+        with self._lock:
+            metrics.set_gauge('report_watcher.waiting', len(self._subscribers))
@@ -1,19 +1,39 @@
 """Definition of the routes for gemini server."""
 import flask
+import json
 import os
 import requests
+import threading
+import time
+import uuid
 from botocore.exceptions import ClientError
 from flask import Flask, request
 from flask_cors import CORS
-from utils import DatabaseIngestion, scan_repo, validate_request_data, \
-    retrieve_worker_result, alert_user, GREMLIN_SERVER_URL_REST, _s3_helper, \
-    generate_comparison, GraphPassThrough, PostgresPassThrough
-from f8a_worker.setup_celery import init_selinon
+from itertools import chain
+from utils import DatabaseIngestion, validate_request_data, alert_user, \
+    generate_comparison, MAX_BATCH_REGISTER_SIZE, MAX_BATCH_REPORT_SIZE, COMPARISON_MAX_DAYS, \
+    generate_trend, aggregate_reports, _report_watcher, REPORT_WAIT_MAX_SECONDS, \
+    REPORT_WAIT_MAX_WAITERS
+from database import PostgresPassThrough, retrieve_worker_result, retrieve_worker_results, \
+    remove_sessions, get_session, _rdb
+from graph import GraphPassThrough, GREMLIN_SERVER_URL_REST
+from s3_helper import _s3_helper
+from scans import scan_repo, scan_repos, _selinon, _celery, _scan_store, \
+    get_scan_dispatcher_id, get_flow_status, FLOW_STATUS_RESULT_BACKEND, \
+    FLOW_STATUS_CACHE_TTL, FLOW_FINAL_STATUSES
 from fabric8a_auth.auth import login_required, init_service_account_token
 from data_extractor import DataExtractor
+from metrics import metrics
+from singleflight import coalesce
+from lazy import Lazy, warm_up
+from outbox import Outbox, OUTBOX_BACKEND, OUTBOX_PATH
+from webhooks import WebhookNotifier
+from compression import compress_response, choose_encoding, is_gzip, \
+    STREAM_UPSTREAM_RESPONSES
 from exceptions import HTTPError
 from repo_dependency_creator import RepoDependencyCreator
-from notification.user_notification import UserNotification
+from notification.user_notification import UserNotification, NotificationSender, \
+    NotificationQueue, NOTIFICATION_WORKERS, notification_lease
 from fabric8a_auth.errors import AuthError
 import sentry_sdk
 from requests_futures.sessions import FuturesSession
@@ -27,19 +47,74 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 sentry_sdk.init(os.environ.get("SENTRY_DSN"))
 
-init_selinon()
-_session = FuturesSession(max_workers=3)
+_session = Lazy('futures_session', FuturesSession, max_workers=NOTIFICATION_WORKERS)
+
+
+def _create_notification_sender():
+    """Create sender of the notifications sharing the futures session."""
+    return NotificationSender(_session.instance())
+
+
+_notification_sender = Lazy('notification_sender', _create_notification_sender)
 
 gpt = GraphPassThrough()
 ppt = PostgresPassThrough()
 
 
-SERVICE_TOKEN = 'token'
-try:
-    SERVICE_TOKEN = init_service_account_token(app)
-except requests.exceptions.RequestException as e:
-    print('Unable to set authentication token for internal service calls. {}'
-          .format(e))
+_service_token = Lazy('service_token', init_service_account_token, app)
+
+
+def get_service_token():
+    """Get the authentication token for internal service calls, fetched on first use."""
+    try:
+        return _service_token.instance()
+    except requests.exceptions.RequestException as e:
+        logger.error('Unable to set authentication token for internal service calls. %s', e)
+        return 'token'
+
+
+def _outbox_database():
+    """Get the database keeping the outboxes of the configured backend."""
+    if OUTBOX_BACKEND == 'postgres':
+        return get_session().get_bind()
+    return OUTBOX_PATH
+
+
+def _start_webhooks():
+    """Start delivering the report callbacks stored in the outbox."""
+    return WebhookNotifier(Outbox(_outbox_database(), 'webhooks'), retrieve_worker_results,
+                           release=remove_sessions).start()
+
+
+_webhooks = Lazy('webhooks', _start_webhooks)
+
+
+def _start_notifications():
+    """Start delivering the notifications stored in the outbox."""
+    outbox = Outbox(_outbox_database(), 'notifications', lease=notification_lease())
+    return NotificationQueue(outbox, _notification_sender.instance(), get_service_token).start()
+
+
+_notifications = Lazy('notifications', _start_notifications)
+
+
+# Backend clients are created on first use, BACKEND_WARM_UP creates them in the
+# background right after the start instead
+if os.environ.get('BACKEND_WARM_UP', 'true').lower() in ('1', 'true'):
+    warm_up(_s3_helper, _rdb, _selinon, _celery, _scan_store, _session, _service_token,
+            _webhooks, _notifications)
+
+
+@app.after_request
+def compress(response):
+    """Compress the response if the client accepts it."""
+    return compress_response(response, request.accept_encodings)
+
+
+@app.teardown_appcontext
+def end_db_sessions(_exception=None):
+    """Return the database connections used by the request to the pool."""
+    remove_sessions()
 
 
 @app.route('/api/v1/readiness')
@@ -54,6 +129,22 @@ def liveness():
     return flask.jsonify({}), 200
 
 
+@app.route('/api/v1/metrics')
+def get_metrics():
+    """Endpoint exposing the metrics collected by this worker process."""
+    return flask.jsonify(metrics.snapshot()), 200
+
+
+def _register_callback(entry):
+    """Store the callback of the registration, if it asks for one."""
+    if not entry.get('callback-url'):
+        return
+    try:
+        _webhooks.register(entry['callback-url'], entry['git-url'], entry['git-sha'])
+    except Exception as e:
+        logger.error('Callback of %s cannot be stored: %r', entry['git-url'], e)
+
+
 @app.route('/api/v1/register', methods=['POST'])
 @login_required
 def register():
@@ -61,7 +152,9 @@ def register():
     Endpoint for registering a new repository.
 
     Registers new information and
-    updates existing repo information.
+    updates existing repo information. The scan is skipped when the report
+    for the given commit-hash already exists, unless force is set. The summary
+    of the report is posted to callback-url once the report is available.
     """
     resp_dict = {
         "success": True,
@@ -79,10 +172,35 @@ def register():
         resp_dict["summary"] = validated_data[1]
         return flask.jsonify(resp_dict), 404
 
+    last_scan_report = None
     try:
         repo_info = DatabaseIngestion.get_info(input_json.get('git-url'))
         if repo_info.get('is_valid'):
             data = repo_info.get('data')
+            if data.get('git_sha') == input_json.get('git-sha'):
+                result = retrieve_worker_result(input_json.get('git-sha'),
+                                                "ReportGenerationTask")
+                task_result = result.get('task_result') if result else None
+                if task_result:
+                    last_scan_report = {
+                        "git_sha": input_json.get('git-sha'),
+                        "scanned_at": task_result.get('scanned_at'),
+                        "lock_file_absent": task_result.get('lock_file_absent', False)
+                    }
+                if last_scan_report and not input_json.get('force'):
+                    # Nothing changed since the last scan, do not run the flow again
+                    # as long as the report is already available.
+                    metrics.increment('register.rescan_skipped')
+                    summary = "Repository {} with commit-hash {} has already been " \
+                              "scanned. Set force to scan it again." \
+                        .format(input_json.get('git-url'), input_json.get('git-sha'))
+                    resp_dict.update({
+                        "summary": summary,
+                        "last_scanned_at": data['last_scanned_at'],
+                        "last_scan_report": last_scan_report
+                    })
+                    _register_callback(input_json)
+                    return flask.jsonify(resp_dict), 200
             # Update the record to reflect new git_sha if any.
             DatabaseIngestion.update_data(input_json)
         else:
@@ -100,6 +218,8 @@ def register():
                                        "Please check back for report after some time." \
                     .format(input_json.get('git-url'),
                             input_json.get('git-sha'))
+                resp_dict["dispatcher_id"] = get_scan_dispatcher_id(input_json)
+                _register_callback(input_json)
 
                 return flask.jsonify(resp_dict), 200
             except Exception as e:
@@ -114,32 +234,159 @@ def register():
             .format(input_json.get('git-url'), e)
         return flask.jsonify(resp_dict), 500
 
-    # Scan the repository irrespective of report is available or not.
+    # Scan the repository as the report is either outdated, not available or a
+    # new scan is forced.
+    metrics.increment('register.rescan_dispatched')
     status = scan_repo(input_json)
     if status is not True:
         resp_dict["success"] = False
         resp_dict["summary"] = "New Repo Scan Initialization Failure"
         return flask.jsonify(resp_dict), 500
 
+    if last_scan_report:
+        summary = "Repository {} with commit-hash {} is being scanned again as " \
+                  "requested. Please check back later for the new report."
+    else:
+        summary = "Repository {} was already registered, but no report for " \
+                  "commit-hash {} was found. Please check back later."
     resp_dict.update({
-        "summary": "Repository {} was already registered, but no report for "
-                   "commit-hash {} was found. Please check back later."
-                   .format(input_json.get('git-url'), input_json.get('git-sha')),
+        "summary": summary.format(input_json.get('git-url'), input_json.get('git-sha')),
         "last_scanned_at": data['last_scanned_at'],
-        "last_scan_report": None
+        "last_scan_report": last_scan_report,
+        "dispatcher_id": get_scan_dispatcher_id(input_json)
     })
+    _register_callback(input_json)
 
     return flask.jsonify(resp_dict), 200
 
 
-@app.route('/api/v1/report')
+@app.route('/api/v1/flow/<dispatcher_id>/status')
 @login_required
-def report():
-    """Endpoint for fetching generated scan report."""
-    repo = request.args.get('git-url')
-    sha = request.args.get('git-sha')
+def flow_status(dispatcher_id):
+    """
+    Endpoint to check whether the flow is queued, running, finished or failed.
+
+    The dispatcher id is returned by the register endpoint. Clients should wait
+    the number of seconds given by Retry-After before they ask again. Dispatcher
+    ids that are not Celery task ids are not found, other unknown ids cannot be
+    told from queued flows and are reported as queued.
+    """
+    if not FLOW_STATUS_RESULT_BACKEND:
+        return flask.jsonify(error='Flow status is not available'), 501
+    try:
+        uuid.UUID(dispatcher_id)
+    except ValueError:
+        return flask.jsonify(error='Flow {} not found'.format(dispatcher_id)), 404
+
+    try:
+        status = coalesce('flow-status', dispatcher_id, get_flow_status, dispatcher_id)
+    except Exception as e:
+        logger.error('Status of flow %s cannot be retrieved: %r', dispatcher_id, e)
+        return flask.jsonify(error='Flow status cannot be retrieved'), 500
+
+    response = flask.jsonify(dispatcher_id=dispatcher_id, status=status)
+    if status not in FLOW_FINAL_STATUSES:
+        response.headers['Retry-After'] = str(FLOW_STATUS_CACHE_TTL)
+    return response
+
+
+def _batch_entry_status(entry, status, summary=""):
+    """Describe the outcome of a single entry of a batch request."""
+    return {
+        "git-url": entry.get('git-url') if isinstance(entry, dict) else None,
+        "git-sha": entry.get('git-sha') if isinstance(entry, dict) else None,
+        "status": status,
+        "summary": summary
+    }
+
+
+@app.route('/api/v1/register/batch', methods=['POST'])
+@login_required
+def register_batch():
+    """
+    Endpoint for registering many repositories at once.
+
+    Registers new and updates existing repositories with a single statement,
+    dispatches the scans in batches and reports the status of every entry.
+    """
+    resp_dict = {
+        "success": True,
+        "summary": "",
+        "results": []
+    }
+    if request.content_type != 'application/json':
+        resp_dict["success"] = False
+        resp_dict["summary"] = "Set content type to application/json"
+        return flask.jsonify(resp_dict), 400
+
+    input_json = request.get_json()
+    entries = input_json.get('repositories') if isinstance(input_json, dict) else None
+    if not isinstance(entries, list) or not entries:
+        resp_dict["success"] = False
+        resp_dict["summary"] = "repositories cannot be empty"
+        return flask.jsonify(resp_dict), 400
+
+    if len(entries) > MAX_BATCH_REGISTER_SIZE:
+        resp_dict["success"] = False
+        resp_dict["summary"] = "At most {} repositories can be registered at once" \
+            .format(MAX_BATCH_REGISTER_SIZE)
+        return flask.jsonify(resp_dict), 400
+
+    results = [None] * len(entries)
+    # the last entry wins when the same repository is sent more than once
+    accepted = {}
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            results[index] = _batch_entry_status(entry, "invalid", "Entry must be an object")
+            continue
+        validated_data = validate_request_data(entry)
+        if not validated_data[0]:
+            results[index] = _batch_entry_status(entry, "invalid", validated_data[1])
+            continue
+        previous = accepted.get(entry['git-url'])
+        if previous is not None:
+            results[previous] = _batch_entry_status(
+                entries[previous], "duplicate",
+                "Superseded by a later entry for the same repository")
+        accepted[entry['git-url']] = index
+
+    indexes = sorted(accepted.values())
+    to_register = [entries[index] for index in indexes]
+    try:
+        DatabaseIngestion.bulk_upsert(to_register)
+    except Exception as e:
+        for index in indexes:
+            results[index] = _batch_entry_status(
+                entries[index], "failed", "Database Ingestion Failure due to: {}".format(e))
+        resp_dict["success"] = False
+        resp_dict["summary"] = "Database Ingestion Failure due to: {}".format(e)
+        resp_dict["results"] = results
+        return flask.jsonify(resp_dict), 500
+
+    errors = scan_repos(to_register)
+    for index, error in zip(indexes, errors):
+        if error is None:
+            _register_callback(entries[index])
+            results[index] = _batch_entry_status(
+                entries[index], "registered",
+                "Please check back for report after some time.")
+        else:
+            results[index] = _batch_entry_status(
+                entries[index], "failed", "Repo Scan Initialization Failure: {}".format(error))
+
+    registered = sum(1 for result in results if result["status"] == "registered")
+    resp_dict.update({
+        "success": registered == len(entries),
+        "summary": "{} of {} repositories have been successfully registered."
+                   .format(registered, len(entries)),
+        "results": results
+    })
+    return flask.jsonify(resp_dict), 200
+
+
+def _report_response(repo, sha, result):
+    """Build the scan report response out of the ReportGenerationTask result."""
     response = dict()
-    result = retrieve_worker_result(sha, "ReportGenerationTask")
     if result:
         task_result = result.get('task_result')
         if task_result:
@@ -155,21 +402,145 @@ def report():
                     "lock_file_absent": task_result.get("lock_file_absent"),
                     "message": task_result.get("message")
                 })
-                return flask.jsonify(response), 400
+                return response, 400
 
-            return flask.jsonify(response), 200
+            return response, 200
         else:
             response.update({
                 "status": "failure",
                 "message": "Failed to retrieve scan report"
             })
-            return flask.jsonify(response), 500
+            return response, 500
     else:
         response.update({
             "status": "failure",
             "message": "No report found for this repository"
         })
-        return flask.jsonify(response), 404
+        return response, 404
+
+
+@app.route('/api/v1/report')
+@login_required
+def report():
+    """Endpoint for fetching generated scan report."""
+    repo = request.args.get('git-url')
+    sha = request.args.get('git-sha')
+    result = coalesce('report', sha, retrieve_worker_result, sha, "ReportGenerationTask")
+    response, status_code = _report_response(repo, sha, result)
+    return flask.jsonify(response), status_code
+
+
+def _report_wait_events(repo, sha, timeout):
+    """Generate server-sent events until the report appears or the timeout passes."""
+    ready = threading.Event()
+    found = []
+
+    def notify(result):
+        found.append(result)
+        ready.set()
+
+    token = _report_watcher.subscribe(sha, notify)
+    deadline = time.time() + timeout
+    try:
+        while not ready.wait(min(_report_watcher.interval, max(deadline - time.time(), 0))):
+            if time.time() >= deadline:
+                yield 'event: timeout\ndata: {}\n\n'
+                return
+            yield ': waiting\n\n'
+    finally:
+        _report_watcher.unsubscribe(sha, token)
+    response, status_code = _report_response(repo, sha, found[0])
+    yield 'event: report\ndata: {}\n\n'.format(
+        flask.json.dumps({"status": REPORT_STATUSES[status_code], "report": response}))
+
+
+@app.route('/api/v1/report/wait')
+@login_required
+def report_wait():
+    """
+    Endpoint for waiting until the scan report is generated.
+
+    The request is held until the report appears or timeout seconds pass, then
+    it is answered the same way as /api/v1/report. Clients accepting
+    text/event-stream get server-sent events instead. Clients over
+    REPORT_WAIT_MAX_WAITERS are asked to retry later, so the waiting ones do
+    not take all the worker threads.
+    """
+    repo = request.args.get('git-url')
+    sha = request.args.get('git-sha')
+    if not sha:
+        return flask.jsonify(error='git-sha is required'), 400
+    try:
+        timeout = min(float(request.args.get('timeout', REPORT_WAIT_MAX_SECONDS)),
+                      REPORT_WAIT_MAX_SECONDS)
+    except ValueError:
+        return flask.jsonify(error='timeout must be a number'), 400
+    if _report_watcher.waiting() >= REPORT_WAIT_MAX_WAITERS:
+        metrics.increment('report_wait.rejected')
+        return flask.jsonify(error='Too many clients are waiting for reports'), 503, \
+            {'Retry-After': str(max(1, int(_report_watcher.interval)))}
+
+    if request.accept_mimetypes.best == 'text/event-stream':
+        return flask.Response(_report_wait_events(repo, sha, timeout),
+                              mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache'})
+
+    result = _report_watcher.wait(sha, timeout)
+    response, status_code = _report_response(repo, sha, result)
+    return flask.jsonify(response), status_code
+
+
+REPORT_STATUSES = {
+    200: "available",
+    400: "lock_file_absent",
+    404: "not_found",
+    500: "failure"
+}
+
+
+@app.route('/api/v1/report/batch', methods=['POST'])
+@login_required
+def report_batch():
+    """
+    Endpoint for fetching generated scan reports of many repositories.
+
+    All reports are resolved with a single query and the response is streamed
+    as a map of git-sha to the report status and the report itself.
+    """
+    input_json = request.get_json(silent=True)
+    entries = input_json.get('repositories') if isinstance(input_json, dict) else None
+    if not isinstance(entries, list) or not entries or \
+            not all(isinstance(entry, dict) and entry.get('git-sha') for entry in entries):
+        return flask.jsonify(error="repositories with git-sha cannot be empty"), 400
+
+    if len(entries) > MAX_BATCH_REPORT_SIZE:
+        return flask.jsonify(error="At most {} reports can be retrieved at once"
+                             .format(MAX_BATCH_REPORT_SIZE)), 400
+
+    results = retrieve_worker_results([entry['git-sha'] for entry in entries],
+                                      "ReportGenerationTask")
+
+    def generate():
+        yield '{"reports": {'
+        seen = set()
+        for entry in entries:
+            sha = entry['git-sha']
+            if sha in seen:
+                continue
+            response, status_code = _report_response(entry.get('git-url'), sha,
+                                                     results.get(sha))
+            yield '{sep}{sha}: {report}'.format(
+                sep=', ' if seen else '',
+                sha=flask.json.dumps(sha),
+                report=flask.json.dumps({
+                    "status": REPORT_STATUSES[status_code],
+                    "report": response
+                }))
+            seen.add(sha)
+        yield '}}'
+
+    return flask.Response(flask.stream_with_context(generate()),
+                          mimetype='application/json')
 
 
 @app.route('/api/v1/user-repo/scan', methods=['POST'])
@@ -224,10 +595,10 @@ def user_repo_scan():
         # re-used for '/notify' call as well.
         repo_reports = RepoDependencyCreator.generate_report(repo_cves=repo_cves,
                                                              deps_list=dependencies)
+        # the notifications are stored and delivered in the background
         for repo_report in repo_reports:
             notification = UserNotification.generate_notification(report=repo_report)
-            UserNotification.send_notification(notification=notification,
-                                               token=SERVICE_TOKEN)
+            _notifications.put(notification)
     except Exception as ex:
         return flask.jsonify({
             "error": ex.__str__()
@@ -273,7 +644,7 @@ def user_repo_scan_experimental():  # pragma: no cover
     input_json['git-url'] = url
 
     # Call the worker flow to run a user repository scan asynchronously
-    status = alert_user(input_json, SERVICE_TOKEN)
+    status = alert_user(input_json, get_service_token())
     if status is not True:
         resp_dict["status"] = "failure"
         resp_dict["summary"] = "Scan initialization failure"
@@ -315,7 +686,7 @@ def notify_user():
         return flask.jsonify(resp_dict), 400
 
     # Call the worker flow to run a user repository scan asynchronously
-    status = alert_user(input_json, SERVICE_TOKEN, epv_list=input_json['epv_list'])
+    status = alert_user(input_json, get_service_token(), epv_list=input_json['epv_list'])
     if status is not True:
         resp_dict["status"] = "failure"
         resp_dict["summary"] = "Scan initialization failure"
@@ -373,12 +744,32 @@ def drop():  # pragma: no cover
     return flask.jsonify(resp_dict), 200
 
 
+def _cache_bypassed():
+    """Check whether the client asked for a fresh response via Cache-Control header."""
+    cache_control = request.headers.get('Cache-Control', '').lower()
+    return 'no-cache' in cache_control or 'no-store' in cache_control
+
+
 @app.route('/api/v1/graph', methods=['POST'])
 @login_required
 def graph():
     """Endpoint to get graph node properties."""
     input_json = request.get_json()
-    response = gpt.fetch_nodes(input_json)
+    use_cache = not _cache_bypassed()
+    # results of the unbounded traversals are limited, they are decoded to mark the truncation
+    if STREAM_UPSTREAM_RESPONSES and input_json and input_json.get('query') and \
+            not input_json.get('page_size') and not input_json.get('cursor') and \
+            not gpt.limits_results(input_json['query']):
+        try:
+            return flask.Response(gpt.stream_nodes(input_json, use_cache=use_cache),
+                                  mimetype='application/json')
+        except ValueError as e:
+            return flask.jsonify({'error': str(e)})
+        except requests.exceptions.RequestException as e:
+            return flask.jsonify({'error': str(e)}), 502
+
+    response = coalesce('graph', json.dumps([input_json, use_cache], sort_keys=True),
+                        gpt.fetch_nodes, input_json, use_cache=use_cache)
 
     return flask.jsonify(response)
 
@@ -399,14 +790,51 @@ def pgsql():
     return flask.jsonify(response)
 
 
+def _s3_report_response(report):
+    """Stream the report JSON bytes from S3 as they are.
+
+    Reports stored gzip compressed are sent still compressed to clients accepting gzip.
+    """
+    if choose_encoding(request.accept_encodings) != 'gzip':
+        return flask.Response(_s3_helper.get_object_stream(report), mimetype='application/json')
+
+    chunks = _s3_helper.get_object_stream(report, decompress=False)
+    first = next(chunks, b'')
+    response = flask.Response(chain([first], chunks), mimetype='application/json')
+    if is_gzip(first):
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def _list_s3_reports(prefix):
+    """List the reports under the prefix, narrowed down by the request arguments."""
+    limit = request.args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            return flask.jsonify(error='limit must be a positive number'), 400
+
+    return flask.jsonify(_s3_helper.list_objects(prefix,
+                                                 from_date=request.args.get('from'),
+                                                 to_date=request.args.get('to'),
+                                                 limit=limit,
+                                                 continuation=request.args.get('continuation')))
+
+
 @app.route('/api/v1/stacks-report/list/<frequency>', methods=['GET'])
 def list_stacks_reports(frequency='weekly'):
     """
     Endpoint to fetch the list of generated stacks reports.
 
     The list is fetched based on the frequency which is either weekly or monthly.
+    It can be narrowed down by from and to dates and paged through with limit
+    and continuation arguments.
     """
-    return flask.jsonify(_s3_helper.list_objects(frequency))
+    return _list_s3_reports(frequency)
 
 
 @app.route('/api/v1/stacks-report/report/<path:report>', methods=['GET'])
@@ -418,7 +846,10 @@ def get_stacks_report(report):
     will be returned.
     """
     try:
-        return flask.jsonify(_s3_helper.get_object_content(report)), 200
+        if STREAM_UPSTREAM_RESPONSES:
+            return _s3_report_response(report)
+        return flask.jsonify(coalesce('stacks-report', report,
+                                      _s3_helper.get_object_content, report)), 200
     except ClientError as e:
         return flask.jsonify({
             'key': "{key}".format(key=e.response.get('Error').get('Key')),
@@ -429,7 +860,7 @@ def get_stacks_report(report):
 @app.route('/api/v1/ingestion-report/list', methods=['GET'])
 def list_ingestion_reports():
     """Endpoint to fetch the list of generated ingestion reports."""
-    return flask.jsonify(_s3_helper.list_objects("ingestion-data/epv"))
+    return _list_s3_reports("ingestion-data/epv")
 
 
 @app.route('/api/v1/ingestion-report/report/<path:report>', methods=['GET'])
@@ -440,13 +871,38 @@ def get_ingestion_report(report):
     A report matching with the filename retrieved using the ingestion-report/list
     will be returned.
     """
+    if STREAM_UPSTREAM_RESPONSES:
+        return _s3_report_response(report)
     return flask.jsonify(_s3_helper.get_object_content(report))
 
 
+def _aggregate_s3_reports(prefix):
+    """Aggregate the reports under the prefix dated within the requested range."""
+    from_date = request.args.get('from')
+    to_date = request.args.get('to')
+    if not from_date or not to_date:
+        return flask.jsonify(error='from and to dates are required'), 400
+
+    try:
+        return flask.jsonify(aggregate_reports(prefix, from_date, to_date))
+    except ValueError as e:
+        return flask.jsonify(error=str(e)), 400
+
+
+@app.route('/api/v1/ingestion-report/aggregate', methods=['GET'])
+def aggregate_ingestion_reports():
+    """
+    Endpoint to aggregate the ingestion reports generated between from and to dates.
+
+    Counts found in the reports, e.g. EPV ingestion counts per ecosystem, are summed up.
+    """
+    return _aggregate_s3_reports("ingestion-data/epv")
+
+
 @app.route('/api/v1/sentry-report/list', methods=['GET'])
 def list_sentry_reports():
     """Endpoint to fetch the list of generated sentry reports."""
-    return flask.jsonify(_s3_helper.list_objects("sentry-error-data"))
+    return _list_s3_reports("sentry-error-data")
 
 
 @app.route('/api/v1/sentry-report/report/<path:report>', methods=['GET'])
@@ -457,23 +913,63 @@ def get_sentry_report(report):
     A report matching with the filename retrieved using the sentry-report/list
     will be returned.
     """
+    if STREAM_UPSTREAM_RESPONSES:
+        return _s3_report_response(report)
     return flask.jsonify(_s3_helper.get_object_content(report))
 
 
+@app.route('/api/v1/sentry-report/aggregate', methods=['GET'])
+def aggregate_sentry_reports():
+    """
+    Endpoint to aggregate the sentry reports generated between from and to dates.
+
+    Counts found in the reports, e.g. error counts per service, are summed up.
+    """
+    return _aggregate_s3_reports("sentry-error-data")
+
+
 @app.route('/api/v1/stacks-report/compare', methods=['GET'])
 def compare_stacks_report():
     """
     Endpoint to compare generated stacks reports for past days.
 
-    Maximum number of days 7.
+    Maximum number of days is configured by COMPARISON_MAX_DAYS.
     """
-    comparison_days = int(request.args.get('days'))
-    if comparison_days < 2 and comparison_days > 7:
+    try:
+        comparison_days = int(request.args.get('days'))
+    except (TypeError, ValueError):
+        comparison_days = 0
+    if comparison_days < 2 or comparison_days > COMPARISON_MAX_DAYS:
         # Return bad request
-        return flask.jsonify(error='Invalid number of days provided to compare reports.'
-                                   'Range is 2-7'), 400
+        return flask.jsonify(error='Invalid number of days provided to compare reports. '
+                                   'Range is 2-{}'.format(COMPARISON_MAX_DAYS)), 400
+
+    comparison = generate_comparison(comparison_days)
+    if comparison == -1:
+        return flask.jsonify(error='Insufficient reports to generate comparison result'), 404
+    return flask.jsonify(comparison)
+
+
+@app.route('/api/v1/stacks-report/trend', methods=['GET'])
+def stacks_report_trend():
+    """
+    Endpoint to get time series of the stacks reports summary.
+
+    Summary fields of the daily reports between from and to dates (YYYY-MM-DD)
+    are returned, optionally only the comma separated fields.
+    """
+    from_date = request.args.get('from')
+    to_date = request.args.get('to')
+    if not from_date or not to_date:
+        return flask.jsonify(error='from and to dates are required'), 400
+    fields = request.args.get('fields')
+    fields = [field.strip() for field in fields.split(',') if field.strip()] if fields else None
 
-    return flask.jsonify(generate_comparison(comparison_days))
+    try:
+        trend = generate_trend(from_date, to_date, fields)
+    except ValueError as e:
+        return flask.jsonify(error=str(e)), 400
+    return flask.jsonify({'from': from_date, 'to': to_date, 'trend': trend})
 
 
 @app.errorhandler(HTTPError)
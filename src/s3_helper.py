@@ -0,0 +1,314 @@
+"""Access to the reports stored on S3, with cached listings and content."""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+
+import boto3
+from botocore.exceptions import ClientError
+
+from cache import TTLCache
+from compression import gunzip, gunzip_chunks, STREAM_CHUNK_SIZE
+from lazy import Lazy
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# S3 listings are served from cache and refreshed in the background once older
+# than S3_LISTING_CACHE_TTL seconds, 0 disables the cache
+S3_LISTING_CACHE_TTL = int(os.environ.get("S3_LISTING_CACHE_TTL", "300"))
+_REPORT_DATE = re.compile(r'\d{4}-\d{2}(-\d{2})?')
+
+# Reports fetched from S3 are kept in memory for S3_REPORT_CACHE_TTL seconds, bounded
+# by S3_REPORT_CACHE_MAX_BYTES (0 disables), and optionally in S3_REPORT_CACHE_DIR on
+# disk where they are revalidated by their ETag. Larger objects are never cached. The
+# disk cache holds at most S3_REPORT_CACHE_DIR_MAX_BYTES, least recently used reports
+# are removed first.
+S3_REPORT_CACHE_TTL = int(os.environ.get("S3_REPORT_CACHE_TTL", "3600"))
+S3_REPORT_CACHE_MAX_BYTES = int(os.environ.get("S3_REPORT_CACHE_MAX_BYTES",
+                                               str(128 * 1024 * 1024)))
+S3_REPORT_CACHE_MAX_OBJECT_BYTES = int(os.environ.get("S3_REPORT_CACHE_MAX_OBJECT_BYTES",
+                                                      str(16 * 1024 * 1024)))
+S3_REPORT_CACHE_DIR = os.environ.get("S3_REPORT_CACHE_DIR")
+S3_REPORT_CACHE_DIR_MAX_BYTES = int(os.environ.get("S3_REPORT_CACHE_DIR_MAX_BYTES",
+                                                   str(1024 * 1024 * 1024)))
+
+
+def is_missing_object_error(error):
+    """Check whether the S3 error says that the object does not exist."""
+    return error.response.get('Error', {}).get('Code') in ('NoSuchKey', '404')
+
+
+class S3Helper:
+    """Helper class for storing reports to S3."""
+
+    def __init__(self):
+        """Init method for the helper class."""
+        self.region_name = os.environ.get('AWS_S3_REGION') or 'us-east-1'
+        self.aws_s3_access_key = os.environ.get('AWS_S3_ACCESS_KEY_ID')
+        self.aws_s3_secret_access_key = os.environ.get('AWS_S3_SECRET_ACCESS_KEY')
+        self.deployment_prefix = os.environ.get('DEPLOYMENT_PREFIX') or 'dev'
+        if self.deployment_prefix not in ('STAGE', 'prod'):
+            self.deployment_prefix = 'dev'
+
+        if self.aws_s3_secret_access_key is None or self.aws_s3_access_key is None or\
+                self.region_name is None or self.deployment_prefix is None:
+            raise ValueError("AWS credentials or S3 configuration was "
+                             "not provided correctly. Please set the AWS_S3_REGION, "
+                             "AWS_S3_ACCESS_KEY_ID, AWS_S3_SECRET_ACCESS_KEY, REPORT_BUCKET_NAME "
+                             "and DEPLOYMENT_PREFIX correctly.")
+        # S3 endpoint URL is required only for local deployments
+        self.s3_endpoint_url = os.environ.get('S3_ENDPOINT_URL') or 'http://localhost'
+
+        self.s3 = boto3.resource('s3', region_name=self.region_name,
+                                 aws_access_key_id=self.aws_s3_access_key,
+                                 aws_secret_access_key=self.aws_s3_secret_access_key)
+        self.s3_bucket_obj = self.s3.Bucket(os.environ.get('REPORT_BUCKET_NAME'))
+        self.listing_cache = TTLCache('s3_listing')
+        self.content_cache = TTLCache('s3_report', ttl=S3_REPORT_CACHE_TTL,
+                                      max_bytes=S3_REPORT_CACHE_MAX_BYTES,
+                                      max_entry_bytes=S3_REPORT_CACHE_MAX_OBJECT_BYTES)
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+
+    def list_objects(self, loc_prefix='weekly', from_date=None, to_date=None, limit=None,
+                     continuation=None):
+        """Fetch the list of objects found on the S3 bucket.
+
+        :param loc_prefix: prefix of the listed objects
+        :param from_date: list only reports dated on or after the date (YYYY-MM-DD)
+        :param to_date: list only reports dated on or before the date (YYYY-MM-DD)
+        :param limit: list at most the given number of objects
+        :param continuation: list objects following the one returned as next_continuation
+        """
+        keys = self.list_keys('{loc_prefix}'.format(loc_prefix=loc_prefix))
+        if continuation:
+            keys = [key for key in keys if key > continuation]
+        if from_date or to_date:
+            keys = [key for key in keys if self._in_date_range(key, from_date, to_date)]
+
+        res = {'objects': keys}
+        if limit is not None:
+            res['objects'] = keys[:limit]
+            res['next_continuation'] = keys[limit - 1] if 0 < limit < len(keys) else None
+        return res
+
+    @staticmethod
+    def _in_date_range(key, from_date, to_date):
+        """Check whether the date found in the object name is in the range."""
+        found = _REPORT_DATE.search(os.path.basename(key))
+        if not found:
+            return False
+        # monthly reports are named by YYYY-MM only
+        date = found.group(0)
+        return (not from_date or date >= from_date[:len(date)]) and \
+            (not to_date or date <= to_date[:len(date)])
+
+    def list_keys(self, prefix):
+        """Get sorted names of the objects under the prefix, from cache if possible."""
+        if S3_LISTING_CACHE_TTL <= 0:
+            return self._fetch_keys(prefix)
+
+        keys = self.listing_cache.get(prefix)
+        if keys is None:
+            return self._refresh_keys(prefix)
+        if self.listing_cache.age(prefix) >= S3_LISTING_CACHE_TTL:
+            # serve the stale listing, the fresh one is going to be there for the next call
+            with self._refreshing_lock:
+                refresh = prefix not in self._refreshing
+                self._refreshing.add(prefix)
+            if refresh:
+                threading.Thread(target=self._refresh_keys, args=(prefix,), daemon=True).start()
+        return keys
+
+    def _refresh_keys(self, prefix):
+        """List the objects and store the listing in the cache."""
+        try:
+            keys = self._fetch_keys(prefix)
+            self.listing_cache.set(prefix, keys, sum(len(key) for key in keys))
+            return keys
+        except ClientError as e:
+            logger.error('Listing of %s failed: %r', prefix, e)
+            raise
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(prefix)
+
+    def _fetch_keys(self, prefix):
+        """List names of the objects under the prefix on the S3 bucket."""
+        return sorted(obj.key for obj in self.s3_bucket_obj.objects.filter(Prefix=prefix)
+                      if os.path.basename(obj.key) != '')
+
+    def get_object_stream(self, object_name, decompress=True):
+        """Get generator of bytes of the object found on the S3 bucket.
+
+        Objects stored gzip compressed are decompressed on the fly unless
+        decompress is False, in that case their raw bytes are generated.
+        """
+        cached = self.content_cache.get(object_name) if S3_REPORT_CACHE_MAX_BYTES > 0 else None
+        if cached is not None:
+            chunks = iter([cached])
+        else:
+            try:
+                body = self._get_object(object_name)['Body']
+            except ClientError as e:
+                logger.error('Exception found: %r' % e)
+                raise e
+
+            def generate():
+                try:
+                    for chunk in body.iter_chunks(STREAM_CHUNK_SIZE):
+                        yield chunk
+                finally:
+                    body.close()
+            chunks = generate()
+        return gunzip_chunks(chunks) if decompress else chunks
+
+    def _get_object(self, object_name, **kwargs):
+        """Get the object, its gzip compressed variant if a JSON one is not there."""
+        try:
+            return self.s3.Object(os.environ.get('REPORT_BUCKET_NAME'), object_name) \
+                .get(**kwargs)
+        except ClientError as e:
+            if not object_name.endswith('.json') or not is_missing_object_error(e):
+                raise
+        return self.s3.Object(os.environ.get('REPORT_BUCKET_NAME'), object_name + '.gz') \
+            .get(**kwargs)
+
+    def get_object_bytes(self, object_name):
+        """Get raw bytes of the object found on the S3 bucket, from cache if possible."""
+        if S3_REPORT_CACHE_MAX_BYTES > 0:
+            content = self.content_cache.get(object_name)
+            if content is not None:
+                return content
+
+        content = self._get_object_bytes(object_name)
+        if S3_REPORT_CACHE_MAX_BYTES > 0:
+            self.content_cache.set(object_name, content, len(content))
+        return content
+
+    def _get_object_bytes(self, object_name):
+        """Download the object, or reuse its copy on disk as long as its ETag matches."""
+        cached_path, cached_etag = self._disk_cache_entry(object_name)
+        try:
+            if cached_etag:
+                response = self._get_object(object_name, IfNoneMatch=cached_etag)
+            else:
+                response = self._get_object(object_name)
+            content = response['Body'].read()
+        except ClientError as e:
+            if cached_etag and e.response.get('Error', {}).get('Code') == '304':
+                content = self._read_from_disk(cached_path)
+                if content is not None:
+                    metrics.increment('cache.s3_report_disk.hits')
+                    return content
+                # evicted after its ETag was read
+                return self._get_object_bytes(object_name)
+            logger.error('Exception found: %r' % e)
+            raise e
+
+        if cached_path:
+            metrics.increment('cache.s3_report_disk.misses')
+            if len(content) <= min(S3_REPORT_CACHE_MAX_OBJECT_BYTES,
+                                   S3_REPORT_CACHE_DIR_MAX_BYTES) and response.get('ETag'):
+                self._store_on_disk(cached_path, content, response['ETag'])
+                self._evict_from_disk()
+        return content
+
+    @staticmethod
+    def _disk_cache_entry(object_name):
+        """Get path of the object in the disk cache and its ETag, if it is stored there."""
+        if not S3_REPORT_CACHE_DIR:
+            return None, None
+        path = os.path.join(S3_REPORT_CACHE_DIR,
+                            hashlib.sha256(object_name.encode('utf-8')).hexdigest())
+        try:
+            with open(path + '.etag') as f:
+                return path, f.read().strip() if os.path.exists(path) else None
+        except IOError:
+            return path, None
+
+    @staticmethod
+    def _read_from_disk(path):
+        """Read the object content from the disk cache and mark it as recently used."""
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            os.utime(path)
+            return content
+        except (IOError, OSError):
+            return None
+
+    @staticmethod
+    def _evict_from_disk():
+        """Remove the least recently used reports until the disk cache fits its budget."""
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(S3_REPORT_CACHE_DIR)
+        except OSError as e:
+            logger.error('Cannot list the disk cache: %r', e)
+            return
+        for name in names:
+            if '.' in name:
+                # ETag and temporary files
+                continue
+            try:
+                stat = os.stat(os.path.join(S3_REPORT_CACHE_DIR, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+
+        entries.sort()
+        for _, size, name in entries:
+            if total <= S3_REPORT_CACHE_DIR_MAX_BYTES:
+                break
+            path = os.path.join(S3_REPORT_CACHE_DIR, name)
+            for suffix in ('.etag', ''):
+                try:
+                    os.remove(path + suffix)
+                except OSError:
+                    # removed by another worker
+                    pass
+            total -= size
+            metrics.increment('cache.s3_report_disk.evictions')
+
+    @staticmethod
+    def _store_on_disk(path, content, etag):
+        """Store the object content in the disk cache, atomically."""
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            for suffix, data in (('', content), ('.etag', etag.encode('utf-8'))):
+                tmp_path = '{path}{suffix}.{pid}.tmp'.format(
+                    path=path, suffix=suffix, pid=os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.rename(tmp_path, path + suffix)
+        except (IOError, OSError) as e:
+            logger.error('Cannot store report in disk cache: %r', e)
+
+    def get_object_content(self, object_name, use_cache=True):
+        """Get the report json object found on the S3 bucket, gzip compressed or not."""
+        if use_cache:
+            content = self.get_object_bytes(object_name)
+        else:
+            content = self._get_object_bytes(object_name)
+        return json.loads(gunzip(content).decode('utf-8'))
+
+    def put_object_content(self, object_name, content):
+        """Store the json object on the S3 bucket, gzip compressed if its name ends with .gz."""
+        obj = self.s3.Object(os.environ.get('REPORT_BUCKET_NAME'), object_name)
+        body = json.dumps(content).encode('utf-8')
+        if object_name.endswith('.gz'):
+            obj.put(Body=gzip.compress(body), ContentType='application/json',
+                    ContentEncoding='gzip')
+        else:
+            obj.put(Body=body, ContentType='application/json')
+        self.content_cache.delete(object_name)
+
+
+_s3_helper = Lazy('s3', S3Helper)
@@ -0,0 +1,172 @@
+"""Record of the repository scans that have been dispatched and are still in flight."""
+import datetime
+import logging
+import threading
+import time
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+logger = logging.getLogger(__name__)
+
+inflight_scans = Table(
+    'gemini_inflight_scans', MetaData(),
+    Column('git_url', String(255), primary_key=True),
+    Column('git_sha', String(255), primary_key=True),
+    Column('dispatcher_id', String(64)),
+    Column('dispatched_at', DateTime, nullable=False))
+
+
+class LocalScanStore:
+    """In-flight scans of this worker process.
+
+    A scan is claimed before its flow gets dispatched, the dispatcher id is
+    recorded afterwards. Claims older than window seconds are considered stale
+    and can be claimed again.
+    """
+
+    def __init__(self, window):
+        """Initialize empty store."""
+        self.window = window
+        self._lock = threading.Lock()
+        self._scans = {}
+
+    def claim(self, git_url, git_sha):
+        """Claim the scan of the commit.
+
+        :return: (True, None) if the scan has been claimed, (False, dispatcher id) if
+                 the same scan is still in flight
+        """
+        now = time.time()
+        with self._lock:
+            scan = self._scans.get((git_url, git_sha))
+            if scan is not None and now - scan[1] < self.window:
+                return False, scan[0]
+            self._scans[(git_url, git_sha)] = (None, now)
+            self._expire(now)
+        return True, None
+
+    def record(self, git_url, git_sha, dispatcher_id):
+        """Record the dispatcher id of the claimed scan."""
+        with self._lock:
+            scan = self._scans.get((git_url, git_sha))
+            self._scans[(git_url, git_sha)] = (dispatcher_id, scan[1] if scan else time.time())
+
+    def release(self, git_url, git_sha):
+        """Drop the claim of the scan, e.g. when its dispatch failed."""
+        with self._lock:
+            self._scans.pop((git_url, git_sha), None)
+
+    def get(self, git_url, git_sha):
+        """Get the dispatcher id of the scan in flight, None if there is none."""
+        with self._lock:
+            scan = self._scans.get((git_url, git_sha))
+        if scan is None or time.time() - scan[1] >= self.window:
+            return None
+        return scan[0]
+
+    def _expire(self, now):
+        for key in [key for key, scan in self._scans.items() if now - scan[1] >= self.window]:
+            del self._scans[key]
+
+
+def claim_inflight_scan(session, git_url, git_sha, window):  # pragma: no cover
+    """Insert the scan unless the same one is in flight, return True if it was inserted."""
+    now = datetime.datetime.utcnow()
+    statement = insert(inflight_scans).values(git_url=git_url, git_sha=git_sha,
+                                              dispatcher_id=None, dispatched_at=now)
+    statement = statement.on_conflict_do_update(
+        index_elements=[inflight_scans.c.git_url, inflight_scans.c.git_sha],
+        set_={'dispatcher_id': None, 'dispatched_at': now},
+        where=inflight_scans.c.dispatched_at < now - datetime.timedelta(seconds=window)) \
+        .returning(inflight_scans.c.git_url)
+    return session.execute(statement).first() is not None
+
+
+def get_inflight_scan(session, git_url, git_sha, window):  # pragma: no cover
+    """Get the dispatcher id of the scan in flight, None if there is none."""
+    since = datetime.datetime.utcnow() - datetime.timedelta(seconds=window)
+    row = session.execute(
+        inflight_scans.select().where(inflight_scans.c.git_url == git_url)
+        .where(inflight_scans.c.git_sha == git_sha)
+        .where(inflight_scans.c.dispatched_at >= since)).first()
+    return row.dispatcher_id if row else None
+
+
+def update_inflight_scan(session, git_url, git_sha, dispatcher_id):  # pragma: no cover
+    """Set the dispatcher id of the scan."""
+    session.execute(inflight_scans.update().where(inflight_scans.c.git_url == git_url)
+                    .where(inflight_scans.c.git_sha == git_sha)
+                    .values(dispatcher_id=dispatcher_id))
+
+
+def delete_inflight_scan(session, git_url, git_sha, window=None):  # pragma: no cover
+    """Delete the scan, or all scans older than window seconds when window is given."""
+    statement = inflight_scans.delete()
+    if window is None:
+        statement = statement.where(inflight_scans.c.git_url == git_url) \
+            .where(inflight_scans.c.git_sha == git_sha)
+    else:
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=window)
+        statement = statement.where(inflight_scans.c.dispatched_at < since)
+    session.execute(statement)
+
+
+class PostgresScanStore:
+    """In-flight scans shared by all worker processes through a Postgres table.
+
+    The store never stands in the way of scanning: when the database cannot
+    be reached, scans are claimed as if there were none in flight.
+    """
+
+    # stale rows are deleted by every EXPIRE_EVERY-th claim
+    EXPIRE_EVERY = 100
+
+    def __init__(self, get_session, window):
+        """Initialize the store and create its table if it does not exist."""
+        self.get_session = get_session
+        self.window = window
+        self._claims = 0
+        inflight_scans.create(bind=get_session().get_bind(), checkfirst=True)
+
+    def claim(self, git_url, git_sha):
+        """Claim the scan of the commit.
+
+        :return: (True, None) if the scan has been claimed, (False, dispatcher id) if
+                 the same scan is still in flight
+        """
+        self._claims += 1
+        claimed, dispatcher_id = self._run(
+            lambda session: (claim_inflight_scan(session, git_url, git_sha, self.window),
+                             get_inflight_scan(session, git_url, git_sha, self.window)),
+            default=(True, None))
+        if claimed and self._claims % self.EXPIRE_EVERY == 0:
+            self._run(lambda session: delete_inflight_scan(session, None, None, self.window))
+        return (True, None) if claimed else (False, dispatcher_id)
+
+    def record(self, git_url, git_sha, dispatcher_id):
+        """Record the dispatcher id of the claimed scan."""
+        self._run(lambda session: update_inflight_scan(session, git_url, git_sha,
+                                                       dispatcher_id))
+
+    def release(self, git_url, git_sha):
+        """Drop the claim of the scan, e.g. when its dispatch failed."""
+        self._run(lambda session: delete_inflight_scan(session, git_url, git_sha))
+
+    def get(self, git_url, git_sha):
+        """Get the dispatcher id of the scan in flight, None if there is none."""
+        return self._run(lambda session: get_inflight_scan(session, git_url, git_sha,
+                                                           self.window))
+
+    def _run(self, work, default=None):
+        """Run the work in a transaction, the default is returned when it fails."""
+        session = self.get_session()
+        try:
+            result = work(session)
+            session.commit()
+            return result
+        except SQLAlchemyError as e:
+            session.rollback()
+            logger.error('In-flight scans cannot be accessed: %r', e)
+            return default
@@ -0,0 +1,244 @@
+"""Dispatch of the scan flows, coalescing of the scans in flight and status of the flows."""
+import datetime
+import logging
+import os
+
+from f8a_worker.setup_celery import init_celery, init_selinon
+from selinon import run_flow, Config, Dispatcher, UnknownFlowError
+
+from cache import TTLCache
+from database import get_session, retrieve_worker_result
+from lazy import Lazy
+from metrics import metrics
+from scan_store import LocalScanStore, PostgresScanStore
+
+logger = logging.getLogger(__name__)
+
+# Number of scan flows dispatched together by a batch registration
+SCAN_DISPATCH_BATCH_SIZE = int(os.environ.get("SCAN_DISPATCH_BATCH_SIZE", "50"))
+# Scans of a commit requested again within SCAN_DEDUP_WINDOW seconds after its scan
+# was dispatched are coalesced onto the dispatched one, 0 disables that. A scan stops
+# being in flight earlier once its report exists or its flow is over, forced scans are
+# never coalesced. The in-flight scans are recorded either per process (local) or in
+# Postgres shared by all processes.
+SCAN_DEDUP_WINDOW = int(os.environ.get("SCAN_DEDUP_WINDOW", "3600"))
+SCAN_DEDUP_BACKEND = os.environ.get("SCAN_DEDUP_BACKEND", "local")
+# Status of the dispatched flows is read from the Celery result backend, the status of
+# a flow is kept in memory for FLOW_STATUS_CACHE_TTL seconds. The result backend is
+# configured for all the dispatched flows only when FLOW_STATUS_RESULT_BACKEND is set,
+# otherwise the flow status endpoint is not available.
+FLOW_STATUS_RESULT_BACKEND = os.environ.get("FLOW_STATUS_RESULT_BACKEND", "false").lower() \
+    in ("1", "true")
+FLOW_STATUS_CACHE_TTL = int(os.environ.get("FLOW_STATUS_CACHE_TTL", "10"))
+
+_selinon = Lazy('selinon', init_selinon)
+
+
+def _init_celery():
+    """Configure Celery, its broker connection pool is then shared by all dispatches."""
+    init_celery(result_backend=FLOW_STATUS_RESULT_BACKEND)
+
+
+_celery = Lazy('celery', _init_celery)
+
+
+def server_run_flow(flow_name, flow_args):
+    """Run a flow.
+
+    :param flow_name: name of flow to be run as stated in YAML config file
+    :param flow_args: arguments for the flow
+    :return: dispatcher ID handling flow
+    """
+    logger.info('Running flow {}'.format(flow_name))
+    start = datetime.datetime.now()
+    _selinon.instance()
+    _celery.instance()
+    dispacher_id = run_flow(flow_name, flow_args)
+    elapsed_seconds = (datetime.datetime.now() - start).total_seconds()
+    logger.info("It took {t} seconds to start {f} flow.".format(
+        t=elapsed_seconds, f=flow_name))
+    return dispacher_id
+
+
+def server_run_flows(flow_name, flow_args_list):
+    """Run many flows of the same name, publishing all of them over one broker connection.
+
+    :param flow_name: name of flow to be run as stated in YAML config file
+    :param flow_args_list: list of arguments, one flow is run for each of them
+    :return: list of (dispatcher ID, None) or (None, error) tuples in the order of the arguments
+    """
+    logger.info('Running {n} {f} flows'.format(n=len(flow_args_list), f=flow_name))
+    start = datetime.datetime.now()
+    _selinon.instance()
+    _celery.instance()
+    if Config.dispatcher_queues is None or flow_name not in Config.dispatcher_queues:
+        raise UnknownFlowError("No flow with name '{}' defined".format(flow_name))
+
+    queue = Config.dispatcher_queues[flow_name]
+    dispatcher = Dispatcher()
+    results = []
+    with dispatcher.app.producer_or_acquire() as producer:
+        for flow_args in flow_args_list:
+            try:
+                dispatcher_id = dispatcher.apply_async(
+                    kwargs={'flow_name': flow_name, 'node_args': flow_args},
+                    queue=queue, producer=producer)
+                results.append((str(dispatcher_id), None))
+            except Exception as e:
+                logger.error("Dispatch of {f} flow failed: {e}".format(f=flow_name, e=e))
+                results.append((None, e))
+    elapsed_seconds = (datetime.datetime.now() - start).total_seconds()
+    logger.info("It took {t} seconds to start {n} {f} flows.".format(
+        t=elapsed_seconds, n=len(flow_args_list), f=flow_name))
+    return results
+
+
+def _scan_flow_args(data):
+    """Get arguments of the flow scanning the repository."""
+    return {'github_repo': data['git-url'],
+            'github_sha': data['git-sha'],
+            'email_ids': data.get('email-ids', 'dummy')}
+
+
+def _create_scan_store():
+    """Create the store of the in-flight scans of the configured backend."""
+    if SCAN_DEDUP_BACKEND == 'postgres':
+        return PostgresScanStore(get_session, SCAN_DEDUP_WINDOW)
+    return LocalScanStore(SCAN_DEDUP_WINDOW)
+
+
+_scan_store = Lazy('scan_store', _create_scan_store)
+
+
+def _scan_finished(data, d_id):
+    """Check whether the claimed scan of the commit is over, its report or final status exist."""
+    try:
+        if retrieve_worker_result(data['git-sha'], "ReportGenerationTask"):
+            return True
+        return d_id is not None and FLOW_STATUS_RESULT_BACKEND and \
+            get_flow_status(d_id) in FLOW_FINAL_STATUSES
+    except Exception as e:
+        logger.error("State of the scan of %s at %s cannot be checked: %r",
+                     data['git-url'], data['git-sha'], e)
+        return False
+
+
+def _claim_scan(data):
+    """Claim the scan of the repository, return False if the same scan is in flight.
+
+    Forced scans are always claimed, as well as the scans whose claimed
+    predecessor is over already.
+    """
+    if SCAN_DEDUP_WINDOW <= 0:
+        return True
+    claimed, d_id = _scan_store.claim(data['git-url'], data['git-sha'])
+    if not claimed and (data.get('force') or _scan_finished(data, d_id)):
+        _scan_store.release(data['git-url'], data['git-sha'])
+        claimed, d_id = _scan_store.claim(data['git-url'], data['git-sha'])
+    if not claimed:
+        metrics.increment('scan.coalesced')
+        logger.info("Scan of {u} at {s} is already in flight, DISPATCHER ID = {d}".format(
+            u=data['git-url'], s=data['git-sha'], d=d_id))
+    return claimed
+
+
+def _record_scan(data, d_id, error=None):
+    """Record the dispatched scan, or drop its claim if the dispatch failed."""
+    if SCAN_DEDUP_WINDOW <= 0:
+        return
+    if error is None:
+        _scan_store.record(data['git-url'], data['git-sha'], str(d_id))
+    else:
+        _scan_store.release(data['git-url'], data['git-sha'])
+
+
+def get_scan_dispatcher_id(data):
+    """Get the dispatcher id of the scan of the repository in flight, None if unknown."""
+    if SCAN_DEDUP_WINDOW <= 0:
+        return None
+    return _scan_store.get(data['git-url'], data['git-sha'])
+
+
+def scan_repo(data):
+    """Scan function, coalesced onto the scan of the same commit that is in flight."""
+    if not _claim_scan(data):
+        return True
+    try:
+        d_id = server_run_flow('osioAnalysisFlow', _scan_flow_args(data))
+    except Exception as e:
+        _record_scan(data, None, e)
+        raise
+    _record_scan(data, d_id)
+    logger.info("DISPATCHER ID = {}".format(d_id))
+    return True
+
+
+def scan_repos(data_list):
+    """Scan many repositories, dispatching the flows in batches over one broker connection.
+
+    Scans of the commits that are in flight already are not dispatched again.
+
+    :param data_list: list of dicts, describing github data
+    :return: list of errors, None for every repository scanned successfully
+    """
+    errors = [None] * len(data_list)
+    for start in range(0, len(data_list), SCAN_DISPATCH_BATCH_SIZE):
+        claimed = [index for index in range(start, min(start + SCAN_DISPATCH_BATCH_SIZE,
+                                                       len(data_list)))
+                   if _claim_scan(data_list[index])]
+        if not claimed:
+            continue
+        try:
+            results = server_run_flows('osioAnalysisFlow',
+                                       [_scan_flow_args(data_list[index]) for index in claimed])
+        except Exception as e:
+            logger.error("Scan of {} repositories failed: {}".format(len(claimed), e))
+            results = [(None, e)] * len(claimed)
+
+        for index, (d_id, error) in zip(claimed, results):
+            _record_scan(data_list[index], d_id, error)
+            if error is not None:
+                logger.error("Scan of {} failed: {}".format(data_list[index].get('git-url'),
+                                                            error))
+                errors[index] = str(error)
+            else:
+                logger.info("DISPATCHER ID = {}".format(d_id))
+    return errors
+
+
+# Celery states of the task dispatching the flow, it is retried as long as the flow runs
+_FLOW_STATES = {
+    'PENDING': 'queued',
+    'RECEIVED': 'queued',
+    'STARTED': 'running',
+    'RETRY': 'running',
+    'SUCCESS': 'finished',
+    'FAILURE': 'failed',
+    'REVOKED': 'failed'
+}
+FLOW_FINAL_STATUSES = ('finished', 'failed')
+
+_flow_status_cache = TTLCache('flow_status', ttl=FLOW_STATUS_CACHE_TTL, max_bytes=4 * 1024 * 1024)
+
+
+def query_flow_state(dispatcher_id):  # pragma: no cover
+    """Get Celery state of the task dispatching the flow."""
+    return Dispatcher().AsyncResult(dispatcher_id).state
+
+
+def get_flow_status(dispatcher_id):
+    """Get status of the flow, one of queued, running, finished or failed.
+
+    Celery cannot tell flows that are queued from the ones it does not know,
+    flows unknown to the result backend are therefore reported as queued.
+
+    :param dispatcher_id: dispatcher ID returned when the flow was run
+    :return: status of the flow
+    """
+    status = _flow_status_cache.get(dispatcher_id)
+    if status is None:
+        _selinon.instance()
+        _celery.instance()
+        status = _FLOW_STATES.get(query_flow_state(dispatcher_id), 'queued')
+        _flow_status_cache.set(dispatcher_id, status, len(dispatcher_id) + len(status))
+    return status
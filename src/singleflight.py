@@ -0,0 +1,87 @@
+"""Coalescing of identical concurrent backend lookups within a worker process."""
+import os
+import threading
+
+from metrics import metrics
+
+# Comma separated names of endpoints whose lookups are coalesced, e.g. "report,graph"
+SINGLEFLIGHT_ENDPOINTS = set(
+    name.strip() for name in os.environ.get('SINGLEFLIGHT_ENDPOINTS', '').split(',')
+    if name.strip())
+
+
+class _Call:
+    """Backend call in progress together with its outcome."""
+
+    def __init__(self):
+        """Initialize the call that has not finished yet."""
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Share one backend call and its result between callers asking for the same key.
+
+    The first caller of a key runs the lookup, callers arriving while it is
+    still running wait for it and get the very same result (or exception).
+    """
+
+    def __init__(self, name):
+        """Initialize the group, name is used to label the metrics."""
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) unless the same key is already in flight."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        metrics.increment('singleflight.{}.requests'.format(self.name))
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        metrics.increment('singleflight.{}.executions'.format(self.name))
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+            self._update_dedup_factor()
+        return call.result
+
+    def _update_dedup_factor(self):
+        """Publish the ratio of requests to the backend calls actually made."""
+        requests = metrics.get('singleflight.{}.requests'.format(self.name))
+        executions = metrics.get('singleflight.{}.executions'.format(self.name))
+        if executions:
+            metrics.set_gauge('singleflight.{}.dedup_factor'.format(self.name),
+                              float(requests) / executions)
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def coalesce(endpoint, key, fn, *args, **kwargs):
+    """Run the lookup of the endpoint, coalesced when enabled for that endpoint."""
+    if endpoint not in SINGLEFLIGHT_ENDPOINTS:
+        return fn(*args, **kwargs)
+
+    with _flights_lock:
+        flight = _flights.get(endpoint)
+        if flight is None:
+            flight = _flights[endpoint] = SingleFlight(endpoint)
+    return flight.do(key, fn, *args, **kwargs)
@@ -1,238 +1,66 @@
 """Utility classes and functions."""
-from flask import current_app
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm.exc import NoResultFound
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
-from f8a_worker.models import OSIORegisteredRepos, WorkerResult
-from f8a_worker.setup_celery import init_celery
-from selinon import run_flow
+from f8a_worker.models import OSIORegisteredRepos
 from parsers.maven_parser import MavenParser
 from parsers.node_parser import NodeParser
+from cache import TTLCache
+from database import get_session, retrieve_worker_results, remove_sessions
+from s3_helper import _s3_helper, is_missing_object_error
+from scans import server_run_flow
+from report_index import StacksSummaryIndex
+from report_watcher import ReportWatcher
+from webhooks import is_valid_callback_url
+from payload_logging import log_payload
 import datetime
 import requests
 import os
 import logging
-import boto3
 import json
-import re
-import psycopg2
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, BotoCoreError
+from concurrent.futures import ThreadPoolExecutor, as_completed, \
+    TimeoutError as FuturesTimeoutError
 
 logger = logging.getLogger(__name__)
 
-GREMLIN_SERVER_URL_REST = "http://{host}:{port}".format(
-    host=os.environ.get("BAYESIAN_GREMLIN_HTTP_SERVICE_HOST", "localhost"),
-    port=os.environ.get("BAYESIAN_GREMLIN_HTTP_SERVICE_PORT", "8182"))
-
 LICENSE_SCORING_URL_REST = "http://{host}:{port}".format(
     host=os.environ.get("LICENSE_SERVICE_HOST"),
     port=os.environ.get("LICENSE_SERVICE_PORT"))
 
-
-def sanitize_text_for_query(text):
-    """
-    Sanitize text so it can used in queries.
-
-    :param text: string, text to sanitize
-    :return: sanitized text
-    """
-    if text is None:
-        return ''
-
-    if not isinstance(text, str):
-        raise ValueError(
-            'Invalid query text: expected string, got {t}'.format(t=type(text))
-        )
-
-    strict_check_words = ['drop', 'delete', 'update', 'remove', 'insert']
-    if re.compile('|'.join(strict_check_words), re.IGNORECASE).search(text):
-        raise ValueError('Only select queries are supported')
-
-    # remove newlines, quotes and backslash character
-    text = " ".join([line.strip() for line in text.split("\n")])
-    return text.strip()
-
-
-class GraphPassThrough:
-    """Graph database pass through handler."""
-
-    def fetch_nodes(self, data):
-        """Fetch node from graph database."""
-        if data and data.get('query'):
-            try:
-                # sanitize the query to drop CRUD operations
-                query = sanitize_text_for_query(data['query'])
-                if query:
-                    payload = {'gremlin': query}
-                    resp = requests.post(url=GREMLIN_SERVER_URL_REST, json=payload)
-                    return {'data': resp.json()}
-            except (ValueError, requests.exceptions.Timeout, Exception) as e:
-                return {'error': str(e)}
-        else:
-            return {'warning': 'Invalid payload. Check your payload once again'}
-
-
-class PostgresPassThrough:
-    """Postgres connection pass through session and cursor handler."""
-
-    def __init__(self):
-        """Initialize the connection to Postgres database using psycopg2 as a pass through."""
-        self.conn_string = "host='{host}' dbname='{dbname}' user='{user}' password='{password}'".\
-            format(host=os.getenv('PGBOUNCER_SERVICE_HOST', 'bayesian-pgbouncer'),
-                   dbname=os.getenv('POSTGRESQL_DATABASE', 'coreapi'),
-                   user=os.getenv('POSTGRESQL_USER', 'coreapi'),
-                   password=os.getenv('POSTGRESQL_PASSWORD', 'coreapi'))
-
-    def fetch_records(self, data, client_validated):
-        """Fetch records from RDS database."""
-        if data and data.get('query'):
-            try:
-                conn = psycopg2.connect(self.conn_string)
-                cursor = conn.cursor()
-                # sanitize the query to drop CRUD operations
-                query = sanitize_text_for_query(data['query'])
-                if query:
-                    cursor.execute(query)
-
-                    if client_validated:
-                        return {'data': cursor.fetchall()}
-                    return {'data': cursor.fetchmany(10)}
-            except (ValueError, Exception) as e:
-                return {'error': str(e)}
-            finally:
-                conn.commit()
-                cursor.close()
-                conn.close()
-        else:
-            return {'warning': 'Invalid payload. Check your payload once again'}
-
-
-class Postgres:
-    """Postgres utility class to create postgres connection session."""
-
-    def __init__(self):
-        """Postgres utility class constructor."""
-        con_string = 'postgresql://{user}' + ':{passwd}@{pg_host}:' \
-                     + '{pg_port}/{db}?sslmode=disable'
-
-        self.connection = con_string.format(
-            user=os.getenv('POSTGRESQL_USER'),
-            passwd=os.getenv('POSTGRESQL_PASSWORD'),
-            pg_host=os.getenv(
-                'PGBOUNCER_SERVICE_HOST',
-                'bayesian-pgbouncer'),
-            pg_port=os.getenv(
-                'PGBOUNCER_SERVICE_PORT',
-                '5432'),
-            db=os.getenv('POSTGRESQL_DATABASE'))
-        engine = create_engine(self.connection)
-
-        self.Session = sessionmaker(bind=engine)
-        self.session = self.Session()
-
-    def session(self):
-        """Postgres utility session getter."""
-        return self.session
-
-
-_rdb = Postgres()
-
-
-class S3Helper:
-    """Helper class for storing reports to S3."""
-
-    def __init__(self):
-        """Init method for the helper class."""
-        self.region_name = os.environ.get('AWS_S3_REGION') or 'us-east-1'
-        self.aws_s3_access_key = os.environ.get('AWS_S3_ACCESS_KEY_ID')
-        self.aws_s3_secret_access_key = os.environ.get('AWS_S3_SECRET_ACCESS_KEY')
-        self.deployment_prefix = os.environ.get('DEPLOYMENT_PREFIX') or 'dev'
-        if self.deployment_prefix not in ('STAGE', 'prod'):
-            self.deployment_prefix = 'dev'
-
-        if self.aws_s3_secret_access_key is None or self.aws_s3_access_key is None or\
-                self.region_name is None or self.deployment_prefix is None:
-            raise ValueError("AWS credentials or S3 configuration was "
-                             "not provided correctly. Please set the AWS_S3_REGION, "
-                             "AWS_S3_ACCESS_KEY_ID, AWS_S3_SECRET_ACCESS_KEY, REPORT_BUCKET_NAME "
-                             "and DEPLOYMENT_PREFIX correctly.")
-        # S3 endpoint URL is required only for local deployments
-        self.s3_endpoint_url = os.environ.get('S3_ENDPOINT_URL') or 'http://localhost'
-
-        self.s3 = boto3.resource('s3', region_name=self.region_name,
-                                 aws_access_key_id=self.aws_s3_access_key,
-                                 aws_secret_access_key=self.aws_s3_secret_access_key)
-        self.s3_bucket_obj = self.s3.Bucket(os.environ.get('REPORT_BUCKET_NAME'))
-
-    def list_objects(self, loc_prefix='weekly'):
-        """Fetch the list of objects found on the S3 bucket."""
-        prefix = '{loc_prefix}'.format(loc_prefix=loc_prefix)
-        res = {'objects': []}
-        for obj in self.s3_bucket_obj.objects.filter(Prefix=prefix):
-            if os.path.basename(obj.key) != '':
-                res['objects'].append(obj.key)
-        return res
-
-    def get_object_content(self, object_name):
-        """Get the report json object found on the S3 bucket."""
-        obj = self.s3.Object(os.environ.get('REPORT_BUCKET_NAME'), object_name)
-        try:
-            result = json.loads(obj.get()['Body'].read().decode('utf-8'))
-        except ClientError as e:
-            logger.error('Exception found: %r' % e)
-            raise e
-        return result
-
-
-_s3_helper = S3Helper()
-
-
-def query_worker_result(session, external_request_id, worker):  # pragma: no cover
-    """Query worker_result table."""
-    return session.query(WorkerResult) \
-        .filter(WorkerResult.external_request_id == external_request_id,
-                WorkerResult.worker == worker) \
-        .order_by(WorkerResult.ended_at.desc())
-
-
-def get_first_query_result(query):  # pragma: no cover
-    """Return first result of query."""
-    return query.first()
-
-
-def retrieve_worker_result(external_request_id, worker):
-    """Retrieve results for selected worker from RDB."""
-    start = datetime.datetime.now()
-    session = get_session()
-    try:
-        query = query_worker_result(session, external_request_id, worker)
-        result = get_first_query_result(query)
-    except SQLAlchemyError:
-        session.rollback()
-        raise
-
-    if result:
-        result_dict = result.to_dict()
-        elapsed_seconds = (datetime.datetime.now() - start).total_seconds()
-        msg = "It took {t} seconds to retrieve {w} " \
-            "worker results for {r}.".format(t=elapsed_seconds, w=worker, r=external_request_id)
-        current_app.logger.debug(msg)
-
-        return result_dict
-
-    return None
-
-
-def get_session():
-    """Retrieve the database connection session."""
-    try:
-        session = _rdb.session
-    except Exception as e:
-        raise Exception("session could not be loaded due to {}".format(e))
-    return session
+# Upper bound of repositories accepted by a single batch registration request
+MAX_BATCH_REGISTER_SIZE = int(os.environ.get("MAX_BATCH_REGISTER_SIZE", "500"))
+# Clients waiting for a scan report are held for at most REPORT_WAIT_MAX_SECONDS, the
+# results of all waited for commits are checked together every REPORT_WATCH_INTERVAL seconds.
+# Every waiting client holds a worker thread, so the server has to run threaded workers
+# (gunicorn gthread) and at most REPORT_WAIT_MAX_WAITERS clients wait per process.
+REPORT_WAIT_MAX_SECONDS = int(os.environ.get("REPORT_WAIT_MAX_SECONDS", "30"))
+REPORT_WAIT_MAX_WAITERS = int(os.environ.get("REPORT_WAIT_MAX_WAITERS", "8"))
+REPORT_WATCH_INTERVAL = float(os.environ.get("REPORT_WATCH_INTERVAL", "2"))
+# Upper bound of reports retrieved by a single batch report request
+MAX_BATCH_REPORT_SIZE = int(os.environ.get("MAX_BATCH_REPORT_SIZE", "1000"))
+
+# Reports needed by one request are fetched by at most S3_FETCH_WORKERS threads and
+# those not fetched within S3_FETCH_DEADLINE seconds are treated as missing
+S3_FETCH_WORKERS = int(os.environ.get("S3_FETCH_WORKERS", "8"))
+S3_FETCH_DEADLINE = float(os.environ.get("S3_FETCH_DEADLINE", "20"))
+# Upper bound of days compared by the stacks report comparison
+COMPARISON_MAX_DAYS = int(os.environ.get("COMPARISON_MAX_DAYS", "90"))
+# Summary fields of the daily stacks reports kept in the stacks summary index
+STACKS_INDEX_FIELDS = [field.strip() for field in os.environ.get(
+    "STACKS_INDEX_FIELDS", "total_average_response_time,total_stack_requests_count").split(',')
+    if field.strip()]
+# Upper bound of days of the stacks report trend
+STACKS_TREND_MAX_DAYS = int(os.environ.get("STACKS_TREND_MAX_DAYS", "366"))
+# Aggregations over the ingestion and sentry reports are remembered for
+# REPORT_AGGREGATION_CACHE_TTL seconds and span at most REPORT_AGGREGATION_MAX_REPORTS
+REPORT_AGGREGATION_CACHE_TTL = int(os.environ.get("REPORT_AGGREGATION_CACHE_TTL", "3600"))
+REPORT_AGGREGATION_MAX_REPORTS = int(os.environ.get("REPORT_AGGREGATION_MAX_REPORTS", "400"))
+
+_report_watcher = ReportWatcher(retrieve_worker_results, "ReportGenerationTask",
+                                interval=REPORT_WATCH_INTERVAL, release=remove_sessions)
 
 
 def get_session_retry(retries=3, backoff_factor=0.2,
@@ -265,6 +93,9 @@ def validate_request_data(input_json):
         validate_string = validate_string.format("git-sha")
         return False, validate_string
 
+    if 'callback-url' in input_json and not is_valid_callback_url(input_json['callback-url']):
+        return False, "callback-url must be an http or https URL of an allowed host"
+
     return True, None
 
 
@@ -285,6 +116,26 @@ def update_osio_registered_repos(session, data):  # pragma: no cover
         update(_to_object_dict(data))
 
 
+def _to_row_dict(data):  # pragma: no cover
+    """Convert the registration data into a row of osio_registered_repos table."""
+    return {'git_url': data["git-url"],
+            'git_sha': data["git-sha"],
+            'email_ids': data.get('email-ids', 'dummy'),
+            'last_scanned_at': datetime.datetime.now()
+            }
+
+
+def upsert_osio_registered_repos(session, data_list):  # pragma: no cover
+    """Insert or update many rows of osio_registered_repos table with one statement."""
+    statement = insert(OSIORegisteredRepos).values([_to_row_dict(data) for data in data_list])
+    statement = statement.on_conflict_do_update(
+        index_elements=[OSIORegisteredRepos.git_url],
+        set_={'git_sha': statement.excluded.git_sha,
+              'email_ids': statement.excluded.email_ids,
+              'last_scanned_at': statement.excluded.last_scanned_at})
+    session.execute(statement)
+
+
 def add_entry_to_osio_registered_repos(session, entry):  # pragma: no cover
     """Add single entry to osio_registered_repos table."""
     session.add(entry)
@@ -344,17 +195,36 @@ class DatabaseIngestion:
             raise Exception("Error in storing the record due to {}".format(e))
         return cls.get_info(data["git-url"])
 
+    @staticmethod
+    def bulk_upsert(data_list):
+        """Store new and update existing records in the database at once.
+
+        :param data_list: list of dicts, describing github data
+        :return: None
+        """
+        if not data_list:
+            return
+        try:
+            session = get_session()
+            upsert_osio_registered_repos(session, data_list)
+            session.commit()
+        except SQLAlchemyError:
+            session.rollback()
+            raise Exception("Error in storing the records in current session")
+
     @classmethod
-    def get_info(cls, search_key):
+    def get_info(cls, search_key, read_only=False):
         """Get information about github url.
 
         :param search_key: github url to search database
+        :param read_only: read the record from a replica, which can lag behind the primary;
+                          not to be used when the record is written based on what is read
         :return: record from database if exists
         """
         if not search_key:
             return {'error': 'No key found', 'is_valid': False}
 
-        session = get_session()
+        session = get_session(read_only=read_only)
 
         try:
             entry = get_one_result_from_osio_registered_repos(
@@ -374,33 +244,6 @@ class DatabaseIngestion:
         return {'is_valid': True, 'data': entry.to_dict()}
 
 
-def server_run_flow(flow_name, flow_args):
-    """Run a flow.
-
-    :param flow_name: name of flow to be run as stated in YAML config file
-    :param flow_args: arguments for the flow
-    :return: dispatcher ID handling flow
-    """
-    logger.info('Running flow {}'.format(flow_name))
-    start = datetime.datetime.now()
-    init_celery(result_backend=False)
-    dispacher_id = run_flow(flow_name, flow_args)
-    elapsed_seconds = (datetime.datetime.now() - start).total_seconds()
-    logger.info("It took {t} seconds to start {f} flow.".format(
-        t=elapsed_seconds, f=flow_name))
-    return dispacher_id
-
-
-def scan_repo(data):
-    """Scan function."""
-    args = {'github_repo': data['git-url'],
-            'github_sha': data['git-sha'],
-            'email_ids': data.get('email-ids', 'dummy')}
-    d_id = server_run_flow('osioAnalysisFlow', args)
-    logger.info("DISPATCHER ID = {}".format(d_id))
-    return True
-
-
 def alert_user(data, service_token="", epv_list=[]):
     """Invoke worker flow to scan user repository."""
     args = {'github_repo': data['git-url'],
@@ -477,36 +320,164 @@ def get_parser_from_ecosystem(ecosystem):
     }.get(ecosystem)
 
 
+def iter_s3_reports(report_names, deadline=None):
+    """Fetch the reports from S3 concurrently and yield them as they arrive.
+
+    :param report_names: names of the report objects
+    :param deadline: seconds to wait for all the reports, S3_FETCH_DEADLINE by default
+    :return: generator of (report name, report content) pairs, content is None for
+             reports that do not exist, reports not fetched in time or failing to be
+             fetched or parsed for other reasons are left out
+    """
+    report_names = list(report_names)
+    if not report_names:
+        return
+    deadline = S3_FETCH_DEADLINE if deadline is None else deadline
+    executor = ThreadPoolExecutor(max_workers=min(S3_FETCH_WORKERS, len(report_names)))
+    futures = {executor.submit(_s3_helper.get_object_content, name): name
+               for name in report_names}
+    pending = set(futures)
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            pending.discard(future)
+            try:
+                report = future.result()
+            except ClientError as e:
+                if not is_missing_object_error(e):
+                    # e.g. throttling or denied access, the report may be there
+                    logger.error('Report %s cannot be fetched: %r', futures[future], e)
+                    continue
+                logger.info('Report %s is missing: %s', futures[future], e)
+                report = None
+            except (BotoCoreError, ValueError) as e:
+                # e.g. connection failures or malformed reports
+                logger.error('Report %s cannot be read: %r', futures[future], e)
+                continue
+            yield futures[future], report
+    except FuturesTimeoutError:
+        logger.error('{} reports were not fetched within {} seconds'
+                     .format(len(pending), deadline))
+        for future in pending:
+            future.cancel()
+    finally:
+        executor.shutdown(wait=False)
+
+
 def generate_comparison(comparison_days):
-    """Generate comparioson report."""
+    """Generate comparioson report.
+
+    Summaries of the daily reports of the past days are read from the stacks
+    summary index, missing reports are skipped and replaced by the reports of
+    the days preceding the compared ones.
+
+    :param comparison_days: number of daily reports to compare
+    :return: dict with average response times, -1 if there are less than two reports
+    """
     today = datetime.datetime.today()
-    i = 0
-    response_times = []
-    dp = os.environ.get('DEPLOYMENT_PREFIX') or 'dev'
-    while i < comparison_days:
-        formatted_date = (today - datetime.timedelta(days=i + 1)).strftime('%Y-%m-%d')
-        logger.error('Formatted Date: {}'.format(formatted_date))
+    # look back twice as far so that missing reports can be skipped
+    dates = [(today - datetime.timedelta(days=i + 1)).strftime('%Y-%m-%d')
+             for i in range(2 * comparison_days)]
+    summaries = _stacks_index.get_range(dates, ['total_average_response_time'])
+
+    response_times = [{date: summaries[date]['total_average_response_time']}
+                      for date in dates if summaries[date] is not None][:comparison_days]
+    if len(response_times) < 2:
+        logger.warning('Insufficient reports to generate comparison result')
+        return -1
+
+    log_payload(logger, logging.DEBUG, 'Average Response Time: %s', response_times)
+    return {"average_response_time": response_times}
 
-        report_name = '{dp}/daily/{cdate}.json'.format(dp=dp, cdate=formatted_date)
-        logger.error('Report Name: {}'.format(report_name))
 
-        missing_reports = 0
-        try:
-            data = _s3_helper.get_object_content(report_name)
-        except ClientError as e:
-            if comparison_days == 2:
-                logger.error('the report for {} is missing. Cannot proceed with the '
-                             'comparison. Error: {}'.format(formatted_date, e))
-                return -1
-            else:
-                missing_reports += 1
-                if comparison_days - missing_reports == 1:
-                    logger.error('Insufficient reports to generate comparison result')
-                    return -1
+def generate_trend(from_date, to_date, fields=None):
+    """Generate time series of the stacks report summary fields.
+
+    :param from_date: first date of the trend (YYYY-MM-DD)
+    :param to_date: last date of the trend (YYYY-MM-DD)
+    :param fields: names of the stacks_summary fields, all indexed fields by default
+    :return: list of dicts with the date and the fields, days without report are left out
+    """
+    start = datetime.datetime.strptime(from_date, '%Y-%m-%d')
+    end = datetime.datetime.strptime(to_date, '%Y-%m-%d')
+    days = (end - start).days + 1
+    if days < 1 or days > STACKS_TREND_MAX_DAYS:
+        raise ValueError('Date range must span 1-{} days'.format(STACKS_TREND_MAX_DAYS))
+
+    dates = [(start + datetime.timedelta(days=i)).strftime('%Y-%m-%d') for i in range(days)]
+    summaries = _stacks_index.get_range(dates, fields)
+    return [dict(summaries[date], date=date) for date in dates if summaries[date] is not None]
+
+
+def merge_counts(totals, report):
+    """Add the numbers found in the report to the totals.
+
+    Nested dicts are merged recursively, lists are counted by their length and
+    any other values are ignored.
+
+    :param totals: dict with the totals, updated in place
+    :param report: dict, the report
+    :return: the totals
+    """
+    for key, value in report.items():
+        if isinstance(value, bool):
+            continue
+        if isinstance(value, dict):
+            if not isinstance(totals.get(key, {}), dict):
                 continue
-        response_times.append({formatted_date: data.get('stacks_summary', {}).
-                              get('total_average_response_time')})
-        i += 1
+            merge_counts(totals.setdefault(key, {}), value)
+        elif isinstance(value, (int, float, list)) and \
+                isinstance(totals.get(key, 0), (int, float)):
+            totals[key] = totals.get(key, 0) + (len(value) if isinstance(value, list) else value)
+    return totals
 
-    logger.error('Average Response Time: %r' % response_times)
-    return {"average_response_time": response_times}
+
+_aggregation_cache = TTLCache('report_aggregation', ttl=REPORT_AGGREGATION_CACHE_TTL)
+
+
+def aggregate_reports(prefix, from_date, to_date):
+    """Aggregate counts of all reports under the prefix dated within the range.
+
+    Reports are fetched concurrently and merged one by one as they arrive, the
+    result is remembered for the same prefix and date range.
+
+    :param prefix: prefix of the reports, e.g. sentry-error-data
+    :param from_date: first date of the range (YYYY-MM-DD)
+    :param to_date: last date of the range (YYYY-MM-DD)
+    :return: dict with the totals and the number of aggregated reports
+    """
+    for date in (from_date, to_date):
+        datetime.datetime.strptime(date, '%Y-%m-%d')
+    key = (prefix, from_date, to_date)
+    aggregation = _aggregation_cache.get(key)
+    if aggregation is not None:
+        return aggregation
+
+    report_names = _s3_helper.list_objects(prefix, from_date=from_date,
+                                           to_date=to_date)['objects']
+    if len(report_names) > REPORT_AGGREGATION_MAX_REPORTS:
+        raise ValueError('Date range spans {} reports, at most {} can be aggregated'
+                         .format(len(report_names), REPORT_AGGREGATION_MAX_REPORTS))
+
+    totals = {}
+    aggregated = []
+    for report_name, report in iter_s3_reports(report_names):
+        if report is not None:
+            # metadata about the report period are not aggregated
+            merge_counts(totals, {k: v for k, v in report.items() if k != 'report'})
+            aggregated.append(report_name)
+
+    aggregation = {
+        'from': from_date,
+        'to': to_date,
+        'reports': sorted(aggregated),
+        'missing': sorted(set(report_names) - set(aggregated)),
+        'totals': totals
+    }
+    if len(aggregated) == len(report_names):
+        _aggregation_cache.set(key, aggregation, len(json.dumps(aggregation)))
+    return aggregation
+
+
+_stacks_index = StacksSummaryIndex(
+    _s3_helper, iter_s3_reports, os.environ.get('DEPLOYMENT_PREFIX') or 'dev',
+    STACKS_INDEX_FIELDS, path=os.environ.get('STACKS_INDEX_PATH'))
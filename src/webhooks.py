@@ -0,0 +1,175 @@
+"""Callbacks notifying the registering clients that the scan reports are available."""
+import ipaddress
+import logging
+import os
+import socket
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import requests
+
+from metrics import metrics
+from outbox import Drainer
+
+logger = logging.getLogger(__name__)
+
+# Callbacks are delivered in batches every WEBHOOK_INTERVAL seconds, each POST waits at
+# most WEBHOOK_TIMEOUT seconds and callbacks of reports that do not appear within
+# WEBHOOK_MAX_WAIT seconds are dead-lettered
+WEBHOOK_INTERVAL = float(os.environ.get("WEBHOOK_INTERVAL", "10"))
+WEBHOOK_TIMEOUT = float(os.environ.get("WEBHOOK_TIMEOUT", "5"))
+WEBHOOK_MAX_WAIT = float(os.environ.get("WEBHOOK_MAX_WAIT", str(24 * 3600)))
+WEBHOOK_BATCH_SIZE = int(os.environ.get("WEBHOOK_BATCH_SIZE", "100"))
+
+# Comma separated hosts the callbacks may go to, a leading dot allows all the subdomains;
+# when it is empty, callbacks may go to any host that resolves to public addresses only
+CALLBACK_URL_ALLOWED_HOSTS = [host.strip().lower() for host in
+                              os.environ.get("CALLBACK_URL_ALLOWED_HOSTS", "").split(",")
+                              if host.strip()]
+
+
+def _is_allowed_host(host):
+    """Check whether the host is in CALLBACK_URL_ALLOWED_HOSTS."""
+    return any(host == allowed or (allowed.startswith('.') and host.endswith(allowed))
+               for allowed in CALLBACK_URL_ALLOWED_HOSTS)
+
+
+def _is_public_host(host):
+    """Check whether all the addresses of the host are public ones."""
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except (socket.gaierror, UnicodeError):
+        return False
+    return bool(addresses) and all(
+        ipaddress.ip_address(address.split('%')[0]).is_global for address in addresses)
+
+
+def is_valid_callback_url(url):
+    """Check whether the callbacks may be posted to the URL.
+
+    Only http(s) URLs of the allowed hosts are accepted, so that the callbacks
+    cannot be aimed at the services of the internal network.
+    """
+    if not isinstance(url, str):
+        return False
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        return False
+    if CALLBACK_URL_ALLOWED_HOSTS:
+        return _is_allowed_host(parsed.hostname.lower())
+    return _is_public_host(parsed.hostname)
+
+
+def report_summary(git_url, git_sha, result):
+    """Summarize the ReportGenerationTask result of the commit."""
+    task_result = (result or {}).get('task_result')
+    summary = {'git-url': git_url, 'git-sha': git_sha}
+    if not task_result:
+        summary['status'] = 'failure'
+        return summary
+    if task_result.get('lock_file_absent'):
+        summary.update({'status': 'lock_file_absent', 'message': task_result.get('message')})
+        return summary
+
+    dependencies = task_result.get('dependencies') or []
+    cve_counts = [int(dependency.get('cve_count') or 0) for dependency in dependencies]
+    summary.update({
+        'status': 'available',
+        'scanned_at': task_result.get('scanned_at'),
+        'dependencies': len(dependencies),
+        'vulnerable_dependencies': sum(1 for count in cve_counts if count),
+        'cve_count': sum(cve_counts)
+    })
+    return summary
+
+
+class WebhookNotifier:
+    """POST the report summaries to the callback URLs once the reports are generated.
+
+    Callbacks wait in the outbox, the results of all waiting commits are
+    checked with one query per batch and the summaries going to the same URL
+    are delivered together as {"reports": [...]}.
+    """
+
+    def __init__(self, outbox, fetch_results, session=None, interval=WEBHOOK_INTERVAL,
+                 timeout=WEBHOOK_TIMEOUT, max_wait=WEBHOOK_MAX_WAIT, release=None):
+        """Initialize the notifier, callbacks are delivered once it is started.
+
+        :param release: function called once the results are fetched, e.g. ending the
+                        database session before the callbacks are posted
+        """
+        self.outbox = outbox
+        self.fetch_results = fetch_results
+        self.release = release
+        self.session = session or requests.Session()
+        self.interval = interval
+        self.timeout = timeout
+        self.max_wait = max_wait
+        self.drainer = Drainer(outbox, self.deliver, interval=interval,
+                               batch_size=WEBHOOK_BATCH_SIZE)
+
+    def start(self):
+        """Start delivering the callbacks in the background."""
+        self.drainer.start()
+        return self
+
+    def register(self, callback_url, git_url, git_sha):
+        """Store the callback of the commit report."""
+        self.outbox.put(callback_url, {'git-url': git_url, 'git-sha': git_sha})
+        metrics.increment('webhooks.registered')
+
+    def deliver(self, messages):
+        """Deliver the callbacks of the reports that are available already.
+
+        When the reports cannot be looked up, the callbacks are deferred without
+        counting as a failed attempt.
+        """
+        try:
+            results = self.fetch_results(
+                list({message.payload['git-sha'] for message in messages}),
+                "ReportGenerationTask")
+        except Exception as e:
+            logger.error('Reports of %d callbacks cannot be looked up: %r', len(messages), e)
+            self.outbox.defer([message.id for message in messages], self.interval)
+            metrics.increment('webhooks.deferred', len(messages))
+            return
+        finally:
+            if self.release is not None:
+                self.release()
+        now = time.time()
+        ready = defaultdict(list)
+        waiting = []
+        expired = []
+        for message in messages:
+            result = results.get(message.payload['git-sha'])
+            if result is not None:
+                ready[message.destination].append(message)
+            elif now - message.created_at > self.max_wait:
+                expired.append(message.id)
+            else:
+                waiting.append(message.id)
+        self.outbox.defer(waiting, self.interval)
+        if expired:
+            self.outbox.dead_letter(expired, 'Report was not generated in time')
+
+        for url, url_messages in ready.items():
+            ids = [message.id for message in url_messages]
+            # the host could resolve differently by now
+            if not is_valid_callback_url(url):
+                self.outbox.dead_letter(ids, 'Callback URL is not allowed')
+                continue
+            reports = [report_summary(message.payload['git-url'], message.payload['git-sha'],
+                                      results[message.payload['git-sha']])
+                       for message in url_messages]
+            try:
+                response = self.session.post(url, json={'reports': reports},
+                                             timeout=self.timeout, allow_redirects=False)
+                response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                logger.warning('Callback to %s failed: %r', url, e)
+                self.outbox.failed(ids, e)
+                metrics.increment('webhooks.failed', len(ids))
+                continue
+            self.outbox.delivered(ids)
+            metrics.increment('webhooks.delivered', len(ids))
@@ -0,0 +1,58 @@
+"""Tests for the in-memory caches."""
+
+from unittest.mock import patch
+
+from metrics import metrics
+from src.cache import TTLCache
+
+
+def test_ttl_cache():
+    """Test storing and retrieving values."""
+    cache = TTLCache("test-basic", max_bytes=100)
+    assert cache.get("a") is None
+    assert cache.get("a", "default") == "default"
+    assert cache.set("a", {"value": 1}, 10)
+    assert cache.get("a") == {"value": 1}
+    assert cache.age("a") >= 0
+    assert cache.age("b") is None
+    assert len(cache) == 1
+
+    cache.delete("a")
+    assert cache.get("a") is None
+    assert metrics.get("cache.test-basic.hits") == 1
+    assert metrics.get("cache.test-basic.misses") == 3
+    assert metrics.get("cache.test-basic.hit_ratio") == 0.25
+
+
+def test_ttl_cache_size_limits():
+    """Test that the cache is bounded by the size of its entries."""
+    cache = TTLCache("test-size", max_bytes=100, max_entry_bytes=50)
+    assert not cache.set("big", "x", 60)
+    assert cache.get("big") is None
+
+    cache.set("a", "a", 40)
+    cache.set("b", "b", 40)
+    # make "a" the most recently used entry, "b" gets evicted then
+    cache.get("a")
+    cache.set("c", "c", 40)
+    assert cache.get("a") == "a"
+    assert cache.get("b") is None
+    assert cache.get("c") == "c"
+
+    # replacing the entry does not count its old size
+    cache.set("c", "c", 50)
+    assert cache.get("a") == "a"
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_ttl_cache_expiry():
+    """Test that entries expire."""
+    cache = TTLCache("test-expiry", ttl=10)
+    with patch("src.cache.time.time", return_value=1000):
+        cache.set("a", "a", 1)
+    with patch("src.cache.time.time", return_value=1005):
+        assert cache.get("a") == "a"
+    with patch("src.cache.time.time", return_value=1010):
+        assert cache.get("a") is None
+    assert len(cache) == 0
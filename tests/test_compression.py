@@ -0,0 +1,85 @@
+"""Tests for the response compression."""
+
+import gzip
+from unittest.mock import patch
+
+import flask
+import pytest
+from werkzeug.datastructures import Accept
+
+from src.compression import compress_response, choose_encoding, gunzip, gunzip_chunks, \
+    is_gzip
+
+
+def _accept(*encodings):
+    """Create parsed Accept-Encoding header."""
+    return Accept(encodings)
+
+
+def test_choose_encoding():
+    """Test negotiation of the content encoding."""
+    assert choose_encoding(_accept()) is None
+    assert choose_encoding(_accept(('gzip', 1))) == 'gzip'
+    assert choose_encoding(_accept(('gzip', 1), ('br', 0.5))) == 'gzip'
+    assert choose_encoding(_accept(('gzip', 0), ('identity', 1))) is None
+    with patch('src.compression.brotli', None):
+        assert choose_encoding(_accept(('br', 1))) is None
+
+
+def test_gunzip():
+    """Test transparent decompression of gzip compressed content."""
+    content = b'{"a": 1}'
+    compressed = gzip.compress(content)
+    assert is_gzip(compressed)
+    assert gunzip(compressed) == content
+    assert gunzip(content) == content
+    assert b''.join(gunzip_chunks([compressed[:5], compressed[5:]])) == content
+    assert b''.join(gunzip_chunks([content[:2], content[2:]])) == content
+    assert b''.join(gunzip_chunks([])) == b''
+
+
+@patch('src.compression.COMPRESS_MIN_SIZE', 10)
+def test_compress_response():
+    """Test compression of the responses above the threshold."""
+    data = b'{"data": "' + b'x' * 100 + b'"}'
+    response = compress_response(flask.Response(data, mimetype='application/json'),
+                                 _accept(('gzip', 1)))
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert int(response.headers['Content-Length']) < len(data)
+    assert gzip.decompress(response.get_data()) == data
+
+    # small, binary and already encoded responses and clients not accepting compression
+    for response, accept in ((flask.Response(b'{}', mimetype='application/json'),
+                              _accept(('gzip', 1))),
+                             (flask.Response(data, mimetype='application/json'), _accept()),
+                             (flask.Response(data, mimetype='image/png'), _accept(('gzip', 1))),
+                             (flask.Response(data, mimetype='application/json',
+                                             headers={'Content-Encoding': 'gzip'}),
+                              _accept(('gzip', 1)))):
+        original = response.get_data()
+        response = compress_response(response, accept)
+        assert response.headers.get('Content-Encoding') in (None, 'gzip')
+        assert response.get_data() == original
+
+
+@patch('src.compression.COMPRESS_MIN_SIZE', 10)
+def test_compress_response_brotli():
+    """Test brotli compression preferred when it is available."""
+    brotli = pytest.importorskip('brotli')
+    data = b'{"data": "' + b'x' * 100 + b'"}'
+    assert choose_encoding(_accept(('gzip', 1), ('br', 1))) == 'br'
+    response = compress_response(flask.Response(data, mimetype='application/json'),
+                                 _accept(('br', 1)))
+    assert response.headers['Content-Encoding'] == 'br'
+    assert brotli.decompress(response.get_data()) == data
+
+
+def test_compress_streamed_response():
+    """Test on the fly compression of the streamed responses."""
+    chunks = [b'{"data": ', b'"x"}']
+    response = compress_response(flask.Response(iter(chunks), mimetype='application/json'),
+                                 _accept(('gzip', 1)))
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in response.headers
+    assert gzip.decompress(b''.join(response.response)) == b''.join(chunks)
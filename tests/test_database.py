@@ -0,0 +1,228 @@
+"""Tests for the Postgres sessions, replicas and worker results."""
+
+import threading
+from unittest.mock import patch, MagicMock
+
+import psycopg2
+import pytest
+from sqlalchemy.exc import SQLAlchemyError
+
+from rest_api import app
+from src.database import get_session, retrieve_worker_result, retrieve_worker_results, \
+    get_first_query_result, remove_sessions, Postgres, PostgresPassThrough, ReplicaRouter
+
+
+ppt = PostgresPassThrough()
+
+
+def test_get_session():
+    """Test the function get_session."""
+    session = get_session()
+    assert session is not None
+
+
+@patch("src.database.query_worker_result", side_effect=SQLAlchemyError())
+def test_retrieve_worker_result(_query):
+    """Test the function retrieve_worker_result."""
+    with pytest.raises(SQLAlchemyError):
+        retrieve_worker_result("test", "test")
+
+
+@patch("src.database.query_worker_result", return_value=None)
+@patch("src.database.get_first_query_result", return_value=None)
+def test_retrieve_worker_result_1(_a, _b):
+    """Test the function retrieve_worker_result."""
+    response = retrieve_worker_result("test", "test")
+    assert response is None
+
+
+@patch("src.database.query_worker_result", return_value=None)
+@patch("src.database.get_first_query_result", **{"return_value.to_dict.return_value": 1})
+@patch("src.database.get_first_query_result", return_value={"test": "test"})
+def test_retrieve_worker_result_2(_a, _b, _c):
+    """Test the function retrieve_worker_result."""
+    with app.app_context():
+        response = retrieve_worker_result("test", "test")
+        assert response == 1
+
+
+class WorkerResultMock:
+    """Mocks a row of worker_results table."""
+
+    def __init__(self, external_request_id, ended_at):
+        """Initialize the object."""
+        self.external_request_id = external_request_id
+        self.ended_at = ended_at
+
+    def to_dict(self):
+        """Return dict representation of the row."""
+        return {"external_request_id": self.external_request_id, "ended_at": self.ended_at}
+
+
+@patch("src.database.query_worker_results")
+def test_retrieve_worker_results(query):
+    """Test the function retrieve_worker_results."""
+    assert retrieve_worker_results([], "test") == {}
+    query.assert_not_called()
+
+    query.return_value = [WorkerResultMock("a", 2), WorkerResultMock("b", 1),
+                          WorkerResultMock("a", 1)]
+    response = retrieve_worker_results(["a", "b", "a"], "test")
+    assert response == {"a": {"external_request_id": "a", "ended_at": 2},
+                        "b": {"external_request_id": "b", "ended_at": 1}}
+    assert sorted(query.call_args[0][1]) == ["a", "b"]
+
+    query.side_effect = SQLAlchemyError()
+    with pytest.raises(SQLAlchemyError):
+        retrieve_worker_results(["a"], "test")
+
+
+def test_get_session_read_only():
+    """Test the function get_session falls back to primary without replicas."""
+    assert get_session(read_only=True) is get_session()
+
+
+def test_replica_router():
+    """Test routing to healthy replicas."""
+    router = ReplicaRouter(None)
+    assert router.replicas == []
+    assert router.pick() is None
+
+    router = ReplicaRouter("replica-1:5433, replica-2", check_interval=60)
+    assert router.replicas == [("replica-1", "5433"), ("replica-2", "5432")]
+    with patch.object(ReplicaRouter, "check_lag", side_effect=[True, False]) as check_lag:
+        assert router.pick() == ("replica-1", "5433")
+        # replica-2 lags behind, replica-1 is healthy and its state is cached
+        assert router.pick() == ("replica-1", "5433")
+        assert router.pick() == ("replica-1", "5433")
+        assert check_lag.call_count == 2
+        router.mark_unhealthy(("replica-1", "5433"))
+        assert router.pick() is None
+
+
+@patch("src.database.psycopg2.connect")
+def test_replica_router_check_lag(connect):
+    """Test the replication lag check."""
+    router = ReplicaRouter("replica", max_lag_seconds=10)
+    cursor = connect.return_value.cursor.return_value
+    cursor.fetchone.return_value = (1.5,)
+    assert router.check_lag(("replica", "5432")) is True
+    cursor.fetchone.return_value = (20,)
+    assert router.check_lag(("replica", "5432")) is False
+    connect.side_effect = psycopg2.OperationalError()
+    assert router.check_lag(("replica", "5432")) is False
+
+
+@patch("src.database.psycopg2.connect")
+def test_fetch_records_replica_fallback(connect):
+    """Test that the pass through falls back to primary if replica is not reachable."""
+    primary = MagicMock()
+    connect.side_effect = [psycopg2.OperationalError(), primary]
+    replicas = ReplicaRouter("replica")
+    with patch("src.database._replicas", replicas), \
+            patch.object(ReplicaRouter, "check_lag", return_value=True):
+        assert ppt.connect() is primary
+        assert replicas.pick() is None
+
+
+class QueryResultMock():
+    """Class that mocks QueryResult class."""
+
+    def __init__(self):
+        """Initialize the mocked QueryResult class."""
+        self.first_called = False
+
+    def first(self):
+        """Implement the tested method with tracepoint variable."""
+        self.first_called = True
+        return "X"
+
+    def get_first_called(self):
+        """Return the actual state of tracepoint variable."""
+        return self.first_called
+
+
+def test_get_first_query_result():
+    """Test the function get_first_query_result()."""
+    query_result_mock = QueryResultMock()
+    # make sure the first() was not called
+    assert not query_result_mock.get_first_called()
+
+    # this is a value returned by mocked class
+    assert get_first_query_result(query_result_mock) == "X"
+
+    # now first() was called, so check it
+    assert query_result_mock.get_first_called()
+
+
+def test_fetch_records():
+    """Test the PostgresPassThrough fetch records module."""
+    query = "select id from worker_results limit 1;"
+    resp = ppt.fetch_records(data={}, client_validated=False)
+    assert resp['warning'] == 'Invalid payload. Check your payload once again'
+    resp = ppt.fetch_records(data={'query': {'query': ''}}, client_validated=False)
+    assert resp['error'] is not None
+    resp = ppt.fetch_records(data={'query': 'delete all from some_table;'}, client_validated=False)
+    assert resp['error'] is not None
+    data = {'query': query}
+    resp = ppt.fetch_records(data, client_validated=False)
+    assert resp is not None
+
+
+def _explain_result(cost, rows):
+    """Build result of EXPLAIN (FORMAT JSON) as returned by psycopg2."""
+    return [[{"Plan": {"Node Type": "Seq Scan", "Total Cost": cost, "Plan Rows": rows}}]]
+
+
+@patch("src.database.PGSQL_EXPLAIN_GUARD", True)
+@patch("src.database.psycopg2.connect")
+def test_fetch_records_cost_guard(connect):
+    """Test that the pass through rejects queries over the budget."""
+    cursor = connect.return_value.cursor.return_value
+    cursor.fetchone.return_value = _explain_result(10, 5)
+    cursor.fetchmany.return_value = [("id", 1)]
+    resp = ppt.fetch_records({'query': 'select id from worker_results;'},
+                             client_validated=False)
+    assert resp == {'data': [("id", 1)]}
+    executed = [c[0][0] for c in cursor.execute.call_args_list]
+    assert executed == ["SET LOCAL statement_timeout = %s",
+                        "EXPLAIN (FORMAT JSON) select id from worker_results",
+                        "select id from worker_results;"]
+
+    cursor.fetchone.return_value = _explain_result(10 ** 9, 10 ** 8)
+    resp = ppt.fetch_records({'query': 'select * from worker_results'},
+                             client_validated=True)
+    assert resp['estimate'] == {'cost': 10 ** 9, 'rows': 10 ** 8}
+    assert resp['error']
+    cursor.fetchall.assert_not_called()
+
+    resp = ppt.fetch_records({'query': 'select 1; select 2'}, client_validated=True)
+    assert resp == {'error': 'Only a single select query is supported'}
+
+
+def test_postgres_session_per_thread():
+    """Test that every thread gets its own database session."""
+    database = Postgres()
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(database.session()))
+    thread.start()
+    thread.join()
+    assert database.session() is database.session()
+    assert sessions[0] is not database.session()
+
+
+def test_remove_sessions():
+    """Test that the sessions of the primary and of the replicas are ended."""
+    primary = MagicMock(created=True)
+    replica = MagicMock()
+    replicas = ReplicaRouter("replica")
+    replicas._databases[("replica", "5432")] = replica
+    with patch("src.database._rdb", primary), patch("src.database._replicas", replicas):
+        remove_sessions()
+    primary.session.remove.assert_called_once_with()
+    replica.session.remove.assert_called_once_with()
+
+    primary = MagicMock(created=False)
+    with patch("src.database._rdb", primary):
+        remove_sessions()
+    primary.session.remove.assert_not_called()
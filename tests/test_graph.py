@@ -0,0 +1,188 @@
+"""Tests for the graph database pass-through."""
+
+import json
+from unittest.mock import patch
+
+import pytest
+import requests
+
+from src.graph import GraphPassThrough, is_plain_traversal, encode_cursor, decode_cursor
+
+
+gpt = GraphPassThrough()
+
+
+graph_resp = {
+    "requestId": "5cc29849-8e9b-4b66-90d0-f2569dc962b9",
+    "status": {
+        "message": "",
+        "code": 200,
+        "attributes": {}
+    },
+    "result": {
+        "data": [],
+        "meta": {}
+    }
+}
+
+
+@patch("src.graph.GREMLIN_CACHE_TTL", 0)
+@patch("src.graph.requests.post", return_value=graph_resp)
+def test_fetch_nodes(_mock1):
+    """Test the GraphPassThrough fetch nodes module."""
+    resp = gpt.fetch_nodes(data={})
+    assert resp['warning'] == 'Invalid payload. Check your payload once again'
+    resp = gpt.fetch_nodes(data={"query": "g.V().has('foo','bar').drop()')"})
+    assert resp['error'] is not None
+    query = "g.V().has('name','foo').valueMap();"
+    resp = gpt.fetch_nodes(data={'query': query})
+    assert resp is not None
+
+
+class GremlinResponseMock:
+    """Mocks response of the Gremlin server."""
+
+    def __init__(self, json_data, status_code=200):
+        """Initialize the object."""
+        self.json_data = json_data
+        self.status_code = status_code
+        self.content = json.dumps(json_data).encode()
+
+    def json(self):
+        """Return json representation of data."""
+        return self.json_data
+
+
+@patch("src.graph.requests.post", return_value=GremlinResponseMock(graph_resp))
+def test_fetch_nodes_cache(post):
+    """Test that the GraphPassThrough caches results of the same query."""
+    graph = GraphPassThrough()
+    query = "g.V().has('name','foo')\n   .valueMap();"
+    expected = {'data': graph_resp, 'truncated': False, 'next_cursor': None}
+    assert graph.fetch_nodes({'query': query}) == expected
+    resp = graph.fetch_nodes({'query': "  g.V().has('name','foo')\n.valueMap();"})
+    assert resp == expected
+    assert post.call_count == 1
+
+    assert graph.fetch_nodes({'query': query}, use_cache=False) == expected
+    assert post.call_count == 2
+
+    post.return_value = GremlinResponseMock({'error': 'timeout'}, status_code=500)
+    graph.cache.clear()
+    graph.fetch_nodes({'query': query})
+    graph.fetch_nodes({'query': query})
+    assert post.call_count == 4
+
+
+def test_is_plain_traversal():
+    """Test the function is_plain_traversal."""
+    assert is_plain_traversal("g.V().has('ecosystem','npm')")
+    assert is_plain_traversal("g.V().has('ecosystem','npm').valueMap()")
+    assert not is_plain_traversal("g.V().has('ecosystem','npm').limit(5)")
+    assert not is_plain_traversal("g.V().count()")
+    assert not is_plain_traversal("g.V().toList()")
+    assert not is_plain_traversal("repo=g.V().next();g.V(repo)")
+    assert not is_plain_traversal("graph.addVertex('name', 'x')")
+
+
+def test_cursor():
+    """Test encoding and decoding of the cursors."""
+    assert decode_cursor(encode_cursor(200)) == 200
+    for cursor in ("garbage", encode_cursor(-1), encode_cursor("1")):
+        with pytest.raises(ValueError):
+            decode_cursor(cursor)
+
+
+@patch("src.graph.GREMLIN_MAX_RESULTS", 100)
+@patch("src.graph.requests.post")
+def test_fetch_nodes_bounded(post):
+    """Test that unbounded traversals get limited."""
+    post.return_value = GremlinResponseMock(graph_resp)
+    graph = GraphPassThrough()
+    graph.fetch_nodes({'query': "g.V().has('ecosystem','npm');"}, use_cache=False)
+    assert post.call_args[1]['json'] == {'gremlin': "g.V().has('ecosystem','npm').limit(100)"}
+    graph.fetch_nodes({'query': "g.V().has('ecosystem','npm').count()"}, use_cache=False)
+    assert post.call_args[1]['json'] == {'gremlin': "g.V().has('ecosystem','npm').count()"}
+
+
+@patch("src.graph.GREMLIN_MAX_RESULTS", 2)
+@patch("src.graph.requests.post")
+def test_fetch_nodes_truncated(post):
+    """Test that limited results are marked as truncated with the cursor of the rest."""
+    post.return_value = GremlinResponseMock({"result": {"data": [1, 2]}})
+    graph = GraphPassThrough()
+    query = "g.V().has('ecosystem','npm')"
+    resp = graph.fetch_nodes({'query': query}, use_cache=False)
+    assert resp['truncated'] is True
+    assert decode_cursor(resp['next_cursor']) == 2
+
+    resp = graph.fetch_nodes({'query': query, 'cursor': resp['next_cursor']}, use_cache=False)
+    assert post.call_args[1]['json'] == {'gremlin': query + ".range(2, 4)"}
+
+    resp = graph.fetch_nodes({'query': query + ".count()"}, use_cache=False)
+    assert 'truncated' not in resp
+    assert graph.limits_results(query)
+    assert not graph.limits_results(query + ".count()")
+    assert not graph.limits_results("g.V().drop()")
+
+
+@patch("src.graph.GREMLIN_MAX_RESULTS", 100)
+@patch("src.graph.requests.post")
+def test_fetch_nodes_paginated(post):
+    """Test paginated traversals."""
+    page = {"result": {"data": [1, 2]}}
+    post.return_value = GremlinResponseMock(page)
+    graph = GraphPassThrough()
+    query = "g.V().has('ecosystem','npm')"
+    resp = graph.fetch_nodes({'query': query, 'page_size': 2}, use_cache=False)
+    assert post.call_args[1]['json'] == {'gremlin': query + ".range(0, 2)"}
+    assert resp['data'] == page
+    assert decode_cursor(resp['next_cursor']) == 2
+
+    post.return_value = GremlinResponseMock({"result": {"data": [3]}})
+    resp = graph.fetch_nodes({'query': query, 'page_size': 2, 'cursor': resp['next_cursor']},
+                             use_cache=False)
+    assert post.call_args[1]['json'] == {'gremlin': query + ".range(2, 4)"}
+    assert resp['next_cursor'] is None
+
+    resp = graph.fetch_nodes({'query': query, 'page_size': 500}, use_cache=False)
+    assert post.call_args[1]['json'] == {'gremlin': query + ".range(0, 100)"}
+
+    resp = graph.fetch_nodes({'query': query + ".limit(5)", 'page_size': 2})
+    assert 'error' in resp
+    resp = graph.fetch_nodes({'query': query, 'cursor': 'garbage'})
+    assert resp == {'error': 'Invalid cursor'}
+
+
+@patch("src.graph.requests.post")
+def test_stream_nodes(post):
+    """Test that the raw Gremlin response is passed through."""
+    gpt.cache.clear()
+    post.return_value.status_code = 200
+    post.return_value.iter_content.return_value = [b'{"result": ', b'{"data": []}}']
+    stream = gpt.stream_nodes({'query': "g.V().has('name','foo')"})
+    assert json.loads(b''.join(stream)) == {'data': {'result': {'data': []}}}
+    post.return_value.close.assert_called_once()
+    assert post.call_args[1]['stream'] is True
+    assert post.call_args[1]['timeout'] > 0
+
+    # the streamed bytes are served from cache unless it is bypassed
+    stream = gpt.stream_nodes({'query': "g.V().has('name','foo')"})
+    assert json.loads(b''.join(stream)) == {'data': {'result': {'data': []}}}
+    assert post.call_count == 1
+    b''.join(gpt.stream_nodes({'query': "g.V().has('name','foo')"}, use_cache=False))
+    assert post.call_count == 2
+
+    with pytest.raises(ValueError):
+        gpt.stream_nodes({'query': "g.V().drop()"})
+
+
+@patch("src.graph.requests.post")
+def test_stream_nodes_upstream_error(post):
+    """Test that error responses of Gremlin are not passed through as data."""
+    gpt.cache.clear()
+    post.return_value.status_code = 500
+    with pytest.raises(requests.exceptions.HTTPError):
+        gpt.stream_nodes({'query': "g.V().has('name','bar')"})
+    post.return_value.close.assert_called_once()
+    post.return_value.iter_content.assert_not_called()
@@ -0,0 +1,53 @@
+"""Tests for the graph pass-through endpoint."""
+
+import json
+from unittest.mock import patch
+
+import requests
+
+from tests.test_rest_api import api_route_for, get_json_from_response, graph_response
+
+
+@patch('src.rest_api.GraphPassThrough.fetch_nodes',
+       return_value=graph_response)
+def test_graph_endpoint_cache_bypass(fetch_nodes, client):
+    """Test the /api/v1/graph endpoint passes the Cache-Control header through."""
+    query = {"query": "g.V().count()"}
+    client.post(api_route_for('graph'), data=json.dumps(query),
+                content_type='application/json')
+    fetch_nodes.assert_called_with(query, use_cache=True)
+    client.post(api_route_for('graph'), data=json.dumps(query),
+                content_type='application/json', headers={'Cache-Control': 'no-cache'})
+    fetch_nodes.assert_called_with(query, use_cache=False)
+
+
+@patch('src.rest_api.STREAM_UPSTREAM_RESPONSES', True)
+@patch('src.rest_api.GraphPassThrough.stream_nodes', return_value=iter([b'{"data": {}}']))
+def test_graph_endpoint_stream(stream_nodes, client):
+    """Test the /api/v1/graph endpoint streams the raw Gremlin response."""
+    resp = client.post(api_route_for('graph'), data=json.dumps({"query": "g.V().count()"}),
+                       content_type='application/json')
+    assert resp.status_code == 200
+    assert get_json_from_response(resp) == {"data": {}}
+    stream_nodes.side_effect = ValueError("Only select queries are supported")
+    resp = client.post(api_route_for('graph'), data=json.dumps({"query": "g.V().drop()"}),
+                       content_type='application/json')
+    assert get_json_from_response(resp) == {"error": "Only select queries are supported"}
+
+    stream_nodes.side_effect = requests.exceptions.HTTPError("Graph database responded with "
+                                                             "status 500")
+    resp = client.post(api_route_for('graph'), data=json.dumps({"query": "g.V().count()"}),
+                       content_type='application/json', headers={'Cache-Control': 'no-cache'})
+    assert resp.status_code == 502
+    stream_nodes.assert_called_with({"query": "g.V().count()"}, use_cache=False)
+
+
+@patch('src.rest_api.STREAM_UPSTREAM_RESPONSES', True)
+@patch('src.rest_api.GraphPassThrough.stream_nodes')
+@patch('src.rest_api.GraphPassThrough.fetch_nodes', return_value=graph_response)
+def test_graph_endpoint_stream_limited(fetch_nodes, stream_nodes, client):
+    """Test the /api/v1/graph endpoint decodes the limited results to mark their truncation."""
+    client.post(api_route_for('graph'), data=json.dumps({"query": "g.V()"}),
+                content_type='application/json')
+    stream_nodes.assert_not_called()
+    fetch_nodes.assert_called_with({"query": "g.V()"}, use_cache=True)
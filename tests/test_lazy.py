@@ -0,0 +1,65 @@
+"""Tests for the backend clients created on first use."""
+
+from unittest.mock import MagicMock
+
+import pytest
+
+from metrics import metrics
+from src.lazy import Lazy, warm_up
+
+
+class Client:
+    """Backend client used by the tests."""
+
+    def __init__(self, url):
+        """Initialize the client."""
+        self.url = url
+
+    def fetch(self):
+        """Fetch some data."""
+        return 'data from {}'.format(self.url)
+
+    def get(self, key):
+        """Get some data by key."""
+        return '{} from {}'.format(key, self.url)
+
+
+def test_lazy():
+    """Test that the client is created on first use only."""
+    factory = MagicMock(side_effect=Client)
+    client = Lazy('test-client', factory, 'http://localhost')
+    assert not client.created
+    factory.assert_not_called()
+
+    assert client.fetch() == 'data from http://localhost'
+    assert client.url == 'http://localhost'
+    assert client.get('key') == 'key from http://localhost'
+    assert client.created
+    assert client.instance() is client.instance()
+    factory.assert_called_once_with('http://localhost')
+    assert metrics.get('startup.test-client.init_seconds') >= 0
+
+    client.url = 'http://remote'
+    assert client.instance().url == 'http://remote'
+    del client.url
+    assert not hasattr(client.instance(), 'url')
+
+
+def test_lazy_failure():
+    """Test that a failed creation is retried on the next use."""
+    factory = MagicMock(side_effect=[ValueError('not configured'), Client('http://localhost')])
+    client = Lazy('test-failing-client', factory)
+    with pytest.raises(ValueError):
+        client.fetch()
+    assert not client.created
+    assert client.fetch() == 'data from http://localhost'
+
+
+def test_warm_up():
+    """Test that the clients are created in the background."""
+    failing = Lazy('test-warm-up-failing', MagicMock(side_effect=ValueError('not configured')))
+    client = Lazy('test-warm-up', Client, 'http://localhost')
+    warm_up(failing, client).join()
+    assert client.created
+    assert not failing.created
+    assert metrics.get('startup.warm_up_seconds') >= 0
@@ -0,0 +1,22 @@
+"""Tests for the in-process metrics registry."""
+
+from src.metrics import Metrics
+
+
+def test_metrics():
+    """Test counters and gauges of the metrics registry."""
+    metrics = Metrics()
+    assert metrics.get("missing") == 0
+    metrics.increment("counter")
+    metrics.increment("counter", 2)
+    metrics.set_gauge("gauge", 0.5)
+    assert metrics.get("counter") == 3
+    assert metrics.get("gauge") == 0.5
+
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"] == {"counter": 3}
+    assert snapshot["gauges"] == {"gauge": 0.5}
+    assert snapshot["pid"]
+
+    metrics.reset()
+    assert metrics.snapshot()["counters"] == {}
@@ -0,0 +1,140 @@
+"""Tests for the durable outbox."""
+
+import os
+from unittest.mock import patch
+
+from src.outbox import Outbox, Drainer, OUTBOX_PATH
+
+
+def _outbox(tmp_path, **kwargs):
+    return Outbox(str(tmp_path / 'outbox.sqlite'), 'test', **kwargs)
+
+
+def test_put_claim(tmp_path):
+    """Test that claimed messages are not claimed again until the lease expires."""
+    outbox = _outbox(tmp_path)
+    first = outbox.put('http://a', {'n': 1})
+    outbox.put('http://b', {'n': 2})
+    outbox.put('http://c', {'n': 3}, delay=60)
+
+    messages = outbox.claim(10)
+    assert [(m.id, m.destination, m.payload) for m in messages][0] == \
+        (first, 'http://a', {'n': 1})
+    assert len(messages) == 2
+    assert outbox.claim(10) == []
+
+    # other topics of the same database are independent
+    assert Outbox(outbox.engine, 'other').claim(10) == []
+
+
+def test_lease_expiry(tmp_path):
+    """Test that messages of a crashed drainer are claimed again."""
+    outbox = _outbox(tmp_path, lease=0)
+    outbox.put('http://a', {})
+    assert len(outbox.claim(10)) == 1
+    assert len(outbox.claim(10)) == 1
+
+
+def test_delivered_defer(tmp_path):
+    """Test delivered and deferred messages."""
+    outbox = _outbox(tmp_path)
+    first = outbox.put('http://a', {})
+    second = outbox.put('http://a', {})
+    outbox.claim(10)
+    outbox.delivered([first])
+    outbox.defer([second], 0)
+    messages = outbox.claim(10)
+    assert [m.id for m in messages] == [second]
+    assert messages[0].attempts == 0
+    assert outbox.counts() == {'delivered': 1, 'pending': 1}
+
+
+def test_failed_backoff_dead_letter(tmp_path):
+    """Test retries with backoff and dead-lettering after the last attempt."""
+    outbox = _outbox(tmp_path, max_attempts=3, base_delay=10)
+    message_id = outbox.put('http://a', {})
+    with patch('src.outbox.time.time', return_value=1000.0):
+        outbox.claim(10)
+        outbox.failed([message_id], 'boom')
+        assert outbox.claim(10) == []
+    with patch('src.outbox.time.time', return_value=1010.0):
+        assert len(outbox.claim(10)) == 1
+        outbox.failed([message_id], 'boom')
+    with patch('src.outbox.time.time', return_value=1029.0):
+        assert outbox.claim(10) == []
+    with patch('src.outbox.time.time', return_value=1030.0):
+        assert outbox.claim(10)[0].attempts == 2
+        outbox.failed([message_id], 'boom again')
+
+    assert outbox.counts() == {'dead': 1}
+    [(message, error)] = outbox.dead_letters()
+    assert message.id == message_id
+    assert error == 'boom again'
+
+
+def test_dead_letter_purge(tmp_path):
+    """Test giving up messages and purging the delivered ones."""
+    outbox = _outbox(tmp_path, keep_delivered=0)
+    first = outbox.put('http://a', {})
+    second = outbox.put('http://a', {})
+    outbox.dead_letter([first], 'too late')
+    outbox.delivered([second])
+    outbox.purge()
+    assert outbox.counts() == {'dead': 1}
+
+
+def test_drain(tmp_path):
+    """Test that the drainer hands the messages over in batches."""
+    outbox = _outbox(tmp_path)
+    for n in range(5):
+        outbox.put('http://a', {'n': n})
+    batches = []
+
+    def handler(messages):
+        batches.append([m.payload['n'] for m in messages])
+        outbox.delivered([m.id for m in messages])
+
+    assert Drainer(outbox, handler, batch_size=2).drain() == 5
+    assert batches == [[0, 1], [2, 3], [4]]
+
+
+def test_drain_handler_error(tmp_path):
+    """Test that messages count as failed when the handler raises."""
+    outbox = _outbox(tmp_path)
+    outbox.put('http://a', {})
+
+    def handler(messages):
+        raise ValueError('boom')
+
+    assert Drainer(outbox, handler).drain() == 1
+    assert outbox.counts() == {'pending': 1}
+    assert outbox.claim(10) == []
+
+
+def test_put_merge(tmp_path):
+    """Test merging messages for the same destination that wait for the first attempt."""
+    outbox = _outbox(tmp_path, base_delay=0)
+
+    def merge(payload, other):
+        return {'n': payload['n'] + other['n']}
+
+    first = outbox.put('http://a', {'n': 1}, merge=merge)
+    assert outbox.put('http://a', {'n': 2}, merge=merge) == first
+    assert outbox.put('http://b', {'n': 4}, merge=merge) != first
+    # without merge the message is stored on its own
+    outbox.put('http://a', {'n': 8})
+    messages = outbox.claim(10)
+    assert [(m.destination, m.payload['n']) for m in messages] == \
+        [('http://a', 3), ('http://b', 4), ('http://a', 8)]
+
+    # no merging into messages that are being delivered or have failed
+    latest = outbox.put('http://a', {'n': 16}, merge=merge)
+    assert latest not in [m.id for m in messages]
+    outbox.failed([first], 'boom')
+    assert outbox.put('http://a', {'n': 32}, merge=merge) == latest
+    assert outbox.counts() == {'pending': 4}
+
+
+def test_default_path():
+    """Test that the default database is in a directory the server can write to."""
+    assert os.access(os.path.dirname(OUTBOX_PATH), os.W_OK)
@@ -0,0 +1,68 @@
+"""Tests for the sampled and size capped payload logging."""
+
+import logging
+from unittest.mock import patch
+
+from src.payload_logging import CappedPayload, log_payload, parse_module_config, \
+    payload_settings
+
+
+def test_capped_payload():
+    """Test that the payload is cut after the max size."""
+    assert str(CappedPayload({"a": 1}, 100)) == '{"a": 1}'
+    assert str(CappedPayload({"a": "x" * 1000}, 10)) == '{"a": "xxx... (10 characters shown)'
+
+
+def test_capped_payload_lazy():
+    """Test that the payload is serialized only when it is formatted."""
+    class Payload:
+        def __repr__(self):
+            raise AssertionError("serialized")
+
+    CappedPayload(Payload(), 10)
+
+
+def test_parse_module_config():
+    """Test parsing of the per module settings."""
+    assert parse_module_config("") == {}
+    assert parse_module_config("utils=0.5:100, notification=0:0") == {
+        "utils": (0.5, 100), "notification": (0.0, 0)}
+
+
+@patch("src.payload_logging.PAYLOAD_LOG_MODULES", {"a": (0.5, 10), "a.b": (1.0, 20)})
+def test_payload_settings():
+    """Test that the longest matching logger name applies."""
+    assert payload_settings("a") == (0.5, 10)
+    assert payload_settings("a.c") == (0.5, 10)
+    assert payload_settings("a.b.c") == (1.0, 20)
+    with patch("src.payload_logging.PAYLOAD_LOG_SAMPLE_RATE", 0.1), \
+            patch("src.payload_logging.PAYLOAD_LOG_MAX_SIZE", 30):
+        assert payload_settings("ab") == (0.1, 30)
+
+
+@patch("src.payload_logging.PAYLOAD_LOG_MODULES",
+       {"payload.all": (1.0, 8), "payload.none": (0.0, 8)})
+def test_log_payload(caplog):
+    """Test that the payloads are logged as configured."""
+    caplog.set_level(logging.DEBUG)
+    log_payload(logging.getLogger("payload.all"), logging.DEBUG, "Payload %s", ["x" * 20])
+    log_payload(logging.getLogger("payload.none"), logging.DEBUG, "Payload %s", ["y"])
+    assert caplog.messages == ['Payload ["xxxxxx... (8 characters shown)']
+
+    caplog.clear()
+    caplog.set_level(logging.INFO)
+    log_payload(logging.getLogger("payload.all"), logging.DEBUG, "Payload %s", ["x"])
+    assert caplog.messages == []
+
+
+@patch("src.payload_logging.PAYLOAD_LOG_MODULES", {"payload.sampled": (0.25, 100)})
+@patch("src.payload_logging.random.random")
+def test_log_payload_sampled(random, caplog):
+    """Test that only the sampled payloads are logged."""
+    caplog.set_level(logging.DEBUG)
+    logger = logging.getLogger("payload.sampled")
+    random.return_value = 0.3
+    log_payload(logger, logging.DEBUG, "Payload %s", 1)
+    random.return_value = 0.2
+    log_payload(logger, logging.DEBUG, "Payload %s", 2)
+    assert caplog.messages == ["Payload 2"]
@@ -0,0 +1,191 @@
+"""Tests for the repository registration and flow status endpoints."""
+
+import json
+from unittest.mock import MagicMock, patch
+
+from utils import DatabaseIngestion
+from tests.test_rest_api import api_route_for, get_json_from_response, payload, payload_1
+
+
+@patch.object(DatabaseIngestion, "get_info")
+@patch.object(DatabaseIngestion, "update_data")
+@patch("src.rest_api.retrieve_worker_result")
+@patch("src.rest_api.scan_repo")
+def test_register_endpoint_7(scan_repo, retrieve_worker_result, update_data, get_info,
+                             client):
+    """Test the /api/v1/register endpoint skips scans of already scanned commits."""
+    get_info.return_value = {
+        "is_valid": True,
+        "data": {
+            "git_sha": "somesha",
+            "last_scanned_at": "1"
+        }
+    }
+    retrieve_worker_result.return_value = {"task_result": {"scanned_at": "2"}}
+    scan_repo.return_value = True
+    reg_resp = client.post(api_route_for('register'),
+                           data=json.dumps(payload),
+                           content_type='application/json')
+    assert reg_resp.status_code == 200
+    reg_resp_json = get_json_from_response(reg_resp)
+    assert reg_resp_json["last_scan_report"] == {
+        "git_sha": "somesha",
+        "scanned_at": "2",
+        "lock_file_absent": False
+    }
+    scan_repo.assert_not_called()
+    update_data.assert_not_called()
+
+    reg_resp = client.post(api_route_for('register'),
+                           data=json.dumps(dict(payload, force=True)),
+                           content_type='application/json')
+    assert reg_resp.status_code == 200
+    reg_resp_json = get_json_from_response(reg_resp)
+    assert reg_resp_json["summary"] == "Repository test with commit-hash somesha is being " \
+        "scanned again as requested. Please check back later for the new report."
+    # the forced scan keeps the last report available
+    assert reg_resp_json["last_scan_report"]["scanned_at"] == "2"
+    scan_repo.assert_called_once()
+
+    retrieve_worker_result.return_value = None
+    reg_resp = client.post(api_route_for('register'),
+                           data=json.dumps(payload),
+                           content_type='application/json')
+    reg_resp_json = get_json_from_response(reg_resp)
+    assert reg_resp_json["last_scan_report"] is None
+    assert "no report for commit-hash somesha was found" in reg_resp_json["summary"]
+    assert scan_repo.call_count == 2
+
+    metrics_resp = client.get(api_route_for('metrics'))
+    counters = get_json_from_response(metrics_resp)["counters"]
+    assert counters["register.rescan_skipped"] >= 1
+    assert counters["register.rescan_dispatched"] >= 1
+
+
+@patch.object(DatabaseIngestion, "get_info")
+@patch.object(DatabaseIngestion, "store_record")
+@patch("src.rest_api.scan_repo")
+def test_register_endpoint_callback(scan_repo, store_record, get_info, client):
+    """Test the /api/v1/register endpoint stores the callbacks."""
+    get_info.return_value = {"is_valid": False}
+    store_record.return_value = True
+    scan_repo.return_value = True
+    webhooks = MagicMock()
+    callback_payload = dict(payload, **{"callback-url": "https://93.184.216.34/h"})
+
+    with patch("src.rest_api._webhooks", new=webhooks):
+        reg_resp = client.post(api_route_for('register'),
+                               data=json.dumps(payload),
+                               content_type='application/json')
+        assert reg_resp.status_code == 200
+        webhooks.register.assert_not_called()
+
+        reg_resp = client.post(api_route_for('register'),
+                               data=json.dumps(dict(payload,
+                                                    **{"callback-url": "http://127.0.0.1/h"})),
+                               content_type='application/json')
+        assert reg_resp.status_code == 404
+        assert "callback-url" in get_json_from_response(reg_resp)["summary"]
+        webhooks.register.assert_not_called()
+
+        reg_resp = client.post(api_route_for('register'),
+                               data=json.dumps(callback_payload),
+                               content_type='application/json')
+        assert reg_resp.status_code == 200
+        webhooks.register.assert_called_once_with("https://93.184.216.34/h", "test", "somesha")
+
+        # the registration succeeds even when the callback cannot be stored
+        webhooks.register.side_effect = Exception("disk full")
+        reg_resp = client.post(api_route_for('register'),
+                               data=json.dumps(callback_payload),
+                               content_type='application/json')
+        assert reg_resp.status_code == 200
+
+
+def test_register_batch_endpoint(client):
+    """Test the /api/v1/register/batch endpoint with invalid requests."""
+    reg_resp = client.post(api_route_for('register/batch'),
+                           data=json.dumps({"repositories": [payload]}))
+    assert reg_resp.status_code == 400
+    reg_resp = client.post(api_route_for('register/batch'),
+                           data=json.dumps({"repositories": []}),
+                           content_type='application/json')
+    assert reg_resp.status_code == 400
+    assert get_json_from_response(reg_resp)["summary"] == "repositories cannot be empty"
+
+
+@patch("src.rest_api.MAX_BATCH_REGISTER_SIZE", 2)
+def test_register_batch_endpoint_1(client):
+    """Test the /api/v1/register/batch endpoint with too many repositories."""
+    reg_resp = client.post(api_route_for('register/batch'),
+                           data=json.dumps({"repositories": [payload] * 3}),
+                           content_type='application/json')
+    assert reg_resp.status_code == 400
+
+
+@patch.object(DatabaseIngestion, "bulk_upsert")
+@patch("src.rest_api.scan_repos")
+def test_register_batch_endpoint_2(scan_repos, bulk_upsert, client):
+    """Test the /api/v1/register/batch endpoint with partial failures."""
+    other = dict(payload, **{"git-url": "other"})
+    scan_repos.return_value = [None, "broker unavailable"]
+    reg_resp = client.post(api_route_for('register/batch'),
+                           data=json.dumps({"repositories": [payload, payload_1,
+                                                             payload, other]}),
+                           content_type='application/json')
+    assert reg_resp.status_code == 200
+    reg_resp_json = get_json_from_response(reg_resp)
+    assert reg_resp_json["success"] is False
+    assert [r["status"] for r in reg_resp_json["results"]] == \
+        ["duplicate", "invalid", "registered", "failed"]
+    bulk_upsert.assert_called_once_with([payload, other])
+
+    bulk_upsert.side_effect = Exception("db down")
+    reg_resp = client.post(api_route_for('register/batch'),
+                           data=json.dumps({"repositories": [payload]}),
+                           content_type='application/json')
+    assert reg_resp.status_code == 500
+    assert get_json_from_response(reg_resp)["results"][0]["status"] == "failed"
+
+
+@patch('src.rest_api.FLOW_STATUS_RESULT_BACKEND', True)
+@patch('src.rest_api.get_flow_status', return_value='running')
+def test_flow_status(get_flow_status, client):
+    """Test the /api/v1/flow/<dispatcher_id>/status endpoint."""
+    d_id = "0f7b2d4e-5c3a-4b8e-9d61-2a9c7e1f3b50"
+    route = api_route_for('flow/{}/status'.format(d_id))
+    resp = client.get(route)
+    assert resp.status_code == 200
+    assert get_json_from_response(resp) == {"dispatcher_id": d_id, "status": "running"}
+    assert resp.headers['Retry-After'] == '10'
+    get_flow_status.assert_called_once_with(d_id)
+
+    get_flow_status.return_value = 'finished'
+    resp = client.get(route)
+    assert get_json_from_response(resp)['status'] == 'finished'
+    assert 'Retry-After' not in resp.headers
+
+    resp = client.get(api_route_for('flow/d_id/status'))
+    assert resp.status_code == 404
+
+    get_flow_status.side_effect = Exception('result backend unavailable')
+    resp = client.get(route)
+    assert resp.status_code == 500
+
+    with patch('src.rest_api.FLOW_STATUS_RESULT_BACKEND', False):
+        resp = client.get(route)
+        assert resp.status_code == 501
+
+
+@patch.object(DatabaseIngestion, "get_info", return_value={"is_valid": False})
+@patch.object(DatabaseIngestion, "store_record")
+@patch("src.rest_api.scan_repo", return_value=True)
+@patch("src.rest_api.get_scan_dispatcher_id", return_value="d_id")
+def test_register_dispatcher_id(_get_scan_dispatcher_id, _scan_repo, _store_record, _get_info,
+                                client):
+    """Test the /api/v1/register endpoint returns the dispatcher id of the scan."""
+    reg_resp = client.post(api_route_for('register'),
+                           data=json.dumps(payload),
+                           content_type='application/json')
+    assert reg_resp.status_code == 200
+    assert get_json_from_response(reg_resp)['dispatcher_id'] == "d_id"
@@ -0,0 +1,207 @@
+"""Tests for the report endpoints."""
+
+import gzip
+import json
+from unittest.mock import patch
+
+from tests.test_rest_api import api_route_for, get_json_from_response
+
+
+@patch("src.rest_api.retrieve_worker_results")
+def test_report_batch_endpoint(mocker, client):
+    """Test the /api/v1/report/batch endpoint."""
+    response = client.post(api_route_for('report/batch'),
+                           data=json.dumps({"repositories": [{"git-url": "test"}]}),
+                           content_type='application/json')
+    assert response.status_code == 400
+
+    mocker.return_value = {
+        "sha1": {"task_result": {"scanned_at": "1", "dependencies": []}},
+        "sha2": {"task_result": None}
+    }
+    repositories = [{"git-url": "test", "git-sha": sha}
+                    for sha in ("sha1", "sha2", "sha3", "sha1")]
+    response = client.post(api_route_for('report/batch'),
+                           data=json.dumps({"repositories": repositories}),
+                           content_type='application/json')
+    assert response.status_code == 200
+    json_data = get_json_from_response(response)["reports"]
+    assert json_data["sha1"] == {
+        "status": "available",
+        "report": {
+            "git_url": "test",
+            "git_sha": "sha1",
+            "scanned_at": "1",
+            "dependencies": []
+        }
+    }
+    assert json_data["sha2"]["status"] == "failure"
+    assert json_data["sha3"]["status"] == "not_found"
+    mocker.assert_called_once_with(["sha1", "sha2", "sha3", "sha1"], "ReportGenerationTask")
+
+
+@patch('src.rest_api.STREAM_UPSTREAM_RESPONSES', True)
+@patch('src.rest_api._s3_helper.get_object_stream')
+def test_report_endpoints_stream(get_object_stream, client):
+    """Test the report endpoints stream the raw S3 objects."""
+    for route in ('stacks-report/report/', 'ingestion-report/report/', 'sentry-report/report/'):
+        get_object_stream.return_value = iter([b'{"report": ', b'1}'])
+        resp = client.get(api_route_for(route + 'dev/daily/2019-01-01.json'))
+        assert resp.status_code == 200
+        assert resp.mimetype == 'application/json'
+        assert get_json_from_response(resp) == {"report": 1}
+
+
+@patch('src.rest_api._s3_helper.list_objects', return_value={'objects': []})
+def test_list_reports_endpoints(list_objects, client):
+    """Test the report listing endpoints pass the listing arguments through."""
+    resp = client.get(api_route_for('stacks-report/list/weekly'))
+    assert resp.status_code == 200
+    list_objects.assert_called_with('weekly', from_date=None, to_date=None, limit=None,
+                                    continuation=None)
+
+    resp = client.get(api_route_for('ingestion-report/list?from=2019-01-01&to=2019-02-01'
+                                    '&limit=10&continuation=key'))
+    assert resp.status_code == 200
+    list_objects.assert_called_with('ingestion-data/epv', from_date='2019-01-01',
+                                    to_date='2019-02-01', limit=10, continuation='key')
+
+    resp = client.get(api_route_for('sentry-report/list?limit=none'))
+    assert resp.status_code == 400
+
+
+@patch('src.rest_api.generate_comparison')
+def test_compare_stacks_report_endpoint(generate_comparison, client):
+    """Test the /api/v1/stacks-report/compare endpoint."""
+    for days in ('', 'x', '1', '1000'):
+        resp = client.get(api_route_for('stacks-report/compare?days=' + days))
+        assert resp.status_code == 400
+    generate_comparison.assert_not_called()
+
+    generate_comparison.return_value = {'average_response_time': []}
+    resp = client.get(api_route_for('stacks-report/compare?days=14'))
+    assert resp.status_code == 200
+    generate_comparison.assert_called_with(14)
+
+    generate_comparison.return_value = -1
+    resp = client.get(api_route_for('stacks-report/compare?days=2'))
+    assert resp.status_code == 404
+
+
+@patch('src.rest_api.generate_trend')
+def test_stacks_report_trend_endpoint(generate_trend, client):
+    """Test the /api/v1/stacks-report/trend endpoint."""
+    resp = client.get(api_route_for('stacks-report/trend?from=2019-01-01'))
+    assert resp.status_code == 400
+
+    generate_trend.return_value = [{'date': '2019-01-01', 'total_average_response_time': '1ms'}]
+    resp = client.get(api_route_for('stacks-report/trend?from=2019-01-01&to=2019-01-02'
+                                    '&fields=total_average_response_time'))
+    assert resp.status_code == 200
+    assert get_json_from_response(resp)['trend'] == generate_trend.return_value
+    generate_trend.assert_called_with('2019-01-01', '2019-01-02',
+                                      ['total_average_response_time'])
+
+    generate_trend.side_effect = ValueError('Fields unknown are not indexed')
+    resp = client.get(api_route_for('stacks-report/trend?from=2019-01-01&to=2019-01-02'
+                                    '&fields=unknown'))
+    assert resp.status_code == 400
+
+
+@patch('src.rest_api.aggregate_reports', return_value={'totals': {}})
+def test_aggregate_reports_endpoints(aggregate_reports, client):
+    """Test the report aggregation endpoints."""
+    resp = client.get(api_route_for('sentry-report/aggregate?from=2019-01-01'))
+    assert resp.status_code == 400
+
+    resp = client.get(api_route_for('sentry-report/aggregate?from=2019-01-01&to=2019-01-31'))
+    assert resp.status_code == 200
+    aggregate_reports.assert_called_with('sentry-error-data', '2019-01-01', '2019-01-31')
+    resp = client.get(api_route_for('ingestion-report/aggregate?from=2019-01-01&to=2019-01-31'))
+    assert resp.status_code == 200
+    aggregate_reports.assert_called_with('ingestion-data/epv', '2019-01-01', '2019-01-31')
+
+    aggregate_reports.side_effect = ValueError('invalid date')
+    resp = client.get(api_route_for('ingestion-report/aggregate?from=x&to=y'))
+    assert resp.status_code == 400
+
+
+@patch('src.rest_api.STREAM_UPSTREAM_RESPONSES', True)
+@patch('src.rest_api._s3_helper.get_object_stream')
+def test_report_endpoints_stream_compressed(get_object_stream, client):
+    """Test the gzip compressed S3 objects are sent compressed to clients accepting it."""
+    compressed = gzip.compress(b'{"report": 1}')
+    get_object_stream.return_value = iter([compressed])
+    resp = client.get(api_route_for('stacks-report/report/dev/daily/2019-01-01.json.gz'),
+                      headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(resp.get_data())) == {"report": 1}
+    get_object_stream.assert_called_with('dev/daily/2019-01-01.json.gz', decompress=False)
+
+    # uncompressed objects are compressed on the fly
+    get_object_stream.return_value = iter([b'{"report": ', b'1}'])
+    resp = client.get(api_route_for('stacks-report/report/dev/daily/2019-01-01.json'),
+                      headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(resp.get_data())) == {"report": 1}
+
+
+@patch('compression.COMPRESS_MIN_SIZE', 10)
+@patch('src.rest_api.aggregate_reports', return_value={'totals': {'x' * 100: 1}})
+def test_compressed_response(aggregate_reports, client):
+    """Test the responses are compressed only for clients accepting it."""
+    route = api_route_for('sentry-report/aggregate?from=2019-01-01&to=2019-01-31')
+    resp = client.get(route, headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(resp.get_data())) == aggregate_reports.return_value
+
+    resp = client.get(route)
+    assert 'Content-Encoding' not in resp.headers
+    assert get_json_from_response(resp) == aggregate_reports.return_value
+
+
+@patch('src.rest_api._report_watcher.wait')
+def test_report_wait(wait, client):
+    """Test the /api/v1/report/wait endpoint."""
+    wait.return_value = {"task_result": {"scanned_at": "now", "dependencies": []}}
+    resp = client.get(api_route_for('report/wait?git-url=url&git-sha=sha&timeout=5'))
+    assert resp.status_code == 200
+    assert get_json_from_response(resp)["scanned_at"] == "now"
+    wait.assert_called_once_with("sha", 5)
+
+    wait.return_value = None
+    resp = client.get(api_route_for('report/wait?git-url=url&git-sha=sha&timeout=3600'))
+    assert resp.status_code == 404
+    wait.assert_called_with("sha", 30)
+
+    assert client.get(api_route_for('report/wait?git-url=url')).status_code == 400
+    assert client.get(api_route_for('report/wait?git-sha=sha&timeout=x')).status_code == 400
+
+
+@patch('src.rest_api._report_watcher.wait')
+@patch('src.rest_api._report_watcher.waiting', return_value=8)
+def test_report_wait_too_many_waiters(_waiting, wait, client):
+    """Test that clients over the limit are asked to retry later."""
+    resp = client.get(api_route_for('report/wait?git-url=url&git-sha=sha'))
+    assert resp.status_code == 503
+    assert int(resp.headers['Retry-After']) >= 1
+    wait.assert_not_called()
+
+
+@patch('src.rest_api._report_watcher.unsubscribe')
+@patch('src.rest_api._report_watcher.subscribe')
+def test_report_wait_events(subscribe, unsubscribe, client):
+    """Test the /api/v1/report/wait endpoint sends server-sent events."""
+    subscribe.side_effect = lambda sha, callback: callback({"task_result": {"dependencies": []}})
+    resp = client.get(api_route_for('report/wait?git-url=url&git-sha=sha'),
+                      headers={'Accept': 'text/event-stream'})
+    assert resp.mimetype == 'text/event-stream'
+    events = resp.get_data(as_text=True)
+    assert events.startswith('event: report\ndata: ')
+    assert json.loads(events.split('data: ')[1])["status"] == "available"
+    unsubscribe.assert_called_once()
+
+    subscribe.side_effect = None
+    resp = client.get(api_route_for('report/wait?git-url=url&git-sha=sha&timeout=0.05'),
+                      headers={'Accept': 'text/event-stream'})
+    assert resp.get_data(as_text=True).endswith('event: timeout\ndata: {}\n\n')
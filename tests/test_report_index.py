@@ -0,0 +1,87 @@
+"""Tests for the stacks summary index."""
+
+import json
+from unittest.mock import MagicMock
+
+from botocore.exceptions import ClientError
+
+from src.report_index import StacksSummaryIndex
+
+
+def _fetch_reports(names):
+    """Fetch mocked daily reports, the report of 2019-01-02 is missing."""
+    for name in names:
+        if '2019-01-02' in name:
+            yield name, None
+        else:
+            yield name, {'stacks_summary': {'total_average_response_time': name[-7:-5],
+                                            'total_stack_requests_count': 1}}
+
+
+def _index(s3_helper=None, path=None, fetch_reports=_fetch_reports):
+    """Create index of the mocked reports."""
+    return StacksSummaryIndex(s3_helper or MagicMock(), MagicMock(side_effect=fetch_reports),
+                              'dev', ['total_average_response_time',
+                                      'total_stack_requests_count'], path=path)
+
+
+def test_get_range():
+    """Test that missing dates get indexed and stored."""
+    s3_helper = MagicMock()
+    s3_helper.get_object_content.side_effect = ClientError(
+        {'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+    index = _index(s3_helper)
+    dates = ['2019-01-01', '2019-01-02', '2019-01-03']
+    assert index.get_range(dates, ['total_average_response_time']) == {
+        '2019-01-01': {'total_average_response_time': '01'},
+        '2019-01-02': None,
+        '2019-01-03': {'total_average_response_time': '03'}}
+    index.fetch_reports.assert_called_once()
+    assert sorted(index.fetch_reports.call_args[0][0]) == [
+        'dev/daily/2019-01-01.json', 'dev/daily/2019-01-02.json', 'dev/daily/2019-01-03.json']
+    stored_name, stored = s3_helper.put_object_content.call_args[0]
+    assert stored_name == 'dev/index/stacks-summary.json'
+    assert stored['dates']['2019-01-02'] is None
+
+    # already indexed dates are not fetched again
+    assert index.get_range(['2019-01-01'])['2019-01-01'] == {
+        'total_average_response_time': '01', 'total_stack_requests_count': 1}
+    assert index.fetch_reports.call_count == 1
+
+
+def test_get_range_from_storage(tmpdir):
+    """Test that the index is read from its local file."""
+    path = str(tmpdir.join('index.json'))
+    index = _index(path=path)
+    index.get_range(['2019-01-01'])
+
+    index = _index(path=path)
+    assert index.get_range(['2019-01-01'])['2019-01-01']['total_stack_requests_count'] == 1
+    index.fetch_reports.assert_not_called()
+
+    # index of other fields is rebuilt
+    with open(path, 'w') as f:
+        json.dump({'fields': ['other'], 'dates': {'2019-01-01': {'other': 1}}}, f)
+    index = _index(path=path)
+    index.get_range(['2019-01-01'])
+    index.fetch_reports.assert_called_once()
+
+
+def test_get_range_recent_missing_reports():
+    """Test that missing reports of the last days are not recorded."""
+    index = _index(fetch_reports=lambda names: ((name, None) for name in names))
+    index.s3_helper.get_object_content.return_value = {}
+    assert index.get_range(['2999-01-01']) == {'2999-01-01': None}
+    index.s3_helper.put_object_content.assert_not_called()
+    index.get_range(['2999-01-01'])
+    assert index.fetch_reports.call_count == 2
+
+
+def test_get_range_failed_reports():
+    """Test that reports failing to be fetched are not recorded as missing."""
+    index = _index(fetch_reports=lambda names: iter(()))
+    index.s3_helper.get_object_content.return_value = {}
+    assert index.get_range(['2019-01-01']) == {'2019-01-01': None}
+    index.s3_helper.put_object_content.assert_not_called()
+    index.get_range(['2019-01-01'])
+    assert index.fetch_reports.call_count == 2
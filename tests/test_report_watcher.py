@@ -0,0 +1,86 @@
+"""Tests for the watcher of the scan reports."""
+
+import threading
+import time
+from unittest.mock import MagicMock
+
+from src.report_watcher import ReportWatcher
+
+
+def test_wait():
+    """Test waiting for the results checked together."""
+    fetch_results = MagicMock(side_effect=[{}, {"sha1": {"task_result": {}}}])
+    watcher = ReportWatcher(fetch_results, "ReportGenerationTask", interval=0.01)
+    results = {}
+
+    def wait(sha, timeout):
+        results[sha] = watcher.wait(sha, timeout)
+
+    threads = [threading.Thread(target=wait, args=("sha1", 5)),
+               threading.Thread(target=wait, args=("sha1", 5))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {"sha1": {"task_result": {}}}
+    assert fetch_results.call_count == 2
+    fetch_results.assert_called_with(["sha1"], "ReportGenerationTask")
+
+
+def test_wait_timeout():
+    """Test that nothing is returned once the timeout passes."""
+    fetch_results = MagicMock(return_value={})
+    watcher = ReportWatcher(fetch_results, "ReportGenerationTask", interval=0.01)
+    assert watcher.wait("sha", 0.05) is None
+    assert watcher._subscribers == {}
+
+
+def test_failing_check():
+    """Test that the watcher keeps checking when the check fails."""
+    fetch_results = MagicMock(side_effect=[Exception("database down"), {"sha": {}}])
+    release = MagicMock()
+    watcher = ReportWatcher(fetch_results, "ReportGenerationTask", interval=0.01,
+                            release=release)
+    assert watcher.wait("sha", 5) == {}
+    watcher.stop()
+    # the database session is ended after every check, failed ones included
+    assert release.call_count == 2
+
+
+def test_subscribe():
+    """Test that the subscribers are notified and the watcher stops without them."""
+    fetch_results = MagicMock(return_value={"sha": {}})
+    watcher = ReportWatcher(fetch_results, "ReportGenerationTask", interval=0.01)
+    done = threading.Event()
+    failing = MagicMock(side_effect=Exception("failure"))
+    watcher.subscribe("sha", failing)
+    watcher.subscribe("sha", lambda result: done.set())
+    assert done.wait(5)
+    failing.assert_called_once_with({})
+    token = watcher.subscribe("other", lambda result: None)
+    watcher.unsubscribe("other", token)
+    assert watcher._subscribers == {}
+
+
+def test_subscribe_existing_result():
+    """Test that an existing result is returned without waiting for the interval."""
+    fetch_results = MagicMock(return_value={"sha": {"task_result": {}}})
+    watcher = ReportWatcher(fetch_results, "ReportGenerationTask", interval=60)
+    start = time.time()
+    assert watcher.wait("sha", 5) == {"task_result": {}}
+    assert time.time() - start < 1
+    fetch_results.assert_called_once_with(["sha"], "ReportGenerationTask")
+    assert watcher._thread is None
+    assert watcher.waiting() == 0
+
+
+def test_waiting():
+    """Test counting of the waiting subscribers."""
+    watcher = ReportWatcher(MagicMock(return_value={}), "ReportGenerationTask", interval=60)
+    token = watcher.subscribe("sha", lambda result: None)
+    watcher.subscribe("sha", lambda result: None)
+    watcher.subscribe("other", lambda result: None)
+    assert watcher.waiting() == 3
+    watcher.unsubscribe("sha", token)
+    assert watcher.waiting() == 2
+    watcher.stop()
@@ -1,14 +1,15 @@
 """Test module."""
 
 import json
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 from utils import DatabaseIngestion
 from pathlib import Path
 from parsers.maven_parser import MavenParser
 from src.repo_dependency_creator import RepoDependencyCreator
 from src.notification.user_notification import UserNotification
-from utils import GREMLIN_SERVER_URL_REST
+from graph import GREMLIN_SERVER_URL_REST
 import os
+from src.rest_api import _outbox_database, OUTBOX_PATH
 
 payload = {
     "email-ids": "abcd@gmail.com",
@@ -120,6 +121,24 @@ def test_readiness_endpoint(client):
     assert json_data == {}, "Empty JSON response expected"
 
 
+@patch("src.rest_api.remove_sessions")
+def test_db_sessions_removed(remove_sessions, client):
+    """Test that the database sessions are ended after every request."""
+    # the test client keeps the context of a request until the next one starts
+    client.get(api_route_for('liveness'))
+    client.get(api_route_for('liveness'))
+    remove_sessions.assert_called_once_with()
+
+
+@patch("src.rest_api.get_session")
+def test_outbox_database(get_session):
+    """Test that the outboxes are kept in the database of the configured backend."""
+    with patch("src.rest_api.OUTBOX_BACKEND", "sqlite"):
+        assert _outbox_database() == OUTBOX_PATH
+    with patch("src.rest_api.OUTBOX_BACKEND", "postgres"):
+        assert _outbox_database() == get_session.return_value.get_bind.return_value
+
+
 def test_readiness_endpoint_wrong_http_method(client):
     """Test the /api/v1/readiness endpoint by calling it with wrong HTTP method."""
     url = api_route_for("readiness")
@@ -332,9 +351,7 @@ def test_user_repo_scan_endpoint_1(client):
 @patch.object(UserNotification, "send_notification")
 @patch("src.repo_dependency_creator.requests.post",
        side_effect=mocked_requests_post)
-@patch("src.notification.user_notification.requests.post",
-       side_effect=mocked_requests_post)
-def test_user_repo_scan_endpoint_2(_r_post, _u_post, send_notification, generate_notification,
+def test_user_repo_scan_endpoint_2(_r_post, send_notification, generate_notification,
                                    _generate_report, create_repo_node_and_get_cve,
                                    parse_output_file, client):
     """Test the /api/v1/user-repo/scan endpoint."""
@@ -343,13 +360,17 @@ def test_user_repo_scan_endpoint_2(_r_post, _u_post, send_notification, generate
         "data": []
     }}
     generate_notification.return_value = {'notification-payload': 'notification'}
-    send_notification.return_value = {'status': 'success'}
-    resp = client.post(api_route_for('user-repo/scan'),
-                       headers={'git-url': 'test'},
-                       data=json.dumps(payload_scan_data),
-                       content_type='application/json')
+    notifications = MagicMock()
+    with patch("src.rest_api._notifications", new=notifications):
+        resp = client.post(api_route_for('user-repo/scan'),
+                           headers={'git-url': 'test'},
+                           data=json.dumps(payload_scan_data),
+                           content_type='application/json')
 
     assert resp.status_code == 200
+    # the notifications are only stored within the request
+    notifications.put.assert_called_once()
+    send_notification.assert_not_called()
 
 
 def test_notify_user_endpoint(client):
@@ -0,0 +1,204 @@
+"""Tests for the S3 helper and its caches."""
+
+import gzip
+import os
+import time
+from unittest.mock import patch, MagicMock, ANY
+
+import pytest
+from botocore.exceptions import ClientError
+
+from src.s3_helper import S3Helper
+
+
+def test_get_object_stream():
+    """Test that the raw S3 object is passed through."""
+    s3_helper = S3Helper()
+    s3_helper.s3 = MagicMock()
+    body = s3_helper.s3.Object.return_value.get.return_value['Body']
+    body.iter_chunks.return_value = [b'{"a": ', b'1}']
+    assert b''.join(s3_helper.get_object_stream('report.json')) == b'{"a": 1}'
+    body.close.assert_called_once()
+
+
+class S3ObjectMock:
+    """Mocks object summary returned by S3 listing."""
+
+    def __init__(self, key):
+        """Initialize the object."""
+        self.key = key
+
+
+def _s3_helper_with_keys(keys):
+    """Create S3Helper listing the given keys."""
+    s3_helper = S3Helper()
+    s3_helper.s3_bucket_obj = MagicMock()
+    s3_helper.s3_bucket_obj.objects.filter.return_value = [S3ObjectMock(key) for key in keys]
+    return s3_helper
+
+
+def test_list_objects():
+    """Test listing of S3 objects narrowed down by dates and limit."""
+    s3_helper = _s3_helper_with_keys(["dev/weekly/", "dev/weekly/2019-01-14.json",
+                                      "dev/weekly/2019-01-07.json", "dev/weekly/2019-01-21.json"])
+    assert s3_helper.list_objects("dev/weekly") == {'objects': [
+        "dev/weekly/2019-01-07.json", "dev/weekly/2019-01-14.json", "dev/weekly/2019-01-21.json"]}
+    assert s3_helper.list_objects("dev/weekly", from_date="2019-01-10",
+                                  to_date="2019-01-14") == {
+        'objects': ["dev/weekly/2019-01-14.json"]}
+
+    resp = s3_helper.list_objects("dev/weekly", limit=2)
+    assert resp == {'objects': ["dev/weekly/2019-01-07.json", "dev/weekly/2019-01-14.json"],
+                    'next_continuation': "dev/weekly/2019-01-14.json"}
+    resp = s3_helper.list_objects("dev/weekly", limit=2,
+                                  continuation=resp['next_continuation'])
+    assert resp == {'objects': ["dev/weekly/2019-01-21.json"], 'next_continuation': None}
+
+    s3_helper = _s3_helper_with_keys(["dev/monthly/2018-12.json", "dev/monthly/2019-01.json"])
+    assert s3_helper.list_objects("dev/monthly", from_date="2019-01-01") == {
+        'objects': ["dev/monthly/2019-01.json"]}
+
+
+@patch("src.s3_helper.S3_LISTING_CACHE_TTL", 60)
+def test_list_objects_cache():
+    """Test that listings are cached and refreshed in the background."""
+    s3_helper = _s3_helper_with_keys(["dev/weekly/2019-01-07.json"])
+    listing = s3_helper.s3_bucket_obj.objects.filter
+    s3_helper.list_objects("dev/weekly")
+    s3_helper.list_objects("dev/weekly")
+    assert listing.call_count == 1
+
+    listing.return_value = [S3ObjectMock("dev/weekly/2019-01-14.json")]
+    with patch.object(s3_helper.listing_cache, "age", return_value=120), \
+            patch("src.s3_helper.threading.Thread") as thread:
+        # stale listing is served while refreshed in the background
+        assert s3_helper.list_objects("dev/weekly") == {
+            'objects': ["dev/weekly/2019-01-07.json"]}
+        thread.assert_called_once()
+        thread.return_value.start.assert_called_once()
+        thread.call_args[1]['target'](*thread.call_args[1]['args'])
+    assert s3_helper.list_objects("dev/weekly") == {'objects': ["dev/weekly/2019-01-14.json"]}
+
+
+def _client_error(code):
+    """Create botocore ClientError with the given code."""
+    return ClientError({'Error': {'Code': code, 'Message': 'error'}}, 'GetObject')
+
+
+def test_get_object_content_cache():
+    """Test that the S3 reports are cached in memory."""
+    s3_helper = S3Helper()
+    s3_helper.s3 = MagicMock()
+    get = s3_helper.s3.Object.return_value.get
+    get.return_value = {'Body': MagicMock(**{'read.return_value': b'{"a": 1}'}),
+                        'ETag': '"etag"'}
+    assert s3_helper.get_object_content('dev/daily/2019-01-01.json') == {'a': 1}
+    assert s3_helper.get_object_content('dev/daily/2019-01-01.json') == {'a': 1}
+    assert b''.join(s3_helper.get_object_stream('dev/daily/2019-01-01.json')) == b'{"a": 1}'
+    assert get.call_count == 1
+
+    get.side_effect = _client_error('NoSuchKey')
+    with pytest.raises(ClientError):
+        s3_helper.get_object_content('dev/daily/2019-01-02.json')
+
+
+def test_get_compressed_object():
+    """Test that gzip compressed S3 reports are decompressed."""
+    s3_helper = S3Helper()
+    s3_helper.s3 = MagicMock()
+    compressed = gzip.compress(b'{"a": 1}')
+    get = s3_helper.s3.Object.return_value.get
+    body = MagicMock(**{'read.return_value': compressed,
+                        'iter_chunks.return_value': [compressed]})
+    get.return_value = {'Body': body}
+    assert s3_helper.get_object_content('dev/daily/2019-01-01.json.gz') == {'a': 1}
+    assert b''.join(s3_helper.get_object_stream('dev/daily/2019-01-01.json.gz')) == \
+        b'{"a": 1}'
+    assert b''.join(s3_helper.get_object_stream('dev/daily/2019-01-01.json.gz',
+                                                decompress=False)) == compressed
+
+    # report stored compressed is found under its uncompressed name too
+    s3_helper.content_cache.clear()
+    get.side_effect = [_client_error('NoSuchKey'), get.return_value]
+    assert s3_helper.get_object_content('dev/daily/2019-01-02.json') == {'a': 1}
+    s3_helper.s3.Object.assert_called_with(ANY, 'dev/daily/2019-01-02.json.gz')
+
+
+def test_put_compressed_object():
+    """Test that reports named .gz are stored gzip compressed."""
+    s3_helper = S3Helper()
+    s3_helper.s3 = MagicMock()
+    put = s3_helper.s3.Object.return_value.put
+    s3_helper.put_object_content('dev/daily/2019-01-01.json.gz', {'a': 1})
+    assert gzip.decompress(put.call_args[1]['Body']) == b'{"a": 1}'
+    assert put.call_args[1]['ContentEncoding'] == 'gzip'
+    s3_helper.put_object_content('dev/daily/2019-01-01.json', {'a': 1})
+    assert put.call_args[1]['Body'] == b'{"a": 1}'
+
+
+@patch("src.s3_helper.S3_REPORT_CACHE_MAX_BYTES", 0)
+def test_get_object_content_disk_cache(tmpdir):
+    """Test that the S3 reports are cached on disk and revalidated by ETag."""
+    s3_helper = S3Helper()
+    s3_helper.s3 = MagicMock()
+    get = s3_helper.s3.Object.return_value.get
+    get.return_value = {'Body': MagicMock(**{'read.return_value': b'{"a": 1}'}),
+                        'ETag': '"etag"'}
+    with patch("src.s3_helper.S3_REPORT_CACHE_DIR", str(tmpdir)):
+        assert s3_helper.get_object_content('dev/daily/2019-01-01.json') == {'a': 1}
+        get.assert_called_with()
+
+        get.side_effect = _client_error('304')
+        assert s3_helper.get_object_content('dev/daily/2019-01-01.json') == {'a': 1}
+        get.assert_called_with(IfNoneMatch='"etag"')
+
+        get.side_effect = None
+        get.return_value = {'Body': MagicMock(**{'read.return_value': b'{"a": 2}'}),
+                            'ETag': '"etag2"'}
+        assert s3_helper.get_object_content('dev/daily/2019-01-01.json') == {'a': 2}
+        get.side_effect = _client_error('304')
+        assert s3_helper.get_object_content('dev/daily/2019-01-01.json') == {'a': 2}
+        get.assert_called_with(IfNoneMatch='"etag2"')
+
+
+@patch("src.s3_helper.S3_REPORT_CACHE_MAX_BYTES", 0)
+@patch("src.s3_helper.S3_REPORT_CACHE_DIR_MAX_BYTES", 25)
+def test_get_object_content_disk_cache_eviction(tmpdir):
+    """Test that the least recently used reports are removed from the full disk cache."""
+    s3_helper = S3Helper()
+    s3_helper.s3 = MagicMock()
+    get = s3_helper.s3.Object.return_value.get
+
+    def cached(name):
+        return s3_helper._disk_cache_entry(name)[1] is not None
+
+    with patch("src.s3_helper.S3_REPORT_CACHE_DIR", str(tmpdir)):
+        for day, age in (('01', 300), ('02', 200)):
+            name = 'dev/daily/2019-01-{}.json'.format(day)
+            get.return_value = {'Body': MagicMock(**{'read.return_value': b'{"a": 1234}'}),
+                                'ETag': '"etag{}"'.format(day)}
+            s3_helper.get_object_content(name)
+            path = s3_helper._disk_cache_entry(name)[0]
+            os.utime(path, (time.time() - age, time.time() - age))
+        assert cached('dev/daily/2019-01-01.json') and cached('dev/daily/2019-01-02.json')
+
+        # the hit marks the oldest report as recently used
+        get.side_effect = _client_error('304')
+        assert s3_helper.get_object_content('dev/daily/2019-01-01.json') == {'a': 1234}
+
+        get.side_effect = None
+        get.return_value = {'Body': MagicMock(**{'read.return_value': b'{"a": 5678}'}),
+                            'ETag': '"etag03"'}
+        s3_helper.get_object_content('dev/daily/2019-01-03.json')
+        assert cached('dev/daily/2019-01-01.json') and cached('dev/daily/2019-01-03.json')
+        assert not cached('dev/daily/2019-01-02.json')
+        path = s3_helper._disk_cache_entry('dev/daily/2019-01-02.json')[0]
+        assert not os.path.exists(path + '.etag')
+
+        # reports evicted after their ETag was read are downloaded again
+        path = s3_helper._disk_cache_entry('dev/daily/2019-01-03.json')[0]
+        with patch.object(S3Helper, '_disk_cache_entry', side_effect=[(path, '"etag03"'),
+                                                                      (path, None)]):
+            os.remove(path)
+            get.side_effect = [_client_error('304'), get.return_value]
+            assert s3_helper.get_object_content('dev/daily/2019-01-03.json') == {'a': 5678}
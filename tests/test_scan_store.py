@@ -0,0 +1,60 @@
+"""Tests for the record of the in-flight scans."""
+
+from unittest.mock import patch, MagicMock
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from src.scan_store import LocalScanStore, PostgresScanStore
+
+
+def test_local_scan_store():
+    """Test claiming and recording of the scans."""
+    store = LocalScanStore(60)
+    assert store.claim("url", "sha") == (True, None)
+    assert store.claim("url", "sha") == (False, None)
+    store.record("url", "sha", "d_id")
+    assert store.claim("url", "sha") == (False, "d_id")
+    assert store.get("url", "sha") == "d_id"
+    assert store.claim("url", "other-sha") == (True, None)
+
+    store.release("url", "sha")
+    assert store.get("url", "sha") is None
+    assert store.claim("url", "sha") == (True, None)
+
+
+def test_local_scan_store_expiry():
+    """Test that stale scans can be claimed again."""
+    store = LocalScanStore(60)
+    with patch("src.scan_store.time.time", return_value=1000):
+        store.claim("url", "sha")
+        store.record("url", "sha", "d_id")
+    with patch("src.scan_store.time.time", return_value=1061):
+        assert store.get("url", "sha") is None
+        assert store.claim("url", "other-sha") == (True, None)
+        # stale entries are dropped
+        assert len(store._scans) == 1
+        assert store.claim("url", "sha") == (True, None)
+
+
+@patch("src.scan_store.inflight_scans")
+@patch("src.scan_store.get_inflight_scan", return_value="d_id")
+@patch("src.scan_store.claim_inflight_scan", side_effect=[True, False])
+def test_postgres_scan_store(claim_inflight_scan, get_inflight_scan, inflight_scans):
+    """Test the scans shared through Postgres."""
+    session = MagicMock()
+    store = PostgresScanStore(lambda: session, 60)
+    inflight_scans.create.assert_called_once_with(bind=session.get_bind(), checkfirst=True)
+
+    assert store.claim("url", "sha") == (True, None)
+    assert store.claim("url", "sha") == (False, "d_id")
+    claim_inflight_scan.assert_called_with(session, "url", "sha", 60)
+    assert session.commit.call_count == 2
+
+    # scans are not blocked when the database fails
+    claim_inflight_scan.side_effect = SQLAlchemyError()
+    assert store.claim("url", "sha") == (True, None)
+    session.rollback.assert_called_once()
+
+    with patch("src.scan_store.delete_inflight_scan") as delete_inflight_scan:
+        store.release("url", "sha")
+        delete_inflight_scan.assert_called_once_with(session, "url", "sha")
@@ -0,0 +1,152 @@
+"""Tests for the dispatch of the scan flows and their status."""
+
+from unittest.mock import patch
+
+import pytest
+from selinon import UnknownFlowError
+
+import src.scans
+from src.scan_store import LocalScanStore
+from src.scans import server_run_flow, server_run_flows, scan_repo, scan_repos, \
+    get_flow_status, get_scan_dispatcher_id
+
+
+@patch("src.scans.init_celery", return_value=None)
+@patch("src.scans.run_flow", return_value='dispatcher_id')
+def test_server_run_flow(_a, _b):
+    """Test server_run_flow."""
+    resp = server_run_flow("test", "test")
+    assert resp == 'dispatcher_id'
+
+
+@patch("src.scans.server_run_flow", return_value="d_id")
+def test_scan_repo(a):
+    """Test scan_repo."""
+    payload = {
+        "email-ids": "abcd@gmail.com",
+        "git-sha": "somesha",
+        "git-url": "test"
+    }
+    resp = scan_repo(payload)
+    assert resp is True
+
+
+@patch("src.scans.Config.dispatcher_queues", {"osioAnalysisFlow": "queue"})
+@patch("src.scans.Dispatcher")
+def test_server_run_flows(dispatcher):
+    """Test that the flows are dispatched over one producer."""
+    apply_async = dispatcher.return_value.apply_async
+    apply_async.side_effect = ["d_id_1", Exception("failure"), "d_id_3"]
+    results = server_run_flows("osioAnalysisFlow", [{"github_repo": "test"}] * 3)
+    assert [d_id for d_id, _error in results] == ["d_id_1", None, "d_id_3"]
+    assert str(results[1][1]) == "failure"
+    producer = dispatcher.return_value.app.producer_or_acquire.return_value.__enter__()
+    apply_async.assert_called_with(
+        kwargs={'flow_name': "osioAnalysisFlow", 'node_args': {"github_repo": "test"}},
+        queue="queue", producer=producer)
+    dispatcher.return_value.app.producer_or_acquire.assert_called_once()
+
+    with pytest.raises(UnknownFlowError):
+        server_run_flows("unknownFlow", [{}])
+
+
+@patch("src.scans._scan_store", LocalScanStore(3600))
+@patch("src.scans.retrieve_worker_result", new=lambda sha, worker: None)
+@patch("src.scans.SCAN_DISPATCH_BATCH_SIZE", 2)
+@patch("src.scans.server_run_flows", side_effect=[
+    [("d_id", None), (None, Exception("failure"))], Exception("connection refused")])
+def test_scan_repos(server_run_flows):
+    """Test scan_repos."""
+    payloads = [{"git-sha": "sha{}".format(i), "git-url": "test"} for i in range(3)]
+    errors = scan_repos(payloads)
+    assert errors == [None, "failure", "connection refused"]
+    assert server_run_flows.call_count == 2
+    server_run_flows.assert_called_with("osioAnalysisFlow", [
+        {'github_repo': "test", 'github_sha': "sha2", 'email_ids': "dummy"}])
+
+    # only the scan that was dispatched successfully is in flight
+    server_run_flows.side_effect = lambda name, args: [("d_id_2", None)] * len(args)
+    assert scan_repos(payloads + [payloads[1]]) == [None] * 4
+    assert [call[0][1] for call in server_run_flows.call_args_list[2:]] == [
+        [{'github_repo': "test", 'github_sha': "sha1", 'email_ids': "dummy"}],
+        [{'github_repo': "test", 'github_sha': "sha2", 'email_ids': "dummy"}]]
+
+
+@patch("src.scans._scan_store", LocalScanStore(3600))
+@patch("src.scans.retrieve_worker_result", return_value=None)
+@patch("src.scans.server_run_flow", return_value="d_id")
+def test_scan_repo_coalesced(server_run_flow, _retrieve_worker_result):
+    """Test that the scan of the commit in flight is not dispatched again."""
+    payload = {"git-sha": "somesha", "git-url": "test"}
+    assert scan_repo(payload) is True
+    assert scan_repo(payload) is True
+    server_run_flow.assert_called_once()
+    assert src.scans._scan_store.get("test", "somesha") == "d_id"
+
+    server_run_flow.side_effect = Exception("failure")
+    with pytest.raises(Exception):
+        scan_repo({"git-sha": "othersha", "git-url": "test"})
+    assert src.scans._scan_store.get("test", "othersha") is None
+    with patch("src.scans.SCAN_DEDUP_WINDOW", 0):
+        with pytest.raises(Exception):
+            scan_repo(payload)
+    assert server_run_flow.call_count == 3
+
+
+@patch("src.scans._scan_store", LocalScanStore(3600))
+@patch("src.scans.FLOW_STATUS_RESULT_BACKEND", True)
+@patch("src.scans.get_flow_status", return_value="running")
+@patch("src.scans.retrieve_worker_result", return_value=None)
+@patch("src.scans.server_run_flow", side_effect=["d_id_1", "d_id_2", "d_id_3", "d_id_4"])
+def test_scan_repo_claim_released(server_run_flow, retrieve_worker_result, get_flow_status):
+    """Test that scans are dispatched again when forced or once the previous one is over."""
+    payload = {"git-sha": "somesha", "git-url": "test"}
+    scan_repo(payload)
+    scan_repo(payload)
+    assert server_run_flow.call_count == 1
+    get_flow_status.assert_called_with("d_id_1")
+
+    scan_repo(dict(payload, force=True))
+    scan_repo(dict(payload, force=True))
+    assert server_run_flow.call_count == 3
+    assert src.scans._scan_store.get("test", "somesha") == "d_id_3"
+
+    get_flow_status.return_value = "failed"
+    scan_repo(payload)
+    assert server_run_flow.call_count == 4
+
+    get_flow_status.return_value = "running"
+    retrieve_worker_result.return_value = {"task_result": {}}
+    server_run_flow.side_effect = None
+    scan_repo(payload)
+    assert server_run_flow.call_count == 5
+
+    # the scan counts as in flight when its state cannot be checked
+    retrieve_worker_result.side_effect = Exception("db down")
+    scan_repo(payload)
+    assert server_run_flow.call_count == 5
+
+
+@patch("src.scans.query_flow_state", side_effect=["RETRY", "SUCCESS", "UNKNOWN"])
+def test_get_flow_status(query_flow_state):
+    """Test that the flow status is derived from the dispatcher state and cached."""
+    src.scans._flow_status_cache.clear()
+    assert get_flow_status("d_id") == "running"
+    assert get_flow_status("d_id") == "running"
+    assert query_flow_state.call_count == 1
+    with patch.object(src.scans._flow_status_cache, "ttl", 0):
+        assert get_flow_status("d_id") == "finished"
+    assert get_flow_status("other_d_id") == "queued"
+
+
+@patch("src.scans._scan_store", LocalScanStore(3600))
+@patch("src.scans.retrieve_worker_result", return_value=None)
+@patch("src.scans.server_run_flow", return_value="d_id")
+def test_get_scan_dispatcher_id(_server_run_flow, _retrieve_worker_result):
+    """Test that the dispatcher id of the scan in flight is known."""
+    payload = {"git-sha": "somesha", "git-url": "test"}
+    assert get_scan_dispatcher_id(payload) is None
+    scan_repo(payload)
+    assert get_scan_dispatcher_id(payload) == "d_id"
+    with patch("src.scans.SCAN_DEDUP_WINDOW", 0):
+        assert get_scan_dispatcher_id(payload) is None
@@ -0,0 +1,91 @@
+"""Tests for coalescing of identical concurrent lookups."""
+
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from metrics import metrics
+from src.singleflight import SingleFlight, coalesce
+
+
+def _wait_for(predicate, timeout=5):
+    """Wait until the predicate holds."""
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_single_flight_shares_result():
+    """Test that concurrent callers of the same key share one call."""
+    flight = SingleFlight("test-share")
+    release = threading.Event()
+    calls = []
+
+    def lookup(key):
+        calls.append(key)
+        release.wait(5)
+        return {"key": key}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("k", lookup, "k")))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    _wait_for(lambda: metrics.get("singleflight.test-share.requests") == 3)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == ["k"]
+    assert results == [{"key": "k"}] * 3
+    assert results[0] is results[1]
+    assert metrics.get("singleflight.test-share.dedup_factor") == 3.0
+
+    # once finished, the next caller runs the lookup again
+    flight.do("k", lookup, "k")
+    assert calls == ["k", "k"]
+
+
+def test_single_flight_shares_error():
+    """Test that the error of the call is raised to every caller."""
+    flight = SingleFlight("test-error")
+    release = threading.Event()
+
+    def lookup():
+        release.wait(5)
+        raise ValueError("backend failure")
+
+    errors = []
+
+    def call():
+        try:
+            flight.do("k", lookup)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    _wait_for(lambda: metrics.get("singleflight.test-error.requests") == 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 2
+    assert errors[0] is errors[1]
+
+    with pytest.raises(ValueError):
+        flight.do("k", lookup)
+
+
+def test_coalesce():
+    """Test that coalescing is used only for the enabled endpoints."""
+    with patch("src.singleflight.SINGLEFLIGHT_ENDPOINTS", set()):
+        assert coalesce("test-disabled", "k", lambda x: x + 1, 1) == 2
+    assert metrics.get("singleflight.test-disabled.requests") == 0
+
+    with patch("src.singleflight.SINGLEFLIGHT_ENDPOINTS", {"test-enabled"}):
+        assert coalesce("test-enabled", "k", lambda x: x + 1, 1) == 2
+    assert metrics.get("singleflight.test-enabled.requests") == 1
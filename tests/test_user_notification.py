@@ -1,6 +1,21 @@
 """Tests for UserNotification."""
 
-from src.notification.user_notification import UserNotification
+import time
+from concurrent.futures import Future
+from unittest.mock import MagicMock, patch
+
+import requests
+
+from metrics import metrics
+from src.notification.user_notification import UserNotification, NotificationSender, \
+    NotificationQueue, notification_lease
+from src.outbox import Outbox
+
+
+def _response(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return response
 
 
 def test_generate_notification():
@@ -55,3 +70,138 @@ def test_generate_notification_3():
     }
     resp = UserNotification.generate_notification(report)
     assert resp["data"]["attributes"]["custom"]["cve_count"] == 2
+
+
+@patch("src.notification.user_notification.requests.post")
+def test_send_notification(post):
+    """Test that the notification is sent with a timeout."""
+    post.return_value = _response(202)
+    assert UserNotification.send_notification({"data": {}}, "token", timeout=3) == \
+        {"status": "success"}
+    assert post.call_args[1]["timeout"] == 3
+    assert post.call_args[1]["headers"] == {"Authorization": "Bearer token"}
+
+
+def test_notification_sender():
+    """Test the delivery of the notifications in the background."""
+    futures = [Future(), Future(), Future()]
+    session = MagicMock()
+    session.post.side_effect = futures
+    sender = NotificationSender(session, max_pending=2, timeout=3)
+    delivered = metrics.get('notifications.delivered')
+    failed = metrics.get('notifications.failed')
+    rejected = metrics.get('notifications.rejected')
+
+    assert sender.submit({"data": {"id": "1"}}, "token") is futures[0]
+    assert sender.submit({"data": {"id": "2"}}, "token") is futures[1]
+    assert session.post.call_args[1]["timeout"] == 3
+    # the queue is full
+    assert sender.submit({"data": {"id": "3"}}, "token") is None
+    assert metrics.get('notifications.rejected') == rejected + 1
+
+    futures[0].set_result(_response(202))
+    futures[1].set_exception(requests.exceptions.ConnectionError("down"))
+    assert metrics.get('notifications.delivered') == delivered + 1
+    assert metrics.get('notifications.failed') == failed + 1
+
+    assert sender.submit({"data": {"id": "3"}}, "token") is futures[2]
+    futures[2].set_result(_response(503))
+    assert metrics.get('notifications.failed') == failed + 2
+
+
+def _notification(repo_url):
+    return {"data": {"attributes": {"id": repo_url, "custom": {}}, "id": repo_url}}
+
+
+def test_notification_queue(tmp_path):
+    """Test that stored notifications are delivered and retried."""
+    outbox = Outbox(str(tmp_path / 'outbox.sqlite'), 'notifications', base_delay=0)
+    sender = MagicMock()
+    queue = NotificationQueue(outbox, sender, lambda: "token", interval=0, digest_window=0)
+    queue.put(_notification("repo1"))
+    queue.put(_notification("repo2"))
+    queue.put(_notification("repo3"))
+
+    def submit(notification, token):
+        future = Future()
+        repo_url = notification["data"]["id"]
+        if repo_url == "repo1":
+            future.set_result(_response(202))
+        elif repo_url == "repo2":
+            future.set_exception(requests.exceptions.ConnectionError("down"))
+        else:
+            # the queue of the sender is full
+            return None
+        return future
+
+    sender.submit.side_effect = submit
+    assert queue.drainer.drain() == 3
+    assert sender.submit.call_args[0][1] == "token"
+    assert outbox.counts() == {"delivered": 1, "pending": 2}
+    [failed] = [m for m in outbox.claim(10) if m.destination == "repo2"]
+    assert failed.attempts == 1
+
+
+def test_notification_lease():
+    """Test the lease covers delivery of the whole batch."""
+    assert notification_lease(batch_size=20, workers=3, timeout=10) == 140
+
+
+def _report(repo_url, *deps):
+    return {
+        "repo_url": repo_url,
+        "vulnerable_deps": [{"ecosystem": "maven", "name": name, "version": "1",
+                             "cve_count": cve_count, "is_transitive": is_transitive}
+                            for name, cve_count, is_transitive in deps]
+    }
+
+
+def test_merge_notifications():
+    """Test merging notifications of a repository into a digest."""
+    first = UserNotification.generate_notification(
+        _report("http://repo", ("a", 1, False), ("b", 2, True)))
+    second = UserNotification.generate_notification(
+        _report("http://repo", ("b", 3, True), ("c", 1, False)))
+    digest = UserNotification.merge_notifications(first, second)
+    custom = digest["data"]["attributes"]["custom"]
+    assert digest["data"]["id"] == second["data"]["id"]
+    assert [deps["name"] for deps in custom["direct_updates"]] == ["a", "c"]
+    assert [deps["cve_count"] for deps in custom["transitive_updates"]] == [3]
+    assert custom["total_dependencies"] == 3
+    assert custom["cve_count"] == 5
+    assert custom["merged_notifications"] == 2
+
+    third = UserNotification.generate_notification(_report("http://repo", ("a", 1, False)))
+    custom = UserNotification.merge_notifications(digest, third)["data"]["attributes"]["custom"]
+    assert custom["cve_count"] == 5
+    assert custom["merged_notifications"] == 3
+
+
+def test_notification_queue_digest(tmp_path):
+    """Test that notifications of a repository within the window are sent as one digest."""
+    outbox = Outbox(str(tmp_path / 'outbox.sqlite'), 'notifications')
+    queue = NotificationQueue(outbox, MagicMock(), lambda: "token", digest_window=60)
+    queue.put(UserNotification.generate_notification(_report("http://a", ("x", 1, False))))
+    queue.put(UserNotification.generate_notification(_report("http://a", ("y", 2, False))))
+    queue.put(UserNotification.generate_notification(_report("http://b", ("x", 1, False))))
+    assert outbox.counts() == {"pending": 2}
+    assert outbox.claim(10) == []
+
+    with patch("src.outbox.time.time", return_value=time.time() + 61):
+        messages = outbox.claim(10)
+    digests = {m.destination: m.payload["data"]["attributes"]["custom"] for m in messages}
+    assert digests["http://a.git"]["cve_count"] == 3
+    assert digests["http://b.git"]["cve_count"] == 1
+
+    # claimed notifications are not merged into anymore
+    queue.put(UserNotification.generate_notification(_report("http://a", ("z", 1, False))))
+    assert outbox.counts() == {"pending": 3}
+
+
+def test_notification_queue_no_digest_by_default(tmp_path):
+    """Test that notifications are due right away unless the digest window is configured."""
+    outbox = Outbox(str(tmp_path / 'outbox.sqlite'), 'notifications')
+    queue = NotificationQueue(outbox, MagicMock(), lambda: "token")
+    queue.put(_notification("repo1"))
+    queue.put(_notification("repo1"))
+    assert len(outbox.claim(10)) == 2
@@ -5,10 +5,9 @@ from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm.exc import NoResultFound
 
 from src.utils import (
-    DatabaseIngestion, alert_user, fetch_public_key, get_session, get_session_retry,
-    retrieve_worker_result, scan_repo, server_run_flow, validate_request_data,
-    fix_gremlin_output, generate_comparison, get_first_query_result, get_parser_from_ecosystem,
-    PostgresPassThrough, GraphPassThrough
+    DatabaseIngestion, alert_user, fetch_public_key, get_session_retry, validate_request_data,
+    fix_gremlin_output, generate_comparison, get_parser_from_ecosystem, iter_s3_reports,
+    generate_trend, _stacks_index, merge_counts, aggregate_reports
 )
 
 from src.parsers.maven_parser import MavenParser
@@ -16,12 +15,14 @@ from src.parsers.node_parser import NodeParser
 
 from unittest.mock import patch
 import requests
+from botocore.exceptions import ClientError, EndpointConnectionError
+
 import pytest
 import os
 import json
+import datetime
+import threading
 
-ppt = PostgresPassThrough()
-gpt = GraphPassThrough()
 
 mocked_object_response = {'stacks_summary': {'total_average_response_time': '200ms'}}
 
@@ -62,37 +63,6 @@ def test_validate_request_data():
     assert not result
 
 
-def test_get_session():
-    """Test the function get_session."""
-    session = get_session()
-    assert session is not None
-
-
-@patch("src.utils.query_worker_result", side_effect=SQLAlchemyError())
-def test_retrieve_worker_result(_query):
-    """Test the function retrieve_worker_result."""
-    with pytest.raises(SQLAlchemyError):
-        retrieve_worker_result("test", "test")
-
-
-@patch("src.utils.query_worker_result", return_value=None)
-@patch("src.utils.get_first_query_result", return_value=None)
-def test_retrieve_worker_result_1(_a, _b):
-    """Test the function retrieve_worker_result."""
-    response = retrieve_worker_result("test", "test")
-    assert response is None
-
-
-@patch("src.utils.query_worker_result", return_value=None)
-@patch("src.utils.get_first_query_result", **{"return_value.to_dict.return_value": 1})
-@patch("src.utils.get_first_query_result", return_value={"test": "test"})
-def test_retrieve_worker_result_2(_a, _b, _c):
-    """Test the function retrieve_worker_result."""
-    with app.app_context():
-        response = retrieve_worker_result("test", "test")
-        assert response == 1
-
-
 def test_get_session_retry():
     """Test get_session_retry."""
     resp = get_session_retry()
@@ -176,24 +146,27 @@ def test_get_info_1(a):
         DatabaseIngestion.get_info("test")
 
 
-@patch("src.utils.init_celery", return_value=None)
-@patch("src.utils.run_flow", return_value='dispatcher_id')
-def test_server_run_flow(_a, _b):
-    """Test server_run_flow."""
-    resp = server_run_flow("test", "test")
-    assert resp == 'dispatcher_id'
-
-
-@patch("src.utils.server_run_flow", return_value="d_id")
-def test_scan_repo(a):
-    """Test scan_repo."""
-    payload = {
-        "email-ids": "abcd@gmail.com",
-        "git-sha": "somesha",
-        "git-url": "test"
-    }
-    resp = scan_repo(payload)
-    assert resp is True
+@patch("src.utils.get_one_result_from_osio_registered_repos")
+@patch("src.utils.get_session")
+def test_get_info_primary(get_session, _get_one_result):
+    """Test that the record is read from the primary unless a replica is asked for."""
+    DatabaseIngestion.get_info("test")
+    get_session.assert_called_once_with(read_only=False)
+    get_session.reset_mock()
+    DatabaseIngestion.get_info("test", read_only=True)
+    get_session.assert_called_once_with(read_only=True)
+
+
+@patch("src.utils.upsert_osio_registered_repos", return_value=None)
+def test_bulk_upsert(upsert):
+    """Test bulk_upsert."""
+    DatabaseIngestion.bulk_upsert([])
+    upsert.assert_not_called()
+    DatabaseIngestion.bulk_upsert([{"git-url": "test", "git-sha": "sha"}])
+    upsert.assert_called_once()
+    upsert.side_effect = SQLAlchemyError()
+    with pytest.raises(Exception):
+        DatabaseIngestion.bulk_upsert([{"git-url": "test", "git-sha": "sha"}])
 
 
 def mocked_requests_get_1(*_args, **_kwargs):
@@ -306,41 +279,107 @@ def test_fix_gremlin_output():
             expected.pop(name)
 
 
-@patch("src.utils.S3Helper.get_object_content", return_value=mocked_object_response)
-def test_generate_comparison(_mock1):
+@patch("s3_helper.S3Helper.put_object_content")
+@patch("s3_helper.S3Helper.get_object_content", return_value=mocked_object_response)
+def test_generate_comparison(_mock1, _mock2):
     """Test generate_comparison()."""
+    _stacks_index.clear()
     result = generate_comparison(2)
     assert result.get('average_response_time') is not None
 
 
-class QueryResultMock():
-    """Class that mocks QueryResult class."""
-
-    def __init__(self):
-        """Initialize the mocked QueryResult class."""
-        self.first_called = False
-
-    def first(self):
-        """Implement the tested method with tracepoint variable."""
-        self.first_called = True
-        return "X"
-
-    def get_first_called(self):
-        """Return the actual state of tracepoint variable."""
-        return self.first_called
-
-
-def test_get_first_query_result():
-    """Test the function get_first_query_result()."""
-    query_result_mock = QueryResultMock()
-    # make sure the first() was not called
-    assert not query_result_mock.get_first_called()
-
-    # this is a value returned by mocked class
-    assert get_first_query_result(query_result_mock) == "X"
-
-    # now first() was called, so check it
-    assert query_result_mock.get_first_called()
+def _daily_report(name, **_kwargs):
+    """Get mocked daily report, reports of even days are missing."""
+    day = int(name[-7:-5]) if '/daily/' in name else 0
+    if day % 2 == 0:
+        raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'missing'}}, 'GetObject')
+    return {'stacks_summary': {'total_average_response_time': '{}ms'.format(day)}}
+
+
+@patch("s3_helper.S3Helper.put_object_content")
+@patch("s3_helper.S3Helper.get_object_content", side_effect=_daily_report)
+def test_generate_comparison_missing_reports(get_object_content, put_object_content):
+    """Test generate_comparison() skips the missing reports."""
+    _stacks_index.clear()
+    with patch("src.utils.datetime") as mocked_datetime:
+        mocked_datetime.datetime.today.return_value = datetime.datetime(2019, 1, 20)
+        mocked_datetime.timedelta = datetime.timedelta
+        result = generate_comparison(3)
+    assert result == {'average_response_time': [{'2019-01-19': '19ms'},
+                                                {'2019-01-17': '17ms'},
+                                                {'2019-01-15': '15ms'}]}
+    # the index and the six daily reports
+    assert get_object_content.call_count == 7
+    put_object_content.assert_called_once()
+
+    # the next comparison is served by the index alone
+    get_object_content.reset_mock()
+    with patch("src.utils.datetime") as mocked_datetime:
+        mocked_datetime.datetime.today.return_value = datetime.datetime(2019, 1, 20)
+        mocked_datetime.timedelta = datetime.timedelta
+        assert generate_comparison(2) == {'average_response_time': [{'2019-01-19': '19ms'},
+                                                                    {'2019-01-17': '17ms'}]}
+    get_object_content.assert_not_called()
+
+
+@patch("s3_helper.S3Helper.put_object_content")
+@patch("s3_helper.S3Helper.get_object_content",
+       side_effect=ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject'))
+def test_generate_comparison_insufficient_reports(_mock1, _mock2):
+    """Test generate_comparison() without enough reports."""
+    _stacks_index.clear()
+    assert generate_comparison(2) == -1
+
+
+@patch("s3_helper.S3Helper.put_object_content")
+@patch("s3_helper.S3Helper.get_object_content", side_effect=_daily_report)
+def test_generate_trend(_mock1, _mock2):
+    """Test generate_trend()."""
+    _stacks_index.clear()
+    assert generate_trend('2019-01-01', '2019-01-04', ['total_average_response_time']) == [
+        {'date': '2019-01-01', 'total_average_response_time': '1ms'},
+        {'date': '2019-01-03', 'total_average_response_time': '3ms'}]
+    with pytest.raises(ValueError):
+        generate_trend('2019-01-04', '2019-01-01')
+    with pytest.raises(ValueError):
+        generate_trend('2019-01-01', 'yesterday')
+    with pytest.raises(ValueError):
+        generate_trend('2019-01-01', '2019-01-04', ['unknown'])
+
+
+def test_iter_s3_reports_deadline():
+    """Test that reports not fetched before the deadline are treated as missing."""
+    release = threading.Event()
+
+    def get_object_content(name):
+        if name == 'slow':
+            release.wait(5)
+        return {'name': name}
+
+    with patch("s3_helper.S3Helper.get_object_content", side_effect=get_object_content):
+        reports = dict(iter_s3_reports(['fast', 'slow'], deadline=0.2))
+    release.set()
+    assert reports == {'fast': {'name': 'fast'}}
+
+
+def test_iter_s3_reports_errors():
+    """Test that reports failing to be read are left out."""
+    def get_object_content(name):
+        if name == 'malformed':
+            raise ValueError('Expecting value')
+        if name == 'unreachable':
+            raise EndpointConnectionError(endpoint_url='http://s3')
+        if name == 'throttled':
+            raise ClientError({'Error': {'Code': 'SlowDown'}}, 'GetObject')
+        if name == 'missing':
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return {'name': name}
+
+    with patch("s3_helper.S3Helper.get_object_content", side_effect=get_object_content):
+        reports = dict(iter_s3_reports(['good', 'malformed', 'unreachable', 'throttled',
+                                        'missing']))
+    # only the reports that do not exist are reported as missing
+    assert reports == {'good': {'name': 'good'}, 'missing': None}
 
 
 def test_get_parser_from_ecosystem():
@@ -351,41 +390,50 @@ def test_get_parser_from_ecosystem():
     assert get_parser_from_ecosystem("npm").__name__ == NodeParser.__name__
 
 
-def test_fetch_records():
-    """Test the PostgresPassThrough fetch records module."""
-    query = "select id from worker_results limit 1;"
-    resp = ppt.fetch_records(data={}, client_validated=False)
-    assert resp['warning'] == 'Invalid payload. Check your payload once again'
-    resp = ppt.fetch_records(data={'query': {'query': ''}}, client_validated=False)
-    assert resp['error'] is not None
-    resp = ppt.fetch_records(data={'query': 'delete all from some_table;'}, client_validated=False)
-    assert resp['error'] is not None
-    data = {'query': query}
-    resp = ppt.fetch_records(data, client_validated=False)
-    assert resp is not None
-
-
-graph_resp = {
-    "requestId": "5cc29849-8e9b-4b66-90d0-f2569dc962b9",
-    "status": {
-        "message": "",
-        "code": 200,
-        "attributes": {}
-    },
-    "result": {
-        "data": [],
-        "meta": {}
+def test_merge_counts():
+    """Test merging of the report counts."""
+    report = {'report': 'x', 'flag': True, 'npm': {'ingested': 2, 'epvs': ['a', 'b']}}
+    totals = merge_counts({}, report)
+    assert totals == {'npm': {'ingested': 2, 'epvs': 2}}
+    merge_counts(totals, {'npm': {'ingested': 1.5, 'epvs': ['c']}, 'maven': {'ingested': 1}})
+    assert totals == {'npm': {'ingested': 3.5, 'epvs': 3}, 'maven': {'ingested': 1}}
+    # values of conflicting types are skipped
+    merge_counts(totals, {'npm': 1, 'maven': {'ingested': {'x': 1}}})
+    assert totals == {'npm': {'ingested': 3.5, 'epvs': 3}, 'maven': {'ingested': 1}}
+
+
+def _sentry_report(name, **_kwargs):
+    """Get mocked sentry report, the second one is missing."""
+    if name.endswith('02.json'):
+        raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+    return {'report': {'from': name}, 'error_report': {'gemini': {'total_errors': 2}}}
+
+
+@patch("s3_helper.S3Helper.list_objects", return_value={'objects': [
+    "sentry-error-data/2019-01-01.json", "sentry-error-data/2019-01-02.json",
+    "sentry-error-data/2019-01-03.json"]})
+@patch("s3_helper.S3Helper.get_object_content", side_effect=_sentry_report)
+def test_aggregate_reports(get_object_content, list_objects):
+    """Test aggregation of the reports."""
+    aggregation = aggregate_reports("sentry-error-data", "2019-01-01", "2019-01-03")
+    assert aggregation == {
+        'from': '2019-01-01',
+        'to': '2019-01-03',
+        'reports': ["sentry-error-data/2019-01-01.json", "sentry-error-data/2019-01-03.json"],
+        'missing': ["sentry-error-data/2019-01-02.json"],
+        'totals': {'error_report': {'gemini': {'total_errors': 4}}}
     }
-}
-
-
-@patch("src.utils.requests.post", return_value=graph_resp)
-def test_fetch_nodes(_mock1):
-    """Test the GraphPassThrough fetch nodes module."""
-    resp = gpt.fetch_nodes(data={})
-    assert resp['warning'] == 'Invalid payload. Check your payload once again'
-    resp = gpt.fetch_nodes(data={"query": "g.V().has('foo','bar').drop()')"})
-    assert resp['error'] is not None
-    query = "g.V().has('name','foo').valueMap();"
-    resp = gpt.fetch_nodes(data={'query': query})
-    assert resp is not None
+    list_objects.assert_called_with("sentry-error-data", from_date="2019-01-01",
+                                    to_date="2019-01-03")
+
+    with pytest.raises(ValueError):
+        aggregate_reports("sentry-error-data", "2019-01-01", "today")
+    with patch("src.utils.REPORT_AGGREGATION_MAX_REPORTS", 2), pytest.raises(ValueError):
+        aggregate_reports("sentry-error-data", "2019-01-01", "2019-01-04")
+
+    # complete aggregations are remembered
+    get_object_content.side_effect = lambda name, **kwargs: {'errors': 1}
+    aggregate_reports("sentry-error-data", "2019-01-01", "2019-01-05")
+    calls = get_object_content.call_count
+    aggregate_reports("sentry-error-data", "2019-01-01", "2019-01-05")
+    assert get_object_content.call_count == calls
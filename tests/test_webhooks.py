@@ -0,0 +1,183 @@
+"""Tests for the report callbacks."""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from src.outbox import Outbox
+from src.webhooks import WebhookNotifier, is_valid_callback_url, report_summary
+
+result = {
+    "task_result": {
+        "scanned_at": "2019-01-01",
+        "dependencies": [{"cve_count": 2}, {"cve_count": 0}, {}]
+    }
+}
+
+
+@pytest.fixture
+def callback_server():
+    """Local HTTP server recording the callbacks, failing while server.fail is set."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            self.server.received.append((self.path, json.loads(body.decode('utf-8'))))
+            self.send_response(500 if self.server.fail else 200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    server.received = []
+    server.fail = False
+    server.url = 'http://127.0.0.1:{}'.format(server.server_port)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_is_valid_callback_url():
+    """Test the validation of the callback URLs."""
+    assert is_valid_callback_url('https://93.184.216.34/hook')
+    assert not is_valid_callback_url('ftp://93.184.216.34')
+    assert not is_valid_callback_url('93.184.216.34/hook')
+    assert not is_valid_callback_url(None)
+    # internal network
+    assert not is_valid_callback_url('http://127.0.0.1:8080')
+    assert not is_valid_callback_url('http://10.0.0.1/hook')
+    assert not is_valid_callback_url('http://169.254.169.254/latest/meta-data')
+    assert not is_valid_callback_url('http://[::1]/hook')
+    assert not is_valid_callback_url('http://localhost/hook')
+
+
+@patch('src.webhooks.CALLBACK_URL_ALLOWED_HOSTS', ['ci.example.com', '.example.org'])
+def test_is_valid_callback_url_allowed_hosts():
+    """Test that only the allowed hosts are accepted once they are configured."""
+    assert is_valid_callback_url('https://ci.example.com/hook')
+    assert is_valid_callback_url('https://jenkins.example.org/hook')
+    assert not is_valid_callback_url('https://example.org/hook')
+    assert not is_valid_callback_url('https://93.184.216.34/hook')
+
+
+def test_report_summary():
+    """Test the summary of the report."""
+    assert report_summary('url', 'sha', result) == {
+        'git-url': 'url', 'git-sha': 'sha', 'status': 'available',
+        'scanned_at': '2019-01-01', 'dependencies': 3,
+        'vulnerable_dependencies': 1, 'cve_count': 2
+    }
+    assert report_summary('url', 'sha', {'task_result': None})['status'] == 'failure'
+    assert report_summary('url', 'sha', {'task_result': {
+        'lock_file_absent': True, 'message': 'no lock file'}})['status'] == 'lock_file_absent'
+
+
+@patch('src.webhooks.CALLBACK_URL_ALLOWED_HOSTS', ['127.0.0.1'])
+def test_deliver(tmp_path, callback_server):
+    """Test that callbacks are delivered in batches once the reports exist."""
+    outbox = Outbox(str(tmp_path / 'outbox.sqlite'), 'webhooks')
+    fetch_results = MagicMock(return_value={'sha1': result, 'sha2': result})
+    release = MagicMock()
+    notifier = WebhookNotifier(outbox, fetch_results, interval=0, release=release)
+    notifier.register(callback_server.url + '/a', 'url1', 'sha1')
+    notifier.register(callback_server.url + '/a', 'url2', 'sha2')
+    notifier.register(callback_server.url + '/b', 'url3', 'sha3')
+
+    assert notifier.drainer.drain() == 3
+    fetch_results.assert_called_once()
+    # the database session is not held while the callbacks are posted
+    release.assert_called_once()
+    assert sorted(fetch_results.call_args[0][0]) == ['sha1', 'sha2', 'sha3']
+    [(path, body)] = callback_server.received
+    assert path == '/a'
+    assert [report['git-sha'] for report in body['reports']] == ['sha1', 'sha2']
+    assert outbox.counts() == {'delivered': 2, 'pending': 1}
+
+    fetch_results.return_value = {'sha3': {'task_result': None}}
+    assert notifier.drainer.drain() == 1
+    assert callback_server.received[1] == (
+        '/b', {'reports': [{'git-url': 'url3', 'git-sha': 'sha3', 'status': 'failure'}]})
+    assert outbox.counts() == {'delivered': 3}
+
+
+@patch('src.webhooks.CALLBACK_URL_ALLOWED_HOSTS', ['127.0.0.1'])
+def test_deliver_retry(tmp_path, callback_server):
+    """Test that the failed callbacks are retried with backoff."""
+    outbox = Outbox(str(tmp_path / 'outbox.sqlite'), 'webhooks', base_delay=0)
+    notifier = WebhookNotifier(outbox, MagicMock(return_value={'sha1': result}), interval=0)
+    notifier.register(callback_server.url, 'url1', 'sha1')
+
+    callback_server.fail = True
+    notifier.drainer.drain()
+    assert outbox.counts() == {'pending': 1}
+    assert outbox.claim(1)[0].attempts == 1
+    outbox.defer([1], 0)
+
+    callback_server.fail = False
+    notifier.drainer.drain()
+    assert len(callback_server.received) == 2
+    assert outbox.counts() == {'delivered': 1}
+
+
+def test_deliver_lookup_error(tmp_path):
+    """Test that callbacks are deferred, not failed, when the reports cannot be looked up."""
+    outbox = Outbox(str(tmp_path / 'outbox.sqlite'), 'webhooks', max_attempts=1)
+    session = MagicMock()
+    release = MagicMock()
+    notifier = WebhookNotifier(outbox, MagicMock(side_effect=RuntimeError('db down')),
+                               session=session, interval=0, release=release)
+    notifier.register('http://example.com', 'url1', 'sha1')
+    assert notifier.drainer.drain() == 1
+    session.post.assert_not_called()
+    release.assert_called_once()
+    [message] = outbox.claim(10)
+    assert message.attempts == 0
+    assert outbox.counts() == {'pending': 1}
+
+
+def test_deliver_expired(tmp_path):
+    """Test that callbacks of reports that never appear are dead-lettered."""
+    outbox = Outbox(str(tmp_path / 'outbox.sqlite'), 'webhooks')
+    session = MagicMock()
+    notifier = WebhookNotifier(outbox, MagicMock(return_value={}), session=session,
+                               interval=0, max_wait=60)
+    notifier.register('http://example.com', 'url1', 'sha1')
+    outbox.put('http://example.com', {'git-url': 'url2', 'git-sha': 'sha2'})
+    notifier.max_wait = -1
+    notifier.drainer.drain()
+    session.post.assert_not_called()
+    assert outbox.counts() == {'dead': 2}
+
+
+def test_deliver_not_allowed(tmp_path, callback_server):
+    """Test that callbacks are not posted to the hosts that are not allowed."""
+    outbox = Outbox(str(tmp_path / 'outbox.sqlite'), 'webhooks')
+    notifier = WebhookNotifier(outbox, MagicMock(return_value={'sha1': result}), interval=0)
+    notifier.register(callback_server.url, 'url1', 'sha1')
+    notifier.drainer.drain()
+    assert callback_server.received == []
+    assert outbox.counts() == {'dead': 1}
+
+
+@patch('src.webhooks.CALLBACK_URL_ALLOWED_HOSTS', ['127.0.0.1'])
+def test_start(tmp_path, callback_server):
+    """Test the delivery in the background."""
+    outbox = Outbox(str(tmp_path / 'outbox.sqlite'), 'webhooks')
+    notifier = WebhookNotifier(outbox, MagicMock(return_value={'sha1': result}),
+                               interval=0.01).start()
+    try:
+        notifier.register(callback_server.url, 'url1', 'sha1')
+        for _ in range(500):
+            if callback_server.received:
+                break
+            time.sleep(0.01)
+        assert len(callback_server.received) == 1
+    finally:
+        notifier.drainer.stop()
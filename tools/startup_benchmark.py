@@ -0,0 +1,51 @@
+"""Measure the time the service needs to start answering requests.
+
+Each run imports the application in a fresh interpreter and reports how long
+the import took and how long the first liveness and readiness requests took.
+
+Usage:
+PYTHONPATH=src python3 tools/startup_benchmark.py [runs]
+"""
+
+import json
+import statistics
+import subprocess
+import sys
+
+MEASURE = """
+import json
+import time
+
+start = time.time()
+from rest_api import app
+imported = time.time()
+client = app.test_client()
+client.get('/api/v1/liveness')
+liveness = time.time()
+client.get('/api/v1/readiness')
+readiness = time.time()
+print(json.dumps({'import': imported - start,
+                  'first_liveness': liveness - imported,
+                  'first_readiness': readiness - liveness}))
+"""
+
+
+def measure():
+    """Start the application in a fresh interpreter and get its timings."""
+    output = subprocess.check_output([sys.executable, '-c', MEASURE])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main(arguments):
+    """Run the benchmark and print the timings in seconds."""
+    runs = int(arguments[1]) if len(arguments) > 1 else 5
+    timings = [measure() for _ in range(runs)]
+    summary = {}
+    for name in timings[0]:
+        values = [timing[name] for timing in timings]
+        summary[name] = {'median': statistics.median(values), 'max': max(values)}
+    print(json.dumps(summary, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(sys.argv)